@@ -27,6 +27,8 @@ id SERIAL NOT NULL AUTO_INCREMENT,
 login_id INTEGER,
 ab_session_id BIGINT UNIQUE,
 tzname TEXT,
+router_epoch TEXT,
+created_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
 PRIMARY KEY (id)
 );
 
@@ -37,6 +39,20 @@ session_id INTEGER,
 topic_name TEXT,
 type_id TEXT,
 allow BOOLEAN,
+modified_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+PRIMARY KEY (id)
+);
+
+CREATE TABLE activity_rollup
+(
+id SERIAL NOT NULL AUTO_INCREMENT,
+session_id INTEGER,
+topic_name TEXT,
+type_id TEXT,
+allow BOOLEAN,
+count BIGINT NOT NULL DEFAULT 0,
+first_seen TIMESTAMP NULL,
+last_seen TIMESTAMP NULL,
 PRIMARY KEY (id)
 );
 
@@ -67,6 +83,16 @@ role_id INTEGER NOT NULL,
 PRIMARY KEY (id)
 );
 
+CREATE TABLE router_instance
+(
+id VARCHAR(32) NOT NULL,
+host TEXT,
+started BIGINT,
+heartbeat BIGINT,
+beat_interval INTEGER,
+PRIMARY KEY (id)
+);
+
 CREATE TABLE sqlauth
 (
 component TEXT,
@@ -91,6 +117,12 @@ ALTER TABLE activity ADD FOREIGN KEY session_id_idxfk (session_id) REFERENCES se
 
 ALTER TABLE activity ADD FOREIGN KEY type_id_idxfk (type_id) REFERENCES activity_type (id);
 
+CREATE UNIQUE INDEX activity_rollup_session_id_topic_name_type_id_allow ON activity_rollup (session_id,topic_name(100),type_id(50),allow);
+
+ALTER TABLE activity_rollup ADD FOREIGN KEY session_id_idxfk_1 (session_id) REFERENCES session (id);
+
+ALTER TABLE activity_rollup ADD FOREIGN KEY type_id_idxfk_2 (type_id) REFERENCES activity_type (id);
+
 ALTER TABLE role ADD FOREIGN KEY role_topic_binding (bind_to) REFERENCES topic (id) ON DELETE SET NULL;
 
 CREATE UNIQUE INDEX topicrole_topic_id_role_id_type_id ON topicrole (topic_id,role_id,type_id(50),allow);
@@ -106,3 +138,13 @@ CREATE UNIQUE INDEX loginrole_login_id_role_id ON loginrole (login_id,role_id);
 ALTER TABLE loginrole ADD FOREIGN KEY login_id_idxfk_1 (login_id) REFERENCES login (id);
 
 ALTER TABLE loginrole ADD FOREIGN KEY role_id_idxfk_1 (role_id) REFERENCES role (id);
+
+CREATE INDEX topicrole_role_id_type_id ON topicrole (role_id,type_id(50));
+
+CREATE INDEX activity_session_id ON activity (session_id);
+
+CREATE INDEX activity_type_id_allow ON activity (type_id(50),allow);
+
+CREATE INDEX session_router_epoch ON session (router_epoch(32));
+
+CREATE VIEW activity_all AS SELECT id, session_id, topic_name, type_id, allow, modified_timestamp FROM activity;
@@ -185,6 +185,15 @@ CREATE SEQUENCE activity_id_seq
 
 ALTER SEQUENCE activity_id_seq OWNER TO postgres;
 
+CREATE SEQUENCE activity_rollup_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MAXVALUE
+    NO MINVALUE
+    CACHE 1;
+
+ALTER SEQUENCE activity_rollup_id_seq OWNER TO postgres;
+
 CREATE SEQUENCE session_id_seq
     START WITH 1
     INCREMENT BY 1
@@ -208,6 +217,7 @@ CREATE TABLE session (
     login_id integer,
     ab_session_id bigint,
     tzname text,
+    router_epoch text,
     created_by_user integer NOT NULL,
     created_timestamp timestamp with time zone NOT NULL,
     modified_by_user integer NOT NULL,
@@ -252,6 +262,18 @@ CREATE TABLE activity (
 
 ALTER TABLE activity OWNER TO postgres;
 
+CREATE TABLE activity_rollup (
+    id integer NOT NULL,
+    session_id integer,
+    topic_name text,
+    type_id text,
+    allow boolean,
+    count bigint DEFAULT 0 NOT NULL,
+    first_seen timestamp with time zone,
+    last_seen timestamp with time zone);
+
+ALTER TABLE activity_rollup OWNER TO postgres;
+
 CREATE TABLE topicrole (
     id integer NOT NULL,
     topic_id integer NOT NULL,
@@ -263,6 +285,15 @@ CREATE TABLE topicrole (
 
 ALTER TABLE topicrole OWNER TO postgres;
 
+CREATE TABLE router_instance (
+    id character varying(32) NOT NULL,
+    host text,
+    started bigint,
+    heartbeat bigint,
+    beat_interval integer);
+
+ALTER TABLE router_instance OWNER TO postgres;
+
 CREATE TABLE sqlauth (
     component text NOT NULL,
     version text,
@@ -305,6 +336,8 @@ ALTER SEQUENCE topicrole_id_seq OWNED BY topicrole.id;
 
 ALTER SEQUENCE activity_id_seq OWNED BY activity.id;
 
+ALTER SEQUENCE activity_rollup_id_seq OWNED BY activity_rollup.id;
+
 ALTER SEQUENCE session_id_seq OWNED BY session.id;
 
 ALTER SEQUENCE topicrole_role_id_seq OWNED BY topicrole.role_id;
@@ -317,6 +350,8 @@ ALTER TABLE role ALTER COLUMN id SET DEFAULT nextval('role_id_seq'::regclass);
 
 ALTER TABLE activity ALTER COLUMN id SET DEFAULT nextval('activity_id_seq'::regclass);
 
+ALTER TABLE activity_rollup ALTER COLUMN id SET DEFAULT nextval('activity_rollup_id_seq'::regclass);
+
 ALTER TABLE topicrole ALTER COLUMN id SET DEFAULT nextval('topicrole_id_seq'::regclass);
 
 ALTER TABLE topicrole ALTER COLUMN role_id SET DEFAULT nextval('topicrole_role_id_seq'::regclass);
@@ -353,8 +388,14 @@ ALTER TABLE login ADD CONSTRAINT login_pkey PRIMARY KEY (id);
 
 ALTER TABLE activity ADD CONSTRAINT activity_pkey PRIMARY KEY (id);
 
+ALTER TABLE activity_rollup ADD CONSTRAINT activity_rollup_pkey PRIMARY KEY (id);
+
+ALTER TABLE activity_rollup ADD CONSTRAINT activity_rollup_session_id_topic_name_type_id_allow UNIQUE (session_id, topic_name, type_id, allow);
+
 ALTER TABLE session ADD CONSTRAINT session_ab_session_id UNIQUE (ab_session_id);
 
+ALTER TABLE router_instance ADD CONSTRAINT router_instance_pkey PRIMARY KEY (id);
+
 ALTER TABLE sqlauth ADD CONSTRAINT sqlauth_pkey PRIMARY KEY (component);
 
 ALTER TABLE loginrole ADD CONSTRAINT loginrole_login_id_fkey FOREIGN KEY (login_id) REFERENCES login (id);
@@ -373,8 +414,22 @@ ALTER TABLE topicrole ADD CONSTRAINT topicrole_type_id_fkey FOREIGN KEY (type_id
 
 ALTER TABLE activity ADD CONSTRAINT activity_type_id_fkey FOREIGN KEY (type_id) REFERENCES activity_type (id);
 
+ALTER TABLE activity_rollup ADD CONSTRAINT activity_rollup_session_id_fkey FOREIGN KEY (session_id) REFERENCES session (id);
+
+ALTER TABLE activity_rollup ADD CONSTRAINT activity_rollup_type_id_fkey FOREIGN KEY (type_id) REFERENCES activity_type (id);
+
 ALTER TABLE loginrole ADD CONSTRAINT loginrole_role_id_fkey FOREIGN KEY (role_id) REFERENCES role (id);
 
+CREATE INDEX loginrole_role_id ON loginrole (role_id);
+
+CREATE INDEX topicrole_role_id_type_id ON topicrole (role_id,type_id);
+
+CREATE INDEX activity_session_id ON activity (session_id);
+
+CREATE INDEX activity_type_id_allow ON activity (type_id,allow);
+
+CREATE INDEX session_router_epoch ON session (router_epoch);
+
 CREATE TRIGGER topic_20_audit_fullmodified
     BEFORE INSERT OR UPDATE OR DELETE ON topic
     FOR EACH ROW
@@ -28,6 +28,7 @@ id SERIAL NOT NULL,
 login_id INTEGER,
 ab_session_id BIGINT UNIQUE,
 tzname TEXT,
+router_epoch TEXT,
 PRIMARY KEY (id)
 );
 
@@ -41,6 +42,19 @@ allow BOOLEAN,
 PRIMARY KEY (id)
 );
 
+CREATE TABLE activity_rollup
+(
+id SERIAL NOT NULL,
+session_id INTEGER,
+topic_name TEXT,
+type_id TEXT,
+allow BOOLEAN,
+count BIGINT NOT NULL DEFAULT 0,
+first_seen TIMESTAMP WITH TIME ZONE,
+last_seen TIMESTAMP WITH TIME ZONE,
+PRIMARY KEY (id)
+);
+
 CREATE TABLE role
 (
 bind_to INTEGER,
@@ -68,6 +82,16 @@ role_id INTEGER NOT NULL,
 PRIMARY KEY (id)
 );
 
+CREATE TABLE router_instance
+(
+id VARCHAR(32) NOT NULL,
+host TEXT,
+started BIGINT,
+heartbeat BIGINT,
+beat_interval INTEGER,
+PRIMARY KEY (id)
+);
+
 CREATE TABLE sqlauth
 (
 component TEXT,
@@ -92,6 +116,12 @@ ALTER TABLE activity ADD FOREIGN KEY (session_id) REFERENCES session (id);
 
 ALTER TABLE activity ADD FOREIGN KEY (type_id) REFERENCES activity_type (id);
 
+ALTER TABLE activity_rollup ADD CONSTRAINT activity_rollup_session_id_topic_name_type_id_allow UNIQUE (session_id,topic_name,type_id,allow);
+
+ALTER TABLE activity_rollup ADD FOREIGN KEY (session_id) REFERENCES session (id);
+
+ALTER TABLE activity_rollup ADD FOREIGN KEY (type_id) REFERENCES activity_type (id);
+
 ALTER TABLE role ADD CONSTRAINT role_topic_binding FOREIGN KEY (bind_to) REFERENCES topic (id) ON DELETE SET NULL;
 
 ALTER TABLE topicrole ADD CONSTRAINT topicrole_topic_id_role_id_type_id UNIQUE (topic_id,role_id,type_id,allow);
@@ -107,3 +137,13 @@ ALTER TABLE loginrole ADD CONSTRAINT loginrole_login_id_role_id UNIQUE (login_id
 ALTER TABLE loginrole ADD FOREIGN KEY (login_id) REFERENCES login (id);
 
 ALTER TABLE loginrole ADD FOREIGN KEY (role_id) REFERENCES role (id);
+
+CREATE INDEX loginrole_role_id ON loginrole (role_id);
+
+CREATE INDEX topicrole_role_id_type_id ON topicrole (role_id,type_id);
+
+CREATE INDEX activity_session_id ON activity (session_id);
+
+CREATE INDEX activity_type_id_allow ON activity (type_id,allow);
+
+CREATE INDEX session_router_epoch ON session (router_epoch);
@@ -10,7 +10,7 @@ description TEXT
 CREATE TABLE login
 (
 /*Primary Key for the user*/
-id SERIAL PRIMARY KEY  AUTOINCREMENT,
+id INTEGER PRIMARY KEY  AUTOINCREMENT,
 login TEXT UNIQUE,
 fullname TEXT,
 password TEXT NOT NULL,
@@ -22,45 +22,69 @@ inactive BOOLEAN
 
 CREATE TABLE session
 (
-id SERIAL NOT NULL PRIMARY KEY  AUTOINCREMENT,
+id INTEGER NOT NULL PRIMARY KEY  AUTOINCREMENT,
 login_id INTEGER REFERENCES login (id),
 ab_session_id BIGINT UNIQUE,
-tzname TEXT
+tzname TEXT,
+router_epoch TEXT,
+created_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
 CREATE TABLE activity
 (
-id SERIAL NOT NULL PRIMARY KEY  AUTOINCREMENT,
+id INTEGER NOT NULL PRIMARY KEY  AUTOINCREMENT,
 session_id INTEGER REFERENCES session (id),
 topic_name TEXT,
 type_id TEXT REFERENCES activity_type (id),
-allow BOOLEAN
+allow BOOLEAN,
+modified_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE activity_rollup
+(
+id INTEGER NOT NULL PRIMARY KEY  AUTOINCREMENT,
+session_id INTEGER REFERENCES session (id),
+topic_name TEXT,
+type_id TEXT REFERENCES activity_type (id),
+allow BOOLEAN,
+count BIGINT NOT NULL DEFAULT 0,
+first_seen TIMESTAMP,
+last_seen TIMESTAMP
 );
 
 CREATE TABLE role
 (
 bind_to INTEGER REFERENCES topic (id)  ON DELETE SET NULL,
 name TEXT NOT NULL UNIQUE,
-id SERIAL PRIMARY KEY,
+id INTEGER PRIMARY KEY  AUTOINCREMENT,
 description TEXT
 );
 
 CREATE TABLE topicrole
 (
-id SERIAL NOT NULL PRIMARY KEY  AUTOINCREMENT,
+id INTEGER NOT NULL PRIMARY KEY  AUTOINCREMENT,
 topic_id INTEGER NOT NULL REFERENCES topic (id),
-role_id SERIAL NOT NULL REFERENCES role (id),
+role_id INTEGER NOT NULL REFERENCES role (id),
 type_id TEXT NOT NULL REFERENCES activity_type (id),
 allow BOOLEAN
 );
 
 CREATE TABLE loginrole
 (
-id SERIAL NOT NULL PRIMARY KEY  AUTOINCREMENT,
+id INTEGER NOT NULL PRIMARY KEY  AUTOINCREMENT,
 login_id INTEGER NOT NULL REFERENCES login (id),
 role_id INTEGER NOT NULL REFERENCES role (id)
 );
 
+CREATE TABLE router_instance
+(
+id VARCHAR(32) NOT NULL PRIMARY KEY,
+host TEXT,
+started BIGINT,
+heartbeat BIGINT,
+beat_interval INTEGER
+);
+
 CREATE TABLE sqlauth
 (
 component TEXT PRIMARY KEY,
@@ -70,7 +94,7 @@ profile JSONB
 
 CREATE TABLE topic
 (
-id SERIAL NOT NULL PRIMARY KEY  AUTOINCREMENT,
+id INTEGER NOT NULL PRIMARY KEY  AUTOINCREMENT,
 name TEXT NOT NULL UNIQUE,
 description TEXT
 );
@@ -80,3 +104,17 @@ CREATE UNIQUE INDEX session_ab_session_id ON session (ab_session_id);
 CREATE UNIQUE INDEX topicrole_topic_id_role_id_type_id ON topicrole (topic_id,role_id,type_id,allow);
 
 CREATE UNIQUE INDEX loginrole_login_id_role_id ON loginrole (login_id,role_id);
+
+CREATE UNIQUE INDEX activity_rollup_session_id_topic_name_type_id_allow ON activity_rollup (session_id,topic_name,type_id,allow);
+
+CREATE INDEX loginrole_role_id ON loginrole (role_id);
+
+CREATE INDEX topicrole_role_id_type_id ON topicrole (role_id,type_id);
+
+CREATE INDEX activity_session_id ON activity (session_id);
+
+CREATE INDEX activity_type_id_allow ON activity (type_id,allow);
+
+CREATE INDEX session_router_epoch ON session (router_epoch);
+
+CREATE VIEW activity_all AS SELECT id, session_id, topic_name, type_id, allow, modified_timestamp FROM activity;
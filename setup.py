@@ -72,6 +72,7 @@ setup(
          'sqladm = sqlauth.scripts.sqladm:run',
          'sqlauthrpc = sqlauth.scripts.sqlauthrpc:run',
          'sqlauthrouter = sqlauth.scripts.sqlauthrouter:run',
+         'sqlmigrate = sqlauth.scripts.sqlmigrate:run',
       ]},
    packages = find_packages(),
    include_package_data = True,
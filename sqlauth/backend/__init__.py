@@ -0,0 +1,43 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## backend - the sql behind sqlauth, one backend per database engine
+##
+## get_backend(engine) takes the same engine names sqlbridge does.
+###############################################################################
+
+from sqlauth.backend.base import Backend
+from sqlauth.backend.postgres import PostgresBackend
+from sqlauth.backend.sqlite import SqliteBackend
+from sqlauth.backend.mysql import MysqlBackend
+
+ENGINES = {
+    'PG9_4': PostgresBackend,
+    'PG': PostgresBackend,
+    'SQLITE3_3_8_2': SqliteBackend,
+    'SQLITE3': SqliteBackend,
+    'SQLITE': SqliteBackend,
+    'MYSQL14_14': MysqlBackend,
+    'MYSQL': MysqlBackend,
+}
+
+def get_backend(engine, run=None):
+    if not engine in ENGINES:
+        raise Exception("unsupported engine {}, choose one of {}".format(engine, ', '.join(sorted(ENGINES.keys()))))
+    return ENGINES[engine](run)
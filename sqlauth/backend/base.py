@@ -0,0 +1,821 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## base.py - the sqlauth operations, written once for every engine
+##
+## a backend knows the sql for the user, role, topic, session and activity
+## operations.  it doesn't know how to reach the database, that is the
+## runner: a function run(sql, args) returning a deferred with a list of
+## dictionaries, or a list of those when sql is a list of statements (which
+## run in one transaction).  sqlauthrpc runs it over topic_base.db.query,
+## DirectDb runs it on its own connection pool.  the list operations can
+## also answer in columnar form (see columnar.py), from the cursor when the
+## runner has a columnar version.
+##
+## the sql here sticks to what postgres, sqlite and mysql all understand.
+## the differences (aggregating names, formatting a timestamp, returning)
+## are the small methods the engine subclasses override.
+###############################################################################
+
+import re
+import datetime
+
+from twisted.python import log
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks
+
+from sqlauth.backend import columnar as col
+
+# the columns of activity, in order, the same in every partition
+ACTIVITY_COLUMNS = "id, session_id, topic_name, type_id, allow, modified_timestamp"
+
+# activity_p20261015_20261017 holds 2026-10-15 up to (not including) 2026-10-17
+
+# a router that has missed this many heartbeats is gone
+ROUTER_MISSED = 3
+_ROUTER_ALIVE = "heartbeat + {} * beat_interval >= %(now)s".format(ROUTER_MISSED)
+_ROTATED = re.compile(r'^activity_p(\d{8})_(\d{8})$')
+
+class Backend(object):
+    """
+    sqlauth operations, engine neutral
+    """
+
+    # name used in log messages and the engine column of benchmarks
+    name = 'base'
+    # driver argument style, 'pyformat' (%(name)s) or 'named' (:name)
+    paramstyle = 'pyformat'
+    # does insert/update/delete ... returning work?
+    has_returning = False
+    # most values in one in_list, None when a list is one argument whatever
+    # its length
+    in_limit = 500
+    # can statements be PREPAREd by name?
+    can_prepare = False
+    # can the sql run through sqlbridge (topic_base.db.query)?  the lists of
+    # statements and the %(name)s arguments are only passed on as they are,
+    # an engine that can't take them needs DirectDb (--dsn, --direct).
+    bridge = False
+    # the result titles of activity_rollup
+    rollup_titles = [ 'Upserted' ]
+
+    def __init__(self, run=None, run_columns=None):
+        self.run = run
+        self.run_columns = run_columns
+
+        return
+
+    #
+    # run_columns(sql, args), if given, is the runner's columnar version,
+    # returning a columnar.Columns built from the cursor
+    #
+    def set_runner(self, run, run_columns=None):
+        self.run = run
+        self.run_columns = run_columns
+
+        return
+
+    # one statement, the result [ headers, row ... ] as columnar.encode has it
+    def run_columnar(self, s, a):
+        if self.run_columns is not None:
+            return self.run_columns(s, a)
+        return self.run(s, a).addCallback(col.encode)
+
+    def _runner(self, columnar):
+        return self.run_columnar if columnar else self.run
+
+    #
+    # a new adbapi ConnectionPool for dsn, openfun is called on every new
+    # connection.  only the engines DirectDb can use implement this.
+    #
+    def connect(self, dsn, min_conn=2, max_conn=5, openfun=None):
+        raise Exception("{} backend has no connection pool".format(self.name))
+
+    #
+    # dialect, overridden by the engines
+    #
+
+    # aggregate a column of names into one value
+    def agg(self, expr):
+        return "group_concat({})".format(expr)
+
+    # a timestamp as text, YYYY-MM-DD HH:MM:SS
+    def fmt_ts(self, expr):
+        raise NotImplementedError
+
+    # how long ago a timestamp was, HH:MM:SS
+    def age(self, expr):
+        raise NotImplementedError
+
+    # seconds since the epoch to a timestamp
+    def from_epoch(self, expr):
+        raise NotImplementedError
+
+    # the id of the row just inserted
+    def last_id(self):
+        raise NotImplementedError
+
+    # boolean true literal
+    def true(self):
+        return 'true'
+
+    #
+    # expr is one of the values in qa[key], which in_arg made of a list of
+    # values of type cast.  here an in ( ... ) list, so the statement text
+    # changes with the length, and it can't be empty.
+    #
+    def in_list(self, expr, key, cast):
+        return "{} in %({})s".format(expr, key)
+
+    def in_arg(self, values):
+        return tuple(values)
+
+    #
+    # schema, for migrate.py
+    #
+
+    # a column of an index.  mysql can only index text with a prefix length,
+    # written col(n), the others drop it.
+    def index_column(self, col):
+        return col.split('(')[0]
+
+    def create_index(self, name, table, columns):
+        return "create index {} on {} ( {} )".format(name, table,
+            ', '.join([ self.index_column(c) for c in columns ]))
+
+    # a row if index name exists, none if it doesn't
+    def index_exists(self, name):
+        raise NotImplementedError
+
+    # a row if table has a column name, none if it doesn't
+    def column_exists(self, table, name):
+        raise NotImplementedError
+
+    # the plan sql would run with
+    def explain(self, sql, args):
+        return self.run("explain " + sql, args)
+
+    # the tables (or aliases) the plan reads from start to finish
+    def plan_scans(self, plan):
+        raise NotImplementedError
+
+    #
+    # returning(dml, cols, table, where, before) -> ( statements, keep )
+    # with returning this is just dml returning cols.  without, the rows are
+    # read with a select on table, before a delete (where picks them) or
+    # after an insert (the row just inserted) or update (where picks them).
+    # an update that changes the columns where looks at sets before=True.
+    # keep is the index of the statement whose rows are the result.
+    #
+    def returning(self, dml, cols, table, where=None, before=None):
+        if self.has_returning:
+            return [ dml + "\n returning " + cols ], 0
+        if where is None:
+            where = "id = {}".format(self.last_id())
+        if before is None:
+            before = dml.lstrip().lower().startswith('delete')
+        select = "select {} from {} where {}".format(cols, table, where)
+        if before:
+            return [ select, dml ], 0
+        return [ dml, select ], 1
+
+    #
+    # run a list of returning() steps in one transaction, the result is one
+    # list of rows per step (a single step gives just its rows).
+    #
+    @inlineCallbacks
+    def _steps(self, steps, args):
+        sl = []
+        keep = []
+        for s, k in steps:
+            keep.append(len(sl) + k)
+            sl.extend(s)
+        if len(sl) == 1:
+            rv = yield self.run(sl[0], args)
+            defer.returnValue(rv)
+        rv = yield self.run(sl, args)
+        rv = [ rv[k] for k in keep ]
+        if len(steps) == 1:
+            defer.returnValue(rv[0])
+        defer.returnValue(rv)
+
+    #
+    # users
+    #
+    #
+    # keyset paging for the list operations.  after is the key of the last
+    # row of the previous page (None for the first), limit the page size
+    # (None for all of it).  returns the condition on key (joined with
+    # join, 'where' or 'and'), the limit clause, and their arguments.
+    # with columnar=True a list operation answers as run_columnar does.
+    #
+    def _page(self, key, after, limit, join='and'):
+        qa = {}
+        cond = ''
+        if after is not None:
+            qa['after'] = after
+            cond = '\n             {} {} > %(after)s'.format(join, key)
+        page = ''
+        if limit is not None:
+            qa['limit'] = limit
+            page = '\n         limit %(limit)s'
+        return cond, page, qa
+
+    def user_list(self, after=None, limit=None, columnar=False):
+        cond, page, qa = self._page('l.login', after, limit)
+        return self._runner(columnar)("""
+            select l.id, l.login, l.fullname, l.tzname, {} as roles
+              from login l
+         left join loginrole lr on lr.login_id = l.id
+         left join role r on r.id = lr.role_id
+             where l.login is not null{}
+          group by l.id, l.login, l.fullname, l.tzname
+          order by l.login{}""".format(self.agg('r.name'), cond, page), qa)
+
+    def user_get(self, qa):
+        return self.run("""
+            select password, salt, login, fullname, tzname, id
+              from login
+             where login = %(login)s""", qa)
+
+    # qa has login, fullname, password, salt and tzname
+    def user_add(self, qa):
+        return self._steps([
+            self.returning("""
+                insert into login ( login, fullname, password, salt, tzname )
+                values ( %(login)s, %(fullname)s, %(password)s, %(salt)s, %(tzname)s )""",
+                "id, login, fullname", "login")
+            ], qa)
+
+    # the login name is nulled and its roles removed, the row stays
+    def user_delete(self, qa):
+        return self._steps([
+            self.returning("""
+                delete from loginrole
+                 where login_id = ( select id from login where login = %(login)s )""",
+                "id, login_id, role_id", "loginrole",
+                "login_id = ( select id from login where login = %(login)s )"),
+            self.returning("""
+                update login
+                   set login = null, salt = 'shutdown', password = 'inactive', old_login = %(login)s
+                 where login = %(login)s""",
+                "id, old_login as login, password, salt", "login",
+                "old_login = %(login)s and login is null and password = 'inactive'")
+            ], qa)
+
+    #
+    # roles
+    #
+    def role_list(self, after=None, limit=None, columnar=False):
+        cond, page, qa = self._page('r.name', after, limit, 'where')
+        return self._runner(columnar)("""
+            select r.name, r.description, t.name as role_binding, {} as users
+              from role r
+         left join topic t on t.id = r.bind_to
+         left join loginrole lr on lr.role_id = r.id
+         left join login l on l.id = lr.login_id{}
+          group by r.name, r.description, t.name
+          order by r.name{}""".format(self.agg('l.login'), cond, page), qa)
+
+    def role_get(self, qa):
+        return self.run("""
+            select r.name, r.description, t.name, r.id
+              from role as r
+         left join topic t on t.id = r.bind_to
+             where r.name = %(name)s""", qa)
+
+    # the name of the topic role name is bound to
+    def role_bind_topic(self, qa):
+        return self.run("""
+            select t.name
+              from topic t, role r
+             where t.id = r.bind_to
+               and r.name = %(name)s""", qa)
+
+    # qa has name, description and bind_to_name (the topic to create and bind to)
+    def role_add(self, qa):
+        return self._steps([
+            self.returning("""
+                insert into topic ( name, description )
+                values ( %(bind_to_name)s, %(description)s )""",
+                "id, name as bind_to_name, description", "topic"),
+            self.returning("""
+                insert into role ( name, description, bind_to )
+                values ( %(name)s, %(description)s,
+                    ( select id from topic where name = %(bind_to_name)s ) )""",
+                "id, name, description, bind_to", "role"),
+            self.returning("""
+                insert into topicrole ( topic_id, role_id, type_id, allow )
+                values (
+                    ( select bind_to from role where name = %(name)s ),
+                    ( select id from role where name = %(name)s ),
+                    'admin', {} )""".format(self.true()),
+                "id, topic_id, role_id, type_id, allow", "topicrole")
+            ], qa)
+
+    def role_delete(self, qa):
+        return self._steps([
+            self.returning("""
+                delete from topicrole
+                 where role_id = ( select id from role where name = %(name)s )""",
+                "id, topic_id, role_id", "topicrole",
+                "role_id = ( select id from role where name = %(name)s )"),
+            self.returning("""
+                delete from loginrole
+                 where role_id = ( select id from role where name = %(name)s )""",
+                "id, login_id, role_id", "loginrole",
+                "role_id = ( select id from role where name = %(name)s )"),
+            self.returning("""
+                delete from topicrole
+                 where topic_id = ( select bind_to from role where name = %(name)s )""",
+                "id, topic_id, role_id", "topicrole",
+                "topic_id = ( select bind_to from role where name = %(name)s )"),
+            self.returning("""
+                delete from topic
+                 where id = ( select bind_to from role where name = %(name)s )""",
+                "id, name, description", "topic",
+                "id = ( select bind_to from role where name = %(name)s )"),
+            self.returning("""
+                delete from role where name = %(name)s""",
+                "id, name, description", "role", "name = %(name)s")
+            ], qa)
+
+    #
+    # topics
+    #
+    def topic_list(self, after=None, limit=None, columnar=False):
+        cond, page, qa = self._page('t.name', after, limit, 'where')
+        return self._runner(columnar)("""
+            select t.id, t.name, t.description, {} as roles
+              from topic t
+         left join ( select distinct tr.role_id, tr.topic_id, r.name
+                       from topicrole tr, role r
+                      where tr.role_id = r.id ) u on t.id = u.topic_id{}
+          group by t.id, t.name, t.description
+          order by t.name{}""".format(self.agg('u.name'), cond, page), qa)
+
+    def topic_get(self, qa):
+        return self.run("""
+            select name, description, id
+              from topic
+             where name = %(name)s""", qa)
+
+    def topic_add(self, qa):
+        return self._steps([
+            self.returning("""
+                insert into topic ( name, description )
+                values ( %(name)s, %(description)s )""",
+                "id, name, description", "topic")
+            ], qa)
+
+    def topic_delete(self, qa):
+        return self._steps([
+            self.returning("""
+                delete from topicrole
+                 where topic_id = ( select id from topic where name = %(name)s )""",
+                "id, topic_id, role_id", "topicrole",
+                "topic_id = ( select id from topic where name = %(name)s )"),
+            self.returning("""
+                delete from topic where name = %(name)s""",
+                "id, name, description", "topic", "name = %(name)s")
+            ], qa)
+
+    #
+    # permissions
+    #
+
+    # qa has authid, type_id and topiclist, the topic and each of its parents.
+    # the first row decides, see statements.PERMISSION_QUERY
+    def topicrole_permission(self, qa):
+        return self.run("""
+            select t.name, length(t.name) as topic_length, tr.allow
+              from topic as t, topicrole as tr, loginrole as lr
+             where {}
+               and t.id = tr.topic_id
+               and tr.role_id = lr.role_id
+               and tr.type_id = %(type_id)s
+               and lr.login_id = %(authid)s
+          order by topic_length, tr.allow""".format(self.in_list('t.name', 'topiclist', 'text')),
+            dict(qa, topiclist=self.in_arg(qa['topiclist'])))
+
+    def userrole_add(self, qa):
+        return self._steps([
+            self.returning("""
+                insert into loginrole ( login_id, role_id )
+                values (
+                    ( select id from login where login = %(login)s ),
+                    ( select id from role where name = %(name)s ) )""",
+                "id, login_id, role_id", "loginrole")
+            ], qa)
+
+    def userrole_delete(self, qa):
+        where = """login_id = ( select id from login where login = %(login)s )
+                   and role_id = ( select id from role where name = %(name)s )"""
+        return self._steps([
+            self.returning("delete from loginrole where " + where,
+                "id, login_id, role_id", "loginrole", where)
+            ], qa)
+
+    #
+    # qa has topic_name and name (the role), types is the list of activity
+    # types.  one row each, qa gets type_id_0, type_id_1 ...
+    #
+    def topicrole_add(self, qa, types):
+        steps = []
+        for i in range(len(types)):
+            qa['type_id_'+str(i)] = types[i]
+            steps.append(self.returning("""
+                insert into topicrole ( topic_id, role_id, type_id, allow )
+                values (
+                    ( select id from topic where name = %(topic_name)s ),
+                    ( select id from role where name = %(name)s ),
+                    %(type_id_{})s, {} )""".format(i, self.true()),
+                "id, topic_id, role_id, type_id, allow", "topicrole"))
+        return self._steps(steps, qa)
+
+    def topicrole_delete(self, qa, types):
+        steps = []
+        for i in range(len(types)):
+            qa['type_id_'+str(i)] = types[i]
+            where = """topic_id = ( select id from topic where name = %(topic_name)s )
+                   and role_id = ( select id from role where name = %(name)s )
+                   and type_id = %(type_id_{})s""".format(i)
+            steps.append(self.returning("delete from topicrole where " + where,
+                "id, topic_id, role_id, type_id, allow", "topicrole", where))
+        return self._steps(steps, qa)
+
+    #
+    # sessions
+    #
+    def session_list(self, after=None, limit=None, columnar=False):
+        cond, page, qa = self._page('s.id', after, limit)
+        return self._runner(columnar)("""
+            select s.login_id, s.ab_session_id, s.tzname,
+                   {} as started,
+                   {} as duration,
+                   s.id, l.login, l.fullname, s.router_epoch
+              from session s, login l
+             where l.id = s.login_id
+               and s.ab_session_id is not null{}
+          order by s.id{}""".format(
+                self.fmt_ts('s.created_timestamp'), self.age('s.created_timestamp'), cond, page), qa)
+
+    def session_add(self, qa):
+        return self._steps([
+            self.returning("""
+                insert into session ( login_id, ab_session_id, tzname, router_epoch )
+                values ( %(login_id)s, %(ab_session_id)s,
+                    ( select tzname from login where id = %(login_id)s ), %(router_epoch)s )""",
+                "id, login_id, ab_session_id, tzname", "session")
+            ], dict({ 'router_epoch': None }, **qa))
+
+    #
+    # session_add for a session that may be in the database already, a router
+    # running --direct records its own sessions.  nothing happens if
+    # ab_session_id is there.
+    #
+    def session_add_missing(self, qa):
+        return self.run("""
+            insert into session ( login_id, ab_session_id, tzname, router_epoch )
+            select l.id, %(ab_session_id)s, l.tzname, %(router_epoch)s
+              from login l
+             where l.id = %(login_id)s
+               and not exists ( select 1 from session where ab_session_id = %(ab_session_id)s )""",
+            dict({ 'router_epoch': None }, **qa))
+
+    def session_delete(self, qa):
+        return self._steps([
+            self.returning("""
+                update session set ab_session_id = null
+                 where ab_session_id = %(ab_session_id)s""",
+                "id, login_id", "session", "ab_session_id = %(ab_session_id)s", before=True)
+            ], qa)
+
+    #
+    # close the sessions the database has open but the router doesn't
+    # (orphans, their ab_session_ids), all of them in one transaction.  one
+    # statement, or in_limit orphans to a statement.  returns the count.
+    #
+    @inlineCallbacks
+    def session_orphans_close(self, orphans):
+        orphans = list(orphans)
+        if len(orphans) == 0:
+            defer.returnValue(0)
+        chunk = self.in_limit or len(orphans)
+        sl = []
+        qa = {}
+        for i in range(0, len(orphans), chunk):
+            k = 'o' + str(i // chunk)
+            qa[k] = self.in_arg(orphans[i:i+chunk])
+            sl.append("update session set ab_session_id = null where " + self.in_list('ab_session_id', k, 'bigint'))
+        yield self.run(sl, qa)
+        defer.returnValue(len(orphans))
+
+    #
+    # router instances, for several routers on one database.  each router
+    # (its id is SessionDb's epoch) beats every beat_interval seconds, one
+    # that has missed ROUTER_MISSED beats is gone.  times are seconds since
+    # the epoch, from the routers' clocks, now is the caller's.
+    #
+    def router_beat(self, qa):
+        return self.run([
+            "delete from router_instance where id = %(id)s",
+            """
+            insert into router_instance ( id, host, started, heartbeat, beat_interval )
+            values ( %(id)s, %(host)s, %(started)s, %(now)s, %(beat_interval)s )"""
+            ], qa)
+
+    def router_list(self, now):
+        return self.run("""
+            select id, host, started, heartbeat, beat_interval,
+                   case when {} then 1 else 0 end as alive
+              from router_instance
+          order by started""".format(_ROUTER_ALIVE), { 'now': now })
+
+    @inlineCallbacks
+    def router_live(self, now):
+        rv = yield self.run("select id from router_instance where " + _ROUTER_ALIVE, { 'now': now })
+        defer.returnValue([ r['id'] for r in rv ])
+
+    #
+    # close the sessions of every router that is gone (or of a router that
+    # never beat, no router_epoch or one not in router_instance) and forget
+    # the routers, in one transaction.  with no live router in
+    # router_instance there is nothing to tell the live sessions by, and
+    # none are closed.
+    #
+    def router_reap(self, now):
+        return self.run([
+            """
+            update session set ab_session_id = null
+             where ab_session_id is not null
+               and ( router_epoch is null
+                  or router_epoch not in ( select id from router_instance where {0} ) )
+               and exists ( select 1 from router_instance where {0} )""".format(_ROUTER_ALIVE),
+            "delete from router_instance where not ( {} )".format(_ROUTER_ALIVE)
+            ], { 'now': now })
+
+    def router_stop(self, id):
+        return self.run("delete from router_instance where id = %(id)s", { 'id': id })
+
+    #
+    # activity
+    #
+
+    #
+    # allowed activity, oldest first.  rollup reads the activity_rollup counts.
+    #  sessions -> only these ab_session_ids (the router's active sessions)
+    #  login    -> only this login
+    #  topic    -> only topics starting with this
+    #  types    -> only these types, default call, register, subscribe and publish
+    #  since, until -> only activity at or after since, and before until
+    #                  ('YYYY-MM-DD HH:MM:SS', utc).  for rollup, the last seen time.
+    #  after_id, limit -> a page, the limit rows with an id after after_id
+    #
+    def activity_list(self, rollup=False, sessions=None, login=None, topic=None, types=None,
+            since=None, until=None, after_id=None, limit=None, columnar=False, routers=None):
+        # nothing can match an empty list
+        for v in ( sessions, routers, types, ):
+            if v is not None and len(v) == 0:
+                return defer.succeed([])
+        a = 'ar' if rollup else 'a'
+        ts = a + '.last_seen' if rollup else a + '.modified_timestamp'
+        qa = { 'types': self.in_arg(types or ( 'call', 'register', 'subscribe', 'publish', )) }
+        where = [
+            "{}.session_id = s.id".format(a),
+            "{}.allow = {}".format(a, self.true()),
+            self.in_list(a + '.type_id', 'types', 'text'),
+            "s.login_id = l.id",
+            "s.ab_session_id is not null"
+        ]
+        if sessions is not None:
+            qa['sessions'] = self.in_arg(sessions)
+            where.append(self.in_list('s.ab_session_id', 'sessions', 'bigint'))
+        if routers is not None:
+            qa['routers'] = self.in_arg(routers)
+            where.append(self.in_list('s.router_epoch', 'routers', 'text'))
+        if login is not None:
+            qa['login'] = login
+            where.append("l.login = %(login)s")
+        if topic is not None:
+            qa['topic'] = topic
+            qa['topic_len'] = len(topic)
+            where.append("substr({}.topic_name, 1, %(topic_len)s) = %(topic)s".format(a))
+        if since is not None:
+            qa['since'] = since
+            where.append("{} >= %(since)s".format(ts))
+        if until is not None:
+            qa['until'] = until
+            where.append("{} < %(until)s".format(ts))
+        if after_id is not None:
+            qa['after_id'] = after_id
+            where.append("{}.id > %(after_id)s".format(a))
+        page = ''
+        if limit is not None:
+            qa['limit'] = limit
+            page = '\n         limit %(limit)s'
+
+        if rollup:
+            return self._runner(columnar)("""
+                select ar.id, ar.session_id, s.ab_session_id, ar.type_id, ar.topic_name, l.login, ar.count,
+                       {} as first_timestamp,
+                       {} as action_timestamp
+                  from activity_rollup ar, session s, login l
+                 where {}
+              order by ar.id{}""".format(self.fmt_ts('ar.first_seen'), self.fmt_ts('ar.last_seen'),
+                    '\n                   and '.join(where), page), qa)
+        return self._runner(columnar)("""
+            select a.id, a.session_id, s.ab_session_id, a.type_id, a.topic_name, l.login,
+                   {} as action_timestamp
+              from {} a, session s, login l
+             where {}
+          order by a.id{}""".format(self.fmt_ts('a.modified_timestamp'), self.activity_source(),
+                '\n               and '.join(where), page), qa)
+
+    #
+    # activity partitions, kept up by ActivityPruner.  days are YYYY-MM-DD,
+    # utc.  these are the hooks every engine has, here for an activity table
+    # that isn't partitioned: there are no partitions, and none are made.
+    # postgres has native partitions, sqlite and mysql rotate the table
+    # (RotatedActivity).
+    #
+
+    # where activity is read from, every partition
+    def activity_source(self):
+        return 'activity'
+
+    #
+    # the partitions that can be dropped, one dictionary each with name and
+    # upper, the first day it holds nothing from.
+    #
+    def activity_partitions(self):
+        return defer.succeed([])
+
+    #
+    # make sure today's activity goes to a partition of its own.  ahead is
+    # for engines that make partitions before they are needed.
+    #
+    def activity_partition_add(self, today, ahead=0):
+        log.msg("{}.activity_partition_add: activity isn't partitioned".format(self.name))
+        return defer.succeed(None)
+
+    def activity_partition_drop(self, name):
+        log.msg("{}.activity_partition_drop({})".format(self.name, name))
+        return self.run("drop table " + name, {})
+
+    def activity_add(self, qa):
+        return self._steps([
+            self.returning("""
+                insert into activity ( session_id, topic_name, type_id, allow )
+                values (
+                    ( select id from session where ab_session_id = %(ab_session_id)s ),
+                    %(topic_name)s, %(type_id)s, %(allow)s )""",
+                "id, session_id, topic_name, type_id, allow, %(ab_session_id)s as ab_session_id",
+                "activity")
+            ], qa)
+
+    # the batch as %(k_i)s arguments, one ( ... ) per record
+    def _values(self, batch, keys, fmt):
+        va = {}
+        vl = []
+        for i in range(len(batch)):
+            for k in keys:
+                va[k+'_'+str(i)] = batch[i].get(k, None)
+            vl.append(fmt.format(i))
+        return va, ',\n'.join(vl)
+
+    # a list of activity records in one insert, the count comes back
+    @inlineCallbacks
+    def activity_addbatch(self, batch):
+        if len(batch) == 0:
+            defer.returnValue([])
+        va, values = self._values(batch, ( 'ab_session_id', 'topic_name', 'type_id', 'allow', ),
+            """( ( select id from session where ab_session_id = %(ab_session_id_{0})s ),
+                %(topic_name_{0})s, %(type_id_{0})s, %(allow_{0})s )""")
+        yield self.run("""
+            insert into activity ( session_id, topic_name, type_id, allow )
+            values {}""".format(values), va)
+        defer.returnValue([ { 'activity': len(batch) } ])
+
+    # the rollup batch as values for an insert into activity_rollup
+    def _rollup_values(self, batch):
+        return self._values(batch,
+            ( 'ab_session_id', 'topic_name', 'type_id', 'allow', 'count', 'first_seen', 'last_seen', ),
+            "( ( select id from session where ab_session_id = %(ab_session_id_{0})s ), " +
+            "%(topic_name_{0})s, %(type_id_{0})s, %(allow_{0})s, %(count_{0})s, " +
+            self.from_epoch("%(first_seen_{0})s") + ", " + self.from_epoch("%(last_seen_{0})s") + " )")
+
+    #
+    # add counters to activity_rollup, in one transaction.  for each counter
+    # the row it has is updated, then inserted if there wasn't one.  the
+    # engines override this with their upsert.
+    #
+    @inlineCallbacks
+    def activity_rollup(self, batch):
+        if len(batch) == 0:
+            defer.returnValue([])
+        va = {}
+        sl = []
+        for i in range(len(batch)):
+            for k in ( 'ab_session_id', 'topic_name', 'type_id', 'allow', 'count', 'first_seen', 'last_seen', ):
+                va[k+'_'+str(i)] = batch[i].get(k, None)
+            match = """
+                   ( session_id = ( select id from session where ab_session_id = %(ab_session_id_{0})s )
+                     or ( session_id is null
+                          and not exists ( select 1 from session where ab_session_id = %(ab_session_id_{0})s ) ) )
+               and topic_name = %(topic_name_{0})s
+               and type_id = %(type_id_{0})s
+               and allow = %(allow_{0})s""".format(i)
+            last = self.from_epoch("%(last_seen_{})s".format(i))
+            sl.append("""
+            update activity_rollup
+               set count = count + %(count_{0})s,
+                   last_seen = case when last_seen < {1} then {1} else last_seen end
+             where {2}""".format(i, last, match))
+            sl.append("""
+            insert into activity_rollup
+                ( session_id, topic_name, type_id, allow, count, first_seen, last_seen )
+            select ( select id from session where ab_session_id = %(ab_session_id_{0})s ),
+                   %(topic_name_{0})s, %(type_id_{0})s, %(allow_{0})s, %(count_{0})s,
+                   {1}, {2}
+             where not exists ( select 1 from activity_rollup where {3} )""".format(i,
+                self.from_epoch("%(first_seen_{})s".format(i)), last, match))
+        yield self.run(sl, va)
+        defer.returnValue([ [ { 'upserted': len(batch) } ] ])
+
+class RotatedActivity(object):
+    """
+    activity partitions for the engines without native ones, by renaming
+    """
+
+    #
+    # activity is the live table, the one everything writes to.  once it
+    # holds rows from before today it is renamed (rotated) to
+    # activity_p<first day>_<tomorrow> (it has today's rows up to now too) and
+    # a new empty activity takes its place.  activity_all is a view over the
+    # live table and every rotated one.  the engine (sqlite, mysql) lists the
+    # rotated tables with activity_tables() and rotates with activity_rotate(name).
+    #
+
+    def activity_source(self):
+        return 'activity_all'
+
+    @inlineCallbacks
+    def activity_partitions(self):
+        rv = yield self.activity_tables()
+        pl = []
+        for r in rv:
+            m = _ROTATED.match(r['name'])
+            if m is None:
+                continue
+            u = m.group(2)
+            pl.append({ 'name': r['name'], 'upper': u[0:4] + '-' + u[4:6] + '-' + u[6:8] })
+        defer.returnValue(sorted(pl, key=lambda p: p['upper']))
+
+    @inlineCallbacks
+    def activity_view(self):
+        pl = yield self.activity_partitions()
+        sel = [ "select {} from {}".format(ACTIVITY_COLUMNS, p['name']) for p in pl ]
+        sel.append("select {} from activity".format(ACTIVITY_COLUMNS))
+        yield self.run([ "drop view if exists activity_all",
+            "create view activity_all as " + "\n union all ".join(sel) ], {})
+
+    @inlineCallbacks
+    def activity_partition_add(self, today, ahead=0):
+        rv = yield self.run("""
+            select min(modified_timestamp) as first
+              from activity
+             where modified_timestamp < %(today)s""", { 'today': today })
+        if len(rv) == 0 or rv[0]['first'] is None:
+            defer.returnValue(None)
+        upper = datetime.datetime.strptime(today, '%Y-%m-%d').date() + datetime.timedelta(days=1)
+        name = "activity_p{}_{}".format(rv[0]['first'][0:10].replace('-', ''), upper.strftime('%Y%m%d'))
+        log.msg("{}.activity_partition_add: activity becomes {}".format(self.name, name))
+        # the view is dropped first, some engines won't rename a table a view uses
+        yield self.run("drop view if exists activity_all", {})
+        yield self.activity_rotate(name)
+        yield self.activity_view()
+        defer.returnValue(name)
+
+    @inlineCallbacks
+    def activity_partition_drop(self, name):
+        log.msg("{}.activity_partition_drop({})".format(self.name, name))
+        yield self.run("drop view if exists activity_all", {})
+        yield self.run("drop table " + name, {})
+        yield self.activity_view()
@@ -0,0 +1,86 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## columnar.py - query results as [ headers, row, row ... ]
+##
+## the admin calls (sqlauthrpc) answer with a list whose first element is
+## the column names, followed by one row per result, values in header order.
+## sqlbridge (and so Backend.run) gives a list of dictionaries, encode() turns
+## that into the columnar shape with one itemgetter for the whole result.
+## DirectDb builds it straight from the cursor (query_columns), no
+## dictionaries at all, and encode() passes that through as it is.
+##
+## rows are tuples.  json writes them as arrays, so on the wire it is the same
+## [[headers],[row]...] the admin calls have always returned.  columns()
+## turns it sideways, one array per column, for callers that ask for it.
+###############################################################################
+
+from operator import itemgetter
+
+class Columns(list):
+    """
+    [ headers, row, row ... ], one encoded result
+    """
+    pass
+
+#
+# qv is a list of dictionaries (or Columns, which is returned as is).  the
+# headers come from the first row, or with fullscan=True from every row, for
+# results whose rows don't all have the same keys.  the result is Columns,
+# or [] when there are no rows.
+#
+def encode(qv, fullscan=False):
+    if isinstance(qv, Columns):
+        if len(qv) < 2:
+            return []
+        return qv
+    if len(qv) == 0:
+        return []
+
+    if fullscan:
+        kv = {}
+        ra = []
+        for r in qv:
+            for k in r.keys():
+                if not k in kv:
+                    kv[k] = True
+                    ra.append(k)
+        return Columns([ ra ] + [ tuple([ r.get(c, None) for c in ra ]) for r in qv ])
+
+    ra = list(qv[0].keys())
+    if len(ra) == 1:
+        c = ra[0]
+        return Columns([ ra ] + [ ( r.get(c, None), ) for r in qv ])
+    try:
+        return Columns([ ra ] + map(itemgetter(*ra), qv))
+    except KeyError:
+        # a row without one of the first row's columns
+        return encode(qv, fullscan=True)
+
+#
+# an encoded result, one array per column
+#
+def columns(rv):
+    if len(rv) == 0:
+        return { 'headers': [], 'columns': [] }
+    return { 'headers': rv[0], 'columns': [ list(c) for c in zip(*rv[1:]) ] }
+
+# is qv one result (as opposed to a list of them, one per statement)?
+def is_result(qv):
+    return isinstance(qv, Columns) or len(qv) == 0 or isinstance(qv[0], dict)
@@ -0,0 +1,449 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## migrate.py - numbered schema changes, applied once
+##
+## the schema version is kept in the sqlauth table, component 'schema'.
+## each migration is a list of steps, applied in order, after which its
+## number is written as the version.  an index step looks for the index
+## before it creates it, so a database that already has it (a fresh install
+## from config/*.sql, or a migration that died half way) is fine.
+## a migration with an option (the postgres activity partitioning, which
+## rewrites the table) is only applied when the option is asked for.
+##
+## check() runs EXPLAIN on the hot path queries and reports any of the
+## tables each should reach through an index that it reads start to finish.
+###############################################################################
+
+from twisted.python import log
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks
+
+from sqlauth.twisted import statements
+
+SCHEMA_COMPONENT = 'schema'
+
+class Index(object):
+    """
+    create index name on table ( columns ), unless it is there
+    """
+
+    def __init__(self, name, table, columns):
+        self.name = name
+        self.table = table
+        self.columns = columns
+
+        return
+
+    def __str__(self):
+        return "index {} on {} ( {} )".format(self.name, self.table, ', '.join(self.columns))
+
+    @inlineCallbacks
+    def apply(self, backend):
+        rv = yield backend.index_exists(self.name)
+        if len(rv) > 0:
+            log.msg("Index.apply: {} is already there".format(self.name))
+            defer.returnValue(False)
+        yield backend.run(backend.create_index(self.name, self.table, self.columns), {})
+        defer.returnValue(True)
+
+class Column(object):
+    """
+    alter table table add column name type, unless it is there
+    """
+
+    def __init__(self, table, name, type):
+        self.table = table
+        self.name = name
+        self.type = type
+
+        return
+
+    def __str__(self):
+        return "column {} {} on {}".format(self.name, self.type, self.table)
+
+    @inlineCallbacks
+    def apply(self, backend):
+        rv = yield backend.column_exists(self.table, self.name)
+        if len(rv) > 0:
+            log.msg("Column.apply: {}.{} is already there".format(self.table, self.name))
+            defer.returnValue(False)
+        yield backend.run("alter table {} add column {} {}".format(self.table, self.name, self.type), {})
+        defer.returnValue(True)
+
+class Sql(object):
+    """
+    plain statements, by backend name.  '*' is for any backend.
+    """
+
+    def __init__(self, description, **sql):
+        self.description = description
+        self.sql = sql
+
+        return
+
+    def __str__(self):
+        return self.description
+
+    @inlineCallbacks
+    def apply(self, backend):
+        s = self.sql.get(backend.name, self.sql.get('*', None))
+        if s is None:
+            log.msg("Sql.apply: nothing to do on {} for {}".format(backend.name, self.description))
+            defer.returnValue(False)
+        yield backend.run(s, {})
+        defer.returnValue(True)
+
+class ActivityView(object):
+    """
+    the activity_all view, on the engines that rotate activity
+    """
+
+    def __str__(self):
+        return "activity_all view"
+
+    @inlineCallbacks
+    def apply(self, backend):
+        if not hasattr(backend, 'activity_view'):
+            log.msg("ActivityView.apply: nothing to do on {}".format(backend.name))
+            defer.returnValue(False)
+        # over whatever has been rotated already
+        yield backend.activity_view()
+        defer.returnValue(True)
+
+class Partition(object):
+    """
+    postgres native partitioning of activity, once, on postgres 13 or later
+    """
+
+    def __init__(self, description, sql):
+        self.description = description
+        self.sql = sql
+
+        return
+
+    def __str__(self):
+        return self.description + " (postgres 13 or later)"
+
+    @inlineCallbacks
+    def apply(self, backend):
+        if backend.name != 'postgres':
+            log.msg("Partition.apply: nothing to do on {}".format(backend.name))
+            defer.returnValue(False)
+        rv = yield backend.run("select current_setting('server_version_num')::integer as version", {})
+        if int(rv[0]['version']) < 130000:
+            raise Exception("{} needs postgres 13 or later, this is {}".format(self.description, rv[0]['version']))
+        rv = yield backend.run("select relkind from pg_class where oid = 'activity'::regclass", {})
+        if rv[0]['relkind'] == 'p':
+            log.msg("Partition.apply: activity is already partitioned")
+            defer.returnValue(False)
+        # one transaction, the rename, the copy and the drop all happen or none do
+        yield backend.run(self.sql, {})
+        defer.returnValue(True)
+
+class Migration(object):
+    """
+    one numbered schema change
+    """
+
+    # option -> only applied when the Migrator is given this option
+    def __init__(self, version, description, steps, option=None):
+        self.version = version
+        self.description = description
+        self.steps = steps
+        self.option = option
+
+        return
+
+    def __str__(self):
+        if self.option is not None:
+            return "{} {} (--{})".format(self.version, self.description, self.option)
+        return "{} {}".format(self.version, self.description)
+
+#
+# in order.  the ones anyone can apply come first, one with an option goes
+# after them, pending() stops at it unless the option is given.  every step
+# can be applied again, so a database migrated under earlier numbering
+# comes to no harm.  text columns indexed on mysql carry a prefix length.
+#
+MIGRATIONS = [
+    Migration(1, "indexes for the permission check, activity and role delete", [
+        # loginrole ( login_id ) is the front of loginrole_login_id_role_id
+        Index('loginrole_role_id', 'loginrole', [ 'role_id' ]),
+        Index('topicrole_role_id_type_id', 'topicrole', [ 'role_id', 'type_id(50)' ]),
+        Index('activity_session_id', 'activity', [ 'session_id' ]),
+        Index('activity_type_id_allow', 'activity', [ 'type_id(50)', 'allow' ]),
+    ]),
+    # sqlite and mysql read activity through activity_all, see RotatedActivity
+    Migration(2, "activity_all view", [
+        ActivityView(),
+    ]),
+    # which run of the router opened a session, see SessionDb.recover
+    Migration(3, "router epoch on session", [
+        Column('session', 'router_epoch', 'text'),
+    ]),
+    # several routers on one database, see RouterInstance
+    Migration(4, "router instances", [
+        Sql("router_instance table", **{ '*': """
+            create table if not exists router_instance (
+                id varchar(32) not null primary key,
+                host text,
+                started bigint,
+                heartbeat bigint,
+                beat_interval integer
+            )""" }),
+        Index('session_router_epoch', 'session', [ 'router_epoch(32)' ]),
+    ]),
+    #
+    # postgres NOTIFYs sqlauth_invalidate with a change notice for every row
+    # changed in the tables behind a decision, see NotifyListener.  the
+    # others have no LISTEN, their routers only get sqlauthrpc's notices.
+    #
+    Migration(5, "change notices", [
+        Sql("sqlauth_notify trigger",
+            postgres=[
+                """
+                create or replace function sqlauth_notify() returns trigger as $$
+                declare
+                    r record;
+                    p json;
+                begin
+                    for i in 1..2 loop
+                        if i = 1 then
+                            if TG_OP = 'INSERT' then
+                                continue;
+                            end if;
+                            r := OLD;
+                        else
+                            if TG_OP = 'DELETE' then
+                                continue;
+                            end if;
+                            r := NEW;
+                        end if;
+                        if TG_TABLE_NAME = 'loginrole' then
+                            p := json_build_object('table', TG_TABLE_NAME, 'login_id', r.login_id);
+                        elsif TG_TABLE_NAME = 'topicrole' then
+                            p := json_build_object('table', TG_TABLE_NAME,
+                                'topic', (select t.name from topic t where t.id = r.topic_id), 'role_id', r.role_id);
+                        elsif TG_TABLE_NAME = 'topic' then
+                            p := json_build_object('table', TG_TABLE_NAME, 'topic', r.name);
+                        elsif TG_TABLE_NAME = 'login' then
+                            p := json_build_object('table', TG_TABLE_NAME, 'login', r.login, 'login_id', r.id);
+                        else
+                            p := json_build_object('table', TG_TABLE_NAME, 'role_id', r.id);
+                        end if;
+                        perform pg_notify('sqlauth_invalidate', p::text);
+                    end loop;
+                    return null;
+                end;
+                $$ language plpgsql""",
+            ] + [ s for t in ( 'login', 'role', 'topic', 'loginrole', 'topicrole', ) for s in (
+                "drop trigger if exists sqlauth_notify on {}".format(t),
+                """
+                create trigger sqlauth_notify
+                    after insert or update or delete on {}
+                    for each row execute procedure sqlauth_notify()""".format(t),
+            ) ]),
+    ]),
+    #
+    # postgres partitions activity by day, what is there now goes to
+    # activity_history.  it rewrites activity, so it is only applied when
+    # asked for (sqlmigrate --apply --partition), and it needs postgres 13.
+    # the others rotate activity (Backend.activity_partition_add) without it.
+    #
+    Migration(6, "time partitioned activity", [
+        Partition("partition activity by day", [
+                "alter table activity rename to activity_unpartitioned",
+                "alter index activity_pkey rename to activity_unpartitioned_pkey",
+                "drop index if exists activity_session_id",
+                "drop index if exists activity_type_id_allow",
+                "alter sequence activity_id_seq owned by none",
+                """
+                create table activity (
+                    id integer not null default nextval('activity_id_seq'::regclass),
+                    session_id integer references session (id),
+                    topic_name text,
+                    type_id text references activity_type (id),
+                    allow boolean,
+                    modified_by_user integer not null default 0,
+                    modified_timestamp timestamp with time zone not null default current_timestamp,
+                    primary key ( id, modified_timestamp )
+                ) partition by range ( modified_timestamp )""",
+                """
+                create table activity_history partition of activity
+                   for values from ( minvalue ) to ( date_trunc('day', now() at time zone 'UTC') at time zone 'UTC' + interval '1 day' )""",
+                "create table activity_default partition of activity default",
+                """
+                insert into activity ( id, session_id, topic_name, type_id, allow, modified_by_user, modified_timestamp )
+                select id, session_id, topic_name, type_id, allow, modified_by_user, modified_timestamp
+                  from activity_unpartitioned""",
+                "drop table activity_unpartitioned",
+                "alter sequence activity_id_seq owned by activity.id",
+                "create index activity_session_id on activity ( session_id )",
+                "create index activity_type_id_allow on activity ( type_id, allow )",
+                """
+                create trigger activity_20_audit_fullmodified
+                    before insert or update or delete on activity
+                    for each row execute procedure audit_fullmodified()"""
+            ]),
+    ], option='partition'),
+]
+
+#
+# ( name, sql, args, the tables or aliases that must be reached by index )
+#
+HOT_QUERIES = [
+    ( 'login', statements.LOGIN_QUERY, { 'login': 'seed_1' }, [ 'login' ] ),
+    ( 'permission', statements.PERMISSION_QUERY,
+        { 'topiclist': ( 'seed', 'seed.1', 'seed.1.call', ), 'action': 'call', 'authid': 1 }, [ 'tr', 'lr' ] ),
+    ( 'role logins', "select lr.id from loginrole lr where lr.role_id = %(role_id)s",
+        { 'role_id': 1 }, [ 'lr' ] ),
+    ( 'role topics', "select tr.id from topicrole tr where tr.role_id = %(role_id)s and tr.type_id = %(type_id)s",
+        { 'role_id': 1, 'type_id': 'call' }, [ 'tr' ] ),
+    ( 'session activity', "select a.id from activity a where a.session_id = %(session_id)s",
+        { 'session_id': 1 }, [ 'a' ] ),
+    ( 'activity by type', "select a.id from activity a where a.type_id = %(type_id)s and a.allow = %(allow)s",
+        { 'type_id': 'call', 'allow': True }, [ 'a' ] ),
+]
+
+class Migrator(object):
+    """
+    brings a database up to the latest migration
+    """
+
+    # options -> the migration options asked for, like 'partition'
+    def __init__(self, backend, migrations=MIGRATIONS, options=()):
+        self.backend = backend
+        self.migrations = migrations
+        self.options = options
+
+        return
+
+    @inlineCallbacks
+    def current(self):
+        rv = yield self.backend.run("select version from sqlauth where component = %(component)s",
+            { 'component': SCHEMA_COMPONENT })
+        if len(rv) == 0 or rv[0]['version'] is None:
+            defer.returnValue(0)
+        defer.returnValue(int(rv[0]['version']))
+
+    #
+    # the migrations after the current version, up to the first one with an
+    # option that wasn't asked for.  the version only ever goes up by one.
+    #
+    @inlineCallbacks
+    def pending(self):
+        cv = yield self.current()
+        ml = []
+        for m in self.migrations:
+            if m.version <= cv:
+                continue
+            if m.option is not None and m.option not in self.options:
+                break
+            ml.append(m)
+        defer.returnValue(ml)
+
+    # the migrations that wait for an option
+    @inlineCallbacks
+    def waiting(self):
+        cv = yield self.current()
+        defer.returnValue([ m for m in self.migrations
+            if m.version > cv and m.option is not None and m.option not in self.options ])
+
+    def set_version(self, version):
+        return self.backend.run([
+            "delete from sqlauth where component = %(component)s",
+            "insert into sqlauth ( component, version ) values ( %(component)s, %(version)s )"
+            ], { 'component': SCHEMA_COMPONENT, 'version': str(version) })
+
+    #
+    # apply everything pending, returns the migrations applied.  a failing
+    # step stops it there, the version stays at the last one that finished.
+    #
+    @inlineCallbacks
+    def apply(self):
+        ml = yield self.pending()
+        for m in ml:
+            log.msg("Migrator.apply: {}".format(m))
+            for st in m.steps:
+                yield st.apply(self.backend)
+            yield self.set_version(m.version)
+        defer.returnValue(ml)
+
+    #
+    # explain each of the hot queries, one dictionary each with the query's
+    # name, ok, and the tables it scans that it shouldn't.
+    #
+    @inlineCallbacks
+    def check(self, queries=HOT_QUERIES):
+        rv = []
+        for name, sql, args, indexed in queries:
+            plan = yield self.backend.explain(sql, args)
+            scans = self.backend.plan_scans(plan)
+            bad = [ t for t in indexed if t in scans ]
+            rv.append({ 'query': name, 'ok': len(bad) == 0, 'scans': bad })
+        defer.returnValue(rv)
+
+#
+# fill a scratch database with logins, roles, topics, sessions and activity
+# for check().  everything is named seed_ or seed., login seed_i is in role
+# seed_(i % roles), which can call and publish on topic seed.(i % roles).
+#
+@inlineCallbacks
+def seed(backend, logins=1000, roles=50, activity=20):
+    b = backend
+
+    @inlineCallbacks
+    def insert(table, cols, rows):
+        for i in range(0, len(rows), 100):
+            chunk = [ dict(zip(cols, r)) for r in rows[i:i+100] ]
+            va, values = b._values(chunk, cols,
+                '(' + ', '.join([ '%(' + c + '_{0})s' for c in cols ]) + ')')
+            yield b.run("insert into {} ( {} ) values {}".format(table, ', '.join(cols), values), va)
+
+    @inlineCallbacks
+    def ids(sql):
+        rv = yield b.run(sql, {})
+        defer.returnValue(dict([ (r['name'], int(r['id'])) for r in rv ]))
+
+    yield insert('topic', ( 'name', 'description', ),
+        [ ( 'seed.' + str(i), 'seeded' ) for i in range(roles) ])
+    tid = yield ids("select name, id from topic where name like 'seed.%%'")
+    yield insert('role', ( 'name', 'description', ),
+        [ ( 'seed_' + str(i), 'seeded' ) for i in range(roles) ])
+    rid = yield ids("select name, id from role where name like 'seed_%%'")
+    yield insert('login', ( 'login', 'fullname', 'password', 'salt', 'tzname', ),
+        [ ( 'seed_' + str(i), 'seeded', 'x', 'x', 'UTC' ) for i in range(logins) ])
+    lid = yield ids("select login as name, id from login where login like 'seed_%%'")
+
+    yield insert('loginrole', ( 'login_id', 'role_id', ),
+        [ ( lid['seed_' + str(i)], rid['seed_' + str(i % roles)] ) for i in range(logins) ])
+    yield insert('topicrole', ( 'topic_id', 'role_id', 'type_id', 'allow', ),
+        [ ( tid['seed.' + str(i)], rid['seed_' + str(i)], t, True )
+            for i in range(roles) for t in ( 'call', 'publish', ) ])
+    yield insert('session', ( 'login_id', 'ab_session_id', 'tzname', ),
+        [ ( lid['seed_' + str(i)], 9000000000 + i, 'UTC' ) for i in range(logins) ])
+    rv = yield b.run("select id from session where ab_session_id >= 9000000000", {})
+    sid = [ int(r['id']) for r in rv ]
+    yield insert('activity', ( 'session_id', 'topic_name', 'type_id', 'allow', ),
+        [ ( sid[i % len(sid)], 'seed.' + str(i % roles), ( 'call', 'publish', )[i % 2], True )
+            for i in range(logins * activity) ])
+
+    log.msg("seed: {} logins, {} roles, {} activity".format(logins, roles, logins * activity))
+    defer.returnValue(None)
@@ -0,0 +1,121 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## mysql.py - the mysql backend
+##
+## mysql has no returning, results are read back with a select in the same
+## transaction.  the rollup is an insert ... on duplicate key update.
+###############################################################################
+
+from twisted.python import log
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks
+from twisted.enterprise import adbapi
+
+from sqlauth.backend.base import Backend, RotatedActivity
+
+class MysqlBackend(RotatedActivity, Backend):
+    """
+    mysql 5.6 and later
+    """
+
+    name = 'mysql'
+    paramstyle = 'pyformat'
+    has_returning = False
+    can_prepare = False
+
+    # dsn is like sqlbridge's, db=autobahn host=localhost user=autouser passwd=x
+    def connect(self, dsn, min_conn=2, max_conn=5, openfun=None):
+        log.msg("MysqlBackend.connect({})".format(dsn))
+        md = dict(s.split('=') for s in dsn.split())
+        return adbapi.ConnectionPool('MySQLdb', cp_min=min_conn, cp_max=max_conn,
+            cp_reconnect=True, cp_openfun=openfun, **md)
+
+    def fmt_ts(self, expr):
+        return "date_format({}, '%%Y-%%m-%%d %%H:%%i:%%s')".format(expr)
+
+    def age(self, expr):
+        return "timediff(now(), {})".format(expr)
+
+    def from_epoch(self, expr):
+        return "from_unixtime({})".format(expr)
+
+    def last_id(self):
+        return "last_insert_id()"
+
+    def index_column(self, col):
+        return col
+
+    def index_exists(self, name):
+        return self.run("""
+            select index_name
+              from information_schema.statistics
+             where table_schema = database()
+               and index_name = %(name)s""", { 'name': name })
+
+    def column_exists(self, table, name):
+        return self.run("""
+            select column_name
+              from information_schema.columns
+             where table_schema = database()
+               and table_name = %(table)s
+               and column_name = %(name)s""", { 'table': table, 'name': name })
+
+    def activity_tables(self):
+        return self.run("""
+            select table_name as name
+              from information_schema.tables
+             where table_schema = database()
+               and table_name like 'activity_p%%'""", {})
+
+    #
+    # the new table carries on with the old ids, its auto_increment is set
+    # before the rename so there is no moment when activity starts at 1
+    # again.  one connection for the @next variable, the rename is atomic.
+    #
+    def activity_rotate(self, name):
+        return self.run([
+            "create table activity_next like activity",
+            "set @next = ( select coalesce(max(id), 0) + 1 from activity )",
+            "set @alter = concat('alter table activity_next auto_increment = ', @next)",
+            "prepare activity_next_ai from @alter",
+            "execute activity_next_ai",
+            "deallocate prepare activity_next_ai",
+            "rename table activity to {}, activity_next to activity".format(name)
+            ], {})
+
+    # type ALL is a full table scan
+    def plan_scans(self, plan):
+        return set([ r['table'] for r in plan if r.get('type') == 'ALL' ])
+
+    # one upsert.  counters for unknown sessions (a null session_id) can't
+    # conflict, they get a row per flush.
+    @inlineCallbacks
+    def activity_rollup(self, batch):
+        if len(batch) == 0:
+            defer.returnValue([])
+        va, values = self._rollup_values(batch)
+        yield self.run("""
+            insert into activity_rollup
+                ( session_id, topic_name, type_id, allow, count, first_seen, last_seen )
+            values {}
+            on duplicate key update
+                count = count + values(count),
+                last_seen = greatest(last_seen, values(last_seen))""".format(values), va)
+        defer.returnValue([ [ { 'upserted': len(batch) } ] ])
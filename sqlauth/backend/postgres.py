@@ -0,0 +1,237 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## postgres.py - the postgres backend
+##
+## postgres has returning, so every operation is one round trip, and the
+## batch inserts and rollup use the set based statements sqlauthrpc started
+## with.  names are aggregated with private.array_accum (PGfunc.sql).
+###############################################################################
+
+import re
+import six
+import datetime
+
+from twisted.python import log
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks
+from twisted.enterprise import adbapi
+
+from sqlauth.backend.base import Backend
+
+# Seq Scan on topicrole tr
+_SEQ_SCAN = re.compile(r'Seq Scan on (\w+)(?: (\w+))?')
+
+#
+# values as an array literal, '{"a","b"}'.  a python list would do where
+# psycopg2 adapts lists to arrays, but sqlbridge registers SQL_IN for lists
+# (in ( a, b )) for the whole process, the router's DirectDb included.  the
+# literal is a string, it is the same over wamp and on any connection.
+#
+def array_literal(values):
+    return u'{' + u','.join([ u'"' + six.text_type(v).replace(u'\\', u'\\\\').replace(u'"', u'\\"') + u'"'
+        for v in values ]) + u'}'
+
+# FOR VALUES FROM ('2026-10-17 00:00:00+00') TO ('2026-10-18 00:00:00+00')
+_UPPER = re.compile(r"TO \('(\d{4}-\d{2}-\d{2})")
+
+class PostgresBackend(Backend):
+    """
+    postgres 9.4
+    """
+
+    name = 'postgres'
+    paramstyle = 'pyformat'
+    has_returning = True
+    in_limit = None
+    can_prepare = True
+    bridge = True
+    rollup_titles = [ 'Updated', 'Inserted' ]
+
+    def connect(self, dsn, min_conn=2, max_conn=5, openfun=None):
+        log.msg("PostgresBackend.connect({})".format(dsn))
+        return adbapi.ConnectionPool('psycopg2', dsn,
+            cp_min=min_conn, cp_max=max_conn, cp_reconnect=True, cp_openfun=openfun)
+
+    def agg(self, expr):
+        return "private.array_accum({})".format(expr)
+
+    # an array, one statement text whatever the length, and empty is fine
+    def in_list(self, expr, key, cast):
+        return "{} = any(%({})s::{}[])".format(expr, key, cast)
+
+    def in_arg(self, values):
+        return array_literal(values)
+
+    def fmt_ts(self, expr):
+        return "to_char({},'YYYY-MM-DD HH24:MI:SS')".format(expr)
+
+    def age(self, expr):
+        return "to_char(now() - {}, 'HH24:MI:SS')".format(expr)
+
+    def from_epoch(self, expr):
+        return "to_timestamp({})".format(expr)
+
+    def last_id(self):
+        return "lastval()"
+
+    def index_exists(self, name):
+        return self.run("select indexname from pg_indexes where indexname = %(name)s", { 'name': name })
+
+    def column_exists(self, table, name):
+        return self.run("""
+            select column_name
+              from information_schema.columns
+             where table_schema = current_schema()
+               and table_name = %(table)s
+               and column_name = %(name)s""", { 'table': table, 'name': name })
+
+    #
+    # on a small table a seq scan is the right choice, so the planner is told
+    # not to use one.  if it still does there is no index it can use.
+    #
+    def explain(self, sql, args):
+        d = self.run([ "set local enable_seqscan = off", "explain " + sql ], args)
+        d.addCallback(lambda rv: rv[1])
+        return d
+
+    def plan_scans(self, plan):
+        scans = set()
+        for r in plan:
+            for m in _SEQ_SCAN.finditer(r.values()[0]):
+                scans.update([ g for g in m.groups() if g is not None ])
+        return scans
+
+    #
+    # activity is natively partitioned by day on modified_timestamp (see
+    # migration 6), postgres 13 or later.  activity_history holds what was
+    # there before, activity_default anything no day partition was made for.
+    # it is read straight from activity (Backend.activity_source), and old
+    # partitions are dropped as tables (Backend.activity_partition_drop).
+    #
+    @inlineCallbacks
+    def activity_partitions(self):
+        # bounds are written in the session's time zone
+        rv = yield self.run([ "set local timezone = 'UTC'",
+            """
+            select c.relname as name, pg_get_expr(c.relpartbound, c.oid) as bound
+              from pg_inherits i, pg_class c
+             where i.inhrelid = c.oid
+               and i.inhparent = 'activity'::regclass""" ], {})
+        pl = []
+        for r in rv[1]:
+            m = _UPPER.search(r['bound'] or '')
+            if m is None:
+                continue
+            pl.append({ 'name': r['name'], 'upper': m.group(1) })
+        defer.returnValue(sorted(pl, key=lambda p: p['upper']))
+
+    #
+    # a partition for today and each of the ahead days after it that isn't
+    # covered yet.  partitions only ever go forward, a day before the last
+    # upper bound is already covered.
+    #
+    @inlineCallbacks
+    def activity_partition_add(self, today, ahead=0):
+        rv = yield self.run("select relkind from pg_class where oid = 'activity'::regclass", {})
+        if rv[0]['relkind'] != 'p':
+            log.msg("PostgresBackend.activity_partition_add: activity isn't partitioned, run sqlmigrate --apply --partition")
+            defer.returnValue(None)
+        pl = yield self.activity_partitions()
+        covered = max([ p['upper'] for p in pl ] or [ '' ])
+        day = datetime.datetime.strptime(today, '%Y-%m-%d').date()
+        for i in range(ahead + 1):
+            d = day + datetime.timedelta(days=i)
+            if d.isoformat() < covered:
+                continue
+            name = 'activity_p' + d.strftime('%Y%m%d')
+            log.msg("PostgresBackend.activity_partition_add: {}".format(name))
+            yield self.run("""
+                create table if not exists {} partition of activity
+                   for values from ( '{} 00:00:00+00' ) to ( '{} 00:00:00+00' )""".format(name,
+                    d.isoformat(), (d + datetime.timedelta(days=1)).isoformat()), {})
+        defer.returnValue(None)
+
+    @inlineCallbacks
+    def activity_addbatch(self, batch):
+        if len(batch) == 0:
+            defer.returnValue([])
+        va, values = self._values(batch, ( 'ab_session_id', 'topic_name', 'type_id', 'allow', ),
+            "(%(ab_session_id_{0})s::bigint, %(topic_name_{0})s::text, %(type_id_{0})s::text, %(allow_{0})s::boolean)")
+        rv = yield self.run("""
+            with ins as (
+                insert into activity ( session_id, topic_name, type_id, allow )
+                select s.id, v.topic_name, v.type_id, v.allow
+                  from ( values {} ) as v (ab_session_id, topic_name, type_id, allow)
+             left join session s on s.ab_session_id = v.ab_session_id
+             returning id
+            )
+            select count(*) as activity from ins""".format(values), va)
+        defer.returnValue(rv)
+
+    #
+    # counters that already have a row are added to it, the rest are
+    # inserted.  both statements run in the same transaction.  sessions
+    # that aren't known (null session_id) are matched too.
+    #
+    @inlineCallbacks
+    def activity_rollup(self, batch):
+        if len(batch) == 0:
+            defer.returnValue([])
+        va, values = self._values(batch,
+            ( 'ab_session_id', 'topic_name', 'type_id', 'allow', 'count', 'first_seen', 'last_seen', ),
+            """(%(ab_session_id_{0})s::bigint, %(topic_name_{0})s::text, %(type_id_{0})s::text,
+                %(allow_{0})s::boolean, %(count_{0})s::bigint,
+                to_timestamp(%(first_seen_{0})s), to_timestamp(%(last_seen_{0})s))""")
+        rollup = """
+            select s.id as session_id, v.topic_name, v.type_id, v.allow, v.count, v.first_seen, v.last_seen
+              from ( values {} ) as v (ab_session_id, topic_name, type_id, allow, count, first_seen, last_seen)
+         left join session s on s.ab_session_id = v.ab_session_id""".format(values)
+        rv = yield self.run([
+            """
+            with upd as (
+                update activity_rollup ar
+                   set count = ar.count + v.count,
+                       last_seen = greatest(ar.last_seen, v.last_seen)
+                  from ( {} ) as v
+                 where ar.session_id is not distinct from v.session_id
+                   and ar.topic_name = v.topic_name
+                   and ar.type_id = v.type_id
+                   and ar.allow = v.allow
+             returning ar.id
+            )
+            select count(*) as updated from upd""".format(rollup),
+            """
+            with ins as (
+                insert into activity_rollup
+                    ( session_id, topic_name, type_id, allow, count, first_seen, last_seen )
+                select v.session_id, v.topic_name, v.type_id, v.allow, v.count, v.first_seen, v.last_seen
+                  from ( {} ) as v
+                 where not exists (
+                        select 1
+                          from activity_rollup ar
+                         where ar.session_id is not distinct from v.session_id
+                           and ar.topic_name = v.topic_name
+                           and ar.type_id = v.type_id
+                           and ar.allow = v.allow )
+             returning id
+            )
+            select count(*) as inserted from ins""".format(rollup)
+            ], va)
+        defer.returnValue(rv)
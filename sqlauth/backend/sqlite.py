@@ -0,0 +1,165 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## sqlite.py - the embedded sqlite backend
+##
+## for a single node, the router and sqlauthrpc (both with a dsn like
+## database=/var/lib/sqlauth/auth.db) share one file.  connections are put
+## in WAL mode so readers don't wait on the activity writer.  sqlite has no
+## returning (before 3.35), so results are read back with a select in the
+## same transaction.  booleans are stored as 1 and 0.
+##
+## sqlite allows only so many bound parameters in a statement (999 before
+## 3.32, SQLITE_MAX_VARIABLE_NUMBER).  an in ( ... ) list of every session a
+## router has open would be one each, so lists are passed as a single json
+## array and read back with json_each.  that needs the json1 functions, built
+## in since 3.38 and compiled into most packaged sqlite before that.
+###############################################################################
+
+import json
+
+from twisted.python import log
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks
+from twisted.enterprise import adbapi
+
+from sqlauth.backend.base import Backend, RotatedActivity
+
+class SqliteBackend(RotatedActivity, Backend):
+    """
+    sqlite 3.8 and later
+    """
+
+    name = 'sqlite'
+    paramstyle = 'named'
+    has_returning = False
+    in_limit = None
+    can_prepare = False
+
+    def connect(self, dsn, min_conn=1, max_conn=1, openfun=None):
+        log.msg("SqliteBackend.connect({})".format(dsn))
+        def opened(conn):
+            conn.execute("pragma journal_mode = wal")
+            conn.execute("pragma synchronous = normal")
+            conn.execute("pragma foreign_keys = on")
+            if openfun is not None:
+                openfun(conn)
+            return
+        md = dict(s.split('=') for s in dsn.split())
+        md['check_same_thread'] = False
+        # one writer at a time is all sqlite can do anyway.  the sqlite3 module
+        # keeps its own cache of compiled statements per connection.
+        return adbapi.ConnectionPool('sqlite3', cp_min=1, cp_max=1, cp_openfun=opened, **md)
+
+    # one json array parameter, whatever the length, see above
+    def in_list(self, expr, key, cast):
+        return "{} in ( select value from json_each(%({})s) )".format(expr, key)
+
+    def in_arg(self, values):
+        return json.dumps(list(values))
+
+    def fmt_ts(self, expr):
+        return "strftime('%%Y-%%m-%%d %%H:%%M:%%S', {})".format(expr)
+
+    def age(self, expr):
+        return "time(strftime('%%s','now') - strftime('%%s', {}), 'unixepoch')".format(expr)
+
+    def from_epoch(self, expr):
+        return "datetime({}, 'unixepoch')".format(expr)
+
+    def last_id(self):
+        return "last_insert_rowid()"
+
+    def true(self):
+        return '1'
+
+    def index_exists(self, name):
+        return self.run("select name from sqlite_master where type = 'index' and name = %(name)s",
+            { 'name': name })
+
+    def column_exists(self, table, name):
+        return self.run("select name from pragma_table_info(%(table)s) where name = %(name)s",
+            { 'table': table, 'name': name })
+
+    def explain(self, sql, args):
+        return self.run("explain query plan " + sql, args)
+
+    # SCAN lr (3.36 and later) or SCAN TABLE loginrole AS lr, maybe USING ...
+    def plan_scans(self, plan):
+        scans = set()
+        for r in plan:
+            w = r['detail'].split()
+            if len(w) == 0 or w[0] != 'SCAN':
+                continue
+            for t in w[1:]:
+                if t == 'USING':
+                    break
+                if not t in ( 'TABLE', 'AS', ):
+                    scans.add(t)
+        return scans
+
+    def activity_tables(self):
+        return self.run("""
+            select name
+              from sqlite_master
+             where type = 'table'
+               and name like 'activity_p%%'""", {})
+
+    #
+    # index names are global in sqlite, the rotated table's indexes are
+    # renamed after it.  the new table carries on with the old ids.
+    #
+    def activity_rotate(self, name):
+        return self.run([
+            "alter table activity rename to " + name,
+            "drop index if exists activity_session_id",
+            "drop index if exists activity_type_id_allow",
+            "create index {0}_session_id on {0} ( session_id )".format(name),
+            """
+            create table activity
+            (
+            id INTEGER NOT NULL PRIMARY KEY  AUTOINCREMENT,
+            session_id INTEGER REFERENCES session (id),
+            topic_name TEXT,
+            type_id TEXT REFERENCES activity_type (id),
+            allow BOOLEAN,
+            modified_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )""",
+            "insert into sqlite_sequence ( name, seq ) select 'activity', seq from sqlite_sequence where name = '{}'".format(name),
+            "create index activity_session_id on activity ( session_id )",
+            "create index activity_type_id_allow on activity ( type_id, allow )"
+            ], {})
+
+    #
+    # one upsert, needs sqlite 3.24.  counters for unknown sessions (a null
+    # session_id) can't conflict, they get a row per flush.
+    #
+    @inlineCallbacks
+    def activity_rollup(self, batch):
+        if len(batch) == 0:
+            defer.returnValue([])
+        va, values = self._rollup_values(batch)
+        yield self.run("""
+            insert into activity_rollup
+                ( session_id, topic_name, type_id, allow, count, first_seen, last_seen )
+            values {}
+            on conflict ( session_id, topic_name, type_id, allow ) do update
+               set count = count + excluded.count,
+                   last_seen = max(last_seen, excluded.last_seen)""".format(values), va)
+        defer.returnValue([ [ { 'upserted': len(batch) } ] ])
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## authorize.py - end to end authorization throughput
+##
+## sqlauthrouter runs in this process (sqlauthrouter.build) on a scratch
+## sqlite database, or on --engine/--dsn (a scratch postgres, say).  it is
+## seeded with --users bench_ logins in --roles roles, each role granted
+## everything on one of --trees topic trees (bench.tN).  then --clients
+## WAMP clients connect over loopback, log in with WAMP-CRA, and each sends
+## --messages messages, picked by the --mix weights:
+##   subscribe  - subscribe (and unsubscribe) a topic in the client's tree
+##   publish    - an acknowledged publish in the client's tree
+##   call       - call the procedure the client registered
+##   deny       - a publish outside any granted tree, refused
+##   connect    - a second connection and login, then leave
+## reported:
+##   authorize  - p50/p99 of AuthorizeRouter.authorize, the database wait
+##                included when a decision goes to the database
+##   connect    - p50/p99 from connecting to joined, the first logins
+##   messages/s - messages the clients finished per second
+##   db/message - database calls (login, permission, session, activity)
+##                per message.  batched activity writes still queued when
+##                the run ends aren't counted.
+##
+## --router passes options to sqlauthrouter, so any setup can be measured.
+## on sqlite keep --direct, sqlbridge's sqlite can't run the router's queries.
+## python -m sqlauth.bench.authorize --clients 50 --router "--direct --authorize trie" --json authorize.json
+###############################################################################
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys, os, argparse, json, time, tempfile, shutil, shlex, random, sqlite3
+from tabulate import tabulate
+
+from twisted.python import log
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet import defer
+from twisted.internet.endpoints import clientFromString
+
+from autobahn.wamp import auth
+from autobahn.wamp import types
+from autobahn.twisted.wamp import ApplicationSession
+from autobahn.twisted.websocket import WampWebSocketClientFactory
+
+import sqlauth
+from sqlauth.scripts import sqlauthrouter
+from sqlauth.twisted.authorizerouter import AuthorizeRouter
+from sqlauth.twisted.directdb import DirectDb
+
+SECRET = 'bench'
+CONNECT_TIMEOUT = 30
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(sqlauth.__file__))),
+    'config', 'SQLITE.sql')
+ACTIONS = ( 'call', 'register', 'subscribe', 'publish', )
+DB_PROCEDURES = ( '.db.query', '.db.operation', '.session.add', '.session.delete',
+    '.activity.add', '.activity.addbatch', '.activity.rollup', )
+
+class TimedRouter(AuthorizeRouter):
+    """
+    AuthorizeRouter, timing each decision on a bench. topic
+    """
+
+    samples = []
+
+    def authorize(self, session, uri, action):
+        if not uri.startswith('bench.'):
+            return AuthorizeRouter.authorize(self, session, uri, action)
+        start = time.time()
+        rv = AuthorizeRouter.authorize(self, session, uri, action)
+        if isinstance(rv, defer.Deferred):
+            def done(r):
+                TimedRouter.samples.append(time.time() - start)
+                return r
+            return rv.addBoth(done)
+        TimedRouter.samples.append(time.time() - start)
+        return rv
+
+class Counter(object):
+    """
+    counts the database calls made through the sessions it wraps
+    """
+
+    def __init__(self, topic_base):
+        self.procedures = set([ topic_base + p for p in DB_PROCEDURES ])
+        self.n = 0
+
+        return
+
+    def wrap(self, session):
+        call = session.call
+        def counted(procedure, *args, **kwargs):
+            if procedure in self.procedures:
+                self.n += 1
+            return call(procedure, *args, **kwargs)
+        session.call = counted
+
+        return
+
+class Client(ApplicationSession):
+    """
+    one simulated client, joined fires with the session once it is in
+    """
+
+    keys = {}
+
+    def __init__(self, config, login, joined):
+        ApplicationSession.__init__(self, config)
+        self.login = login
+        self.joined = joined
+        self.left = defer.Deferred()
+
+        return
+
+    def onConnect(self):
+        self.join(self.config.realm, [u'wampcra'], unicode(self.login))
+
+    # every login has the same secret and salt, the key is derived once
+    def onChallenge(self, challenge):
+        salt = challenge.extra['salt']
+        if not salt in Client.keys:
+            Client.keys[salt] = auth.derive_key(SECRET, salt.encode('utf8'),
+                challenge.extra.get('iterations', None), challenge.extra.get('keylen', None))
+        return auth.compute_wcs(Client.keys[salt], challenge.extra['challenge'].encode('utf8')).decode('ascii')
+
+    def onJoin(self, details):
+        self.joined.callback(self)
+
+    def onLeave(self, details):
+        if not self.joined.called:
+            self.joined.errback(Exception("{} not let in: {}".format(self.login, details.reason)))
+        self.disconnect()
+
+    def onDisconnect(self):
+        if not self.left.called:
+            self.left.callback(None)
+
+def connect(reactor, port, realm, login):
+    joined = defer.Deferred()
+    f = WampWebSocketClientFactory(lambda: Client(types.ComponentConfig(realm=realm), login, joined),
+        url='ws://127.0.0.1:{}/ws'.format(port), debug=False)
+    d = clientFromString(reactor, 'tcp:127.0.0.1:{}'.format(port)).connect(f)
+    d.addErrback(lambda err: joined.errback(err) if not joined.called else None)
+    return joined.addTimeout(CONNECT_TIMEOUT, reactor)
+
+def percentile(v, q):
+    if len(v) == 0:
+        return None
+    return v[int(round(q * (len(v) - 1)))]
+
+#
+# a scratch sqlite database from config/SQLITE.sql, with the activity types
+# and a login taking id 1 (which AuthorizeRouter lets do anything), like
+# the shipped postgres database
+#
+def scratch(schema, path):
+    conn = sqlite3.connect(path)
+    with open(schema) as f:
+        conn.executescript(f.read())
+    conn.executemany("insert into activity_type ( id, name ) values ( ?, ? )",
+        [ ( a, a ) for a in ACTIONS + ( 'start', 'end', 'admin', ) ])
+    conn.execute("insert into login ( login, fullname, password, salt, tzname ) values ( 'adm', 'adm', 'x', 'x', 'UTC' )")
+    conn.commit()
+    conn.close()
+
+@inlineCallbacks
+def seed(db, users, roles, trees):
+    b = db.backend
+
+    @inlineCallbacks
+    def insert(table, cols, rows):
+        for i in range(0, len(rows), 100):
+            chunk = [ dict(zip(cols, r)) for r in rows[i:i+100] ]
+            va, values = b._values(chunk, cols,
+                '(' + ', '.join([ '%(' + c + '_{0})s' for c in cols ]) + ')')
+            yield db.operation("insert into {} ( {} ) values {}".format(table, ', '.join(cols), values), va)
+
+    @inlineCallbacks
+    def ids(sql):
+        rv = yield db.query(sql, {})
+        defer.returnValue(dict([ (r['name'], int(r['id'])) for r in rv ]))
+
+    salt = os.urandom(32).encode('base_64').strip()
+    password = auth.derive_key(SECRET, salt).decode('ascii')
+
+    yield insert('topic', ( 'name', 'description', ),
+        [ ( 'bench.t' + str(i), 'bench' ) for i in range(trees) ])
+    tid = yield ids("select name, id from topic where name like 'bench.t%%'")
+    yield insert('role', ( 'name', 'description', ),
+        [ ( 'bench_' + str(i), 'bench' ) for i in range(roles) ])
+    rid = yield ids("select name, id from role where name like 'bench_%%'")
+    yield insert('login', ( 'login', 'fullname', 'password', 'salt', 'tzname', ),
+        [ ( 'bench_' + str(i), 'bench', password, salt, 'UTC' ) for i in range(users) ])
+    lid = yield ids("select login as name, id from login where login like 'bench_%%'")
+    yield insert('loginrole', ( 'login_id', 'role_id', ),
+        [ ( lid['bench_' + str(i)], rid['bench_' + str(i % roles)] ) for i in range(users) ])
+    yield insert('topicrole', ( 'topic_id', 'role_id', 'type_id', 'allow', ),
+        [ ( tid['bench.t' + str(i % trees)], rid['bench_' + str(i)], a, True )
+            for i in range(roles) for a in ACTIONS ])
+
+    defer.returnValue(None)
+
+# the tree login i was granted, see seed
+def tree(i, roles, trees):
+    return 'bench.t{}'.format((i % roles) % trees)
+
+def mix(s):
+    rv = []
+    for p in s.split(','):
+        name, weight = p.split('=')
+        if not name in ( 'subscribe', 'publish', 'call', 'deny', 'connect', ):
+            raise Exception("unknown --mix message {}".format(name))
+        rv.append(( name, float(weight) ))
+    return rv
+
+@inlineCallbacks
+def bench(reactor, args):
+    d = tempfile.mkdtemp()
+    engine, dsn = args.engine, args.dsn
+    if dsn is None:
+        engine = 'SQLITE3'
+        dsn = 'database=' + os.path.join(d, 'bench.db')
+        scratch(args.schema, os.path.join(d, 'bench.db'))
+    db = DirectDb(engine, dsn, 'sys', prepare=False)
+    try:
+        yield seed(db, args.users, args.roles, args.trees)
+    finally:
+        db.close()
+
+    ra = sqlauthrouter.parser().parse_args([ '--engine', engine, '--dsn', dsn,
+        '--endpoint', 'tcp:0:interface=127.0.0.1', '--no-recover' ] + shlex.split(args.router))
+    parts = sqlauthrouter.build(ra, reactor, router=TimedRouter)
+    port = yield parts['ready']
+    port = port.getHost().port
+    counter = Counter(ra.topic_base)
+    counter.wrap(parts['dbsession'])
+    if parts['authorization_session'] is not parts['dbsession']:
+        counter.wrap(parts['authorization_session'])
+    if parts['acl'] is not None:
+        while not parts['acl'].loaded:
+            yield task.deferLater(reactor, 0.1, lambda: None)
+
+    rv = { 'bench': 'authorize', 'users': args.users, 'roles': args.roles, 'trees': args.trees,
+        'clients': args.clients, 'messages': args.messages, 'mix': args.mix, 'router': args.router }
+    clients = []
+    try:
+        # connect and log in
+        lv = []
+        @inlineCallbacks
+        def login(i):
+            start = time.time()
+            c = yield connect(reactor, port, ra.realm, 'bench_' + str(i % args.users))
+            lv.append(time.time() - start)
+            c.tree = tree(i % args.users, args.roles, args.trees)
+            c.name = i
+            yield c.register(lambda *a, **kw: True, u'{}.c{}'.format(c.tree, i))
+            clients.append(c)
+        n = counter.n
+        start = time.time()
+        yield defer.gatherResults([ login(i) for i in range(args.clients) ], consumeErrors=True)
+        rv['connect_seconds'] = time.time() - start
+        rv['db_per_connect'] = float(counter.n - n) / args.clients
+        lv.sort()
+        rv['connect_p50'] = percentile(lv, 0.5)
+        rv['connect_p99'] = percentile(lv, 0.99)
+
+        # the message mix, one in flight per client
+        weights = mix(args.mix)
+        total = sum([ w for name, w in weights ])
+        counts = dict([ ( name, 0 ) for name, w in weights ])
+        def pick(r):
+            r = r * total
+            for name, w in weights:
+                if r < w:
+                    return name
+                r -= w
+            return weights[-1][0]
+
+        @inlineCallbacks
+        def send(c, j):
+            m = pick(random.random())
+            counts[m] += 1
+            if m == 'subscribe':
+                sub = yield c.subscribe(lambda *a, **kw: None, u'{}.s{}'.format(c.tree, j))
+                yield sub.unsubscribe()
+            elif m == 'publish':
+                yield c.publish(u'{}.p{}'.format(c.tree, j), j, options=types.PublishOptions(acknowledge=True))
+            elif m == 'call':
+                yield c.call(u'{}.c{}'.format(c.tree, c.name), j)
+            elif m == 'deny':
+                try:
+                    yield c.publish(u'bench.none.p{}'.format(j), j, options=types.PublishOptions(acknowledge=True))
+                except Exception:
+                    pass
+            else:
+                o = yield connect(reactor, port, ra.realm, c.login)
+                o.leave()
+                yield o.left
+
+        @inlineCallbacks
+        def client(c):
+            for j in range(args.messages):
+                yield send(c, j)
+
+        del TimedRouter.samples[:]
+        n = counter.n
+        start = time.time()
+        yield defer.gatherResults([ client(c) for c in clients ], consumeErrors=True)
+        t = time.time() - start
+        messages = args.messages * len(clients)
+        av = sorted(TimedRouter.samples)
+        rv['seconds'] = t
+        rv['sent'] = counts
+        rv['messages_per_second'] = messages / t
+        rv['authorizations'] = len(av)
+        rv['authorize_p50'] = percentile(av, 0.5)
+        rv['authorize_p99'] = percentile(av, 0.99)
+        rv['db_per_message'] = float(counter.n - n) / messages
+    finally:
+        for c in clients:
+            c.leave()
+        yield defer.gatherResults([ c.left for c in clients ])
+        shutil.rmtree(d)
+
+    def ms(v):
+        return '-' if v is None else '%.3f' % (v * 1000)
+    print(tabulate([
+        [ 'connect', args.clients, '%.2f' % rv['connect_seconds'], ms(rv['connect_p50']), ms(rv['connect_p99']),
+            '%.2f' % rv['db_per_connect'] ],
+        [ 'messages', messages, '%.2f' % rv['seconds'], ms(rv['authorize_p50']), ms(rv['authorize_p99']),
+            '%.2f' % rv['db_per_message'] ],
+        ], headers=[ '', 'count', 'seconds', 'p50 ms', 'p99 ms', 'db calls each' ]))
+    print("{:.0f} messages/s, {} authorizations".format(rv['messages_per_second'], rv['authorizations']))
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(rv, f, indent=2)
+
+def run():
+    def_users = 1000
+    def_roles = 50
+    def_trees = 10
+    def_clients = 20
+    def_messages = 200
+    def_mix = 'subscribe=20,publish=40,call=40'
+    def_engine = 'SQLITE3'
+    def_router = '--direct'
+    def_schema = SCHEMA
+
+    p = argparse.ArgumentParser(description="authorization throughput through an in process sqlauthrouter")
+
+    p.add_argument('--users', action='store', dest='users', type=int, default=def_users,
+                        help='logins seeded, default is: ' + str(def_users))
+    p.add_argument('--roles', action='store', dest='roles', type=int, default=def_roles,
+                        help='roles seeded, default is: ' + str(def_roles))
+    p.add_argument('--trees', action='store', dest='trees', type=int, default=def_trees,
+                        help='topic trees seeded, default is: ' + str(def_trees))
+    p.add_argument('-c', '--clients', action='store', dest='clients', type=int, default=def_clients,
+                        help='clients connected at once, default is: ' + str(def_clients))
+    p.add_argument('-n', '--messages', action='store', dest='messages', type=int, default=def_messages,
+                        help='messages each client sends, default is: ' + str(def_messages))
+    p.add_argument('-m', '--mix', action='store', dest='mix', default=def_mix,
+                        help='message=weight of subscribe, publish, call, deny and connect, default is: ' + def_mix)
+    p.add_argument('--router', action='store', dest='router', default=def_router,
+                        help='sqlauthrouter options, default is: ' + def_router)
+    p.add_argument('-e', '--engine', action='store', dest='engine', default=def_engine,
+                        help='with --dsn, the engine, default is: ' + def_engine)
+    p.add_argument('-d', '--dsn', action='store', dest='dsn', default=None,
+                        help='a scratch database with the sqlauth schema to seed and use, default is a new sqlite database')
+    p.add_argument('--schema', action='store', dest='schema', default=def_schema,
+                        help='the sqlite schema for the new database, default is: ' + def_schema)
+    p.add_argument('-j', '--json', action='store', dest='json', default=None,
+                        help='also write the results to this file')
+    p.add_argument('-v', '--verbose', action='store_true', dest='verbose',
+            default=False, help='Verbose logging for debugging')
+
+    args = p.parse_args()
+    if args.verbose:
+       log.startLogging(sys.stdout)
+
+    task.react(bench, [ args ])
+
+
+if __name__ == '__main__':
+   run()
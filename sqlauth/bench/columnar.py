@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## columnar.py - per row cost of formatting an admin result
+##
+## a user list shaped result (5 text columns) of --rows rows, formatted
+##   legacy       - the old Component._columnize, a list per row
+##   encode       - columnar.encode on the same list of dictionaries
+##   db dicts     - DirectDb.query, then encode (the sqlbridge shape)
+##   db columns   - DirectDb.query_columns, straight from the cursor
+## the db ones read a scratch sqlite database, the time includes the fetch.
+##
+## python -m sqlauth.bench.columnar --rows 100000 --json columnar.json
+###############################################################################
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys, os, argparse, json, time, tempfile, shutil
+from tabulate import tabulate
+
+from twisted.python import log
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet import defer
+
+from sqlauth.backend import columnar
+from sqlauth.twisted.directdb import DirectDb
+
+COLUMNS = ( 'id', 'login', 'fullname', 'tzname', 'roles', )
+
+# what _columnize did before columnar.encode
+def legacy(qv):
+    if len(qv) == 0:
+        return []
+    kv = {}
+    for r in qv:
+        for k in r.keys():
+            kv[k] = True
+        break
+    rv = []
+    ra = kv.keys()
+    rv.append(ra)
+    for r in qv:
+        rv.append([r.get(c,None) for c in ra])
+    return rv
+
+def rows(n):
+    return [ dict(zip(COLUMNS, ( str(i), 'user_' + str(i), 'User ' + str(i), 'UTC', 'admin,user', )))
+        for i in range(n) ]
+
+# best of repeat, seconds
+@inlineCallbacks
+def best(fn, repeat):
+    bv = None
+    for i in range(repeat):
+        start = time.time()
+        yield defer.maybeDeferred(fn)
+        t = time.time() - start
+        if bv is None or t < bv:
+            bv = t
+    defer.returnValue(bv)
+
+@inlineCallbacks
+def bench(reactor, args):
+    qv = rows(args.rows)
+    d = tempfile.mkdtemp()
+    db = DirectDb('SQLITE3', 'database=' + os.path.join(d, 'bench.db'), 'sys', prepare=False)
+    try:
+        yield db.query("create table bench ( id integer primary key, login text, fullname text, tzname text, roles text )")
+        for i in range(0, len(qv), 500):
+            chunk = qv[i:i+500]
+            va, values = db.backend._values(chunk, COLUMNS,
+                '(' + ', '.join([ '%(' + c + '_{0})s' for c in COLUMNS ]) + ')')
+            yield db.query("insert into bench ( {} ) values {}".format(', '.join(COLUMNS), values), va)
+        sql = "select {} from bench order by id".format(', '.join(COLUMNS))
+
+        cases = [
+            ( 'legacy', lambda: legacy(qv) ),
+            ( 'encode', lambda: columnar.encode(qv) ),
+            ( 'db dicts', lambda: db.query(sql, {}).addCallback(columnar.encode) ),
+            ( 'db columns', lambda: db.query_columns(sql, {}) ),
+        ]
+        rv = []
+        for name, fn in cases:
+            t = yield best(fn, args.repeat)
+            rv.append({ 'case': name, 'rows': args.rows, 'seconds': t, 'us_per_row': t * 1e6 / args.rows })
+    finally:
+        db.close()
+        shutil.rmtree(d)
+
+    print(tabulate([ [ r['case'], r['rows'], '%.3f' % r['seconds'], '%.3f' % r['us_per_row'] ] for r in rv ],
+        headers=[ 'case', 'rows', 'seconds', 'us/row' ]))
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({ 'bench': 'columnar', 'results': rv }, f, indent=2)
+
+def run():
+    def_rows = 100000
+    def_repeat = 3
+
+    p = argparse.ArgumentParser(description="per row cost of the admin result formats")
+
+    p.add_argument('-n', '--rows', action='store', dest='rows', type=int, default=def_rows,
+                        help='rows in the result, default is: ' + str(def_rows))
+    p.add_argument('-r', '--repeat', action='store', dest='repeat', type=int, default=def_repeat,
+                        help='runs of each case, the best is kept, default is: ' + str(def_repeat))
+    p.add_argument('-j', '--json', action='store', dest='json', default=None,
+                        help='also write the results to this file')
+    p.add_argument('-v', '--verbose', action='store_true', dest='verbose',
+            default=False, help='Verbose logging for debugging')
+
+    args = p.parse_args()
+    if args.verbose:
+       log.startLogging(sys.stdout)
+
+    task.react(bench, [ args ])
+
+
+if __name__ == '__main__':
+   run()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## connect.py - a connection storm, every client logging in at once
+##
+## what a router restart looks like: --clients WebSocket sessions open at
+## the same time (at most --jobs handshakes in flight) and log in with
+## WAMP-CRA against an in process sqlauthrouter, seeded like
+## sqlauth.bench.authorize.  reported:
+##   handshakes/s   - clients / time to all joined
+##   joined         - p50/p99 from connecting to joined, per client
+##   peak memory    - the process' max rss, and how much the storm added.
+##                    the clients live in the same process, so it is an
+##                    upper bound for the router.
+## and where the router's time went, p50/p99 and total of
+##   hello          - MyRouterSession.onHello, all of it
+##   user lookup    - UserDb.get
+##   challenge      - PendingAuth, the json challenge and its signature
+##   authenticate   - MyRouterSession.onAuthenticate
+##   session add    - SessionDb.add, the session row
+##
+## python -m sqlauth.bench.connect --clients 5000 --router "--direct" --json connect.json
+###############################################################################
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys, os, argparse, json, time, tempfile, shutil, shlex, resource
+from tabulate import tabulate
+
+from twisted.python import log
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet import defer
+
+from sqlauth.scripts import sqlauthrouter
+from sqlauth.scripts.sqlauthrouter import MyRouterSession
+from sqlauth.twisted.directdb import DirectDb
+from sqlauth.bench.authorize import scratch, seed, connect, percentile, SCHEMA
+
+STEPS = ( 'hello', 'user lookup', 'challenge', 'authenticate', 'session add', )
+
+class Timings(object):
+    """
+    seconds spent in each step, one sample per call
+    """
+
+    def __init__(self):
+        self.samples = dict([ ( s, [] ) for s in STEPS ])
+
+        return
+
+    # fn, timed as step, whether it answers right away or with a deferred
+    def timed(self, step, fn):
+        samples = self.samples[step]
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            rv = fn(*args, **kwargs)
+            if isinstance(rv, defer.Deferred):
+                def done(r):
+                    samples.append(time.time() - start)
+                    return r
+                return rv.addBoth(done)
+            samples.append(time.time() - start)
+            return rv
+        return wrapper
+
+    def clear(self):
+        for v in self.samples.values():
+            del v[:]
+
+        return
+
+timings = Timings()
+
+# bench() puts this in sqlauthrouter's place
+PendingAuth = sqlauthrouter.PendingAuth
+
+class TimedPendingAuth(PendingAuth):
+    def __init__(self, *args, **kwargs):
+        start = time.time()
+        PendingAuth.__init__(self, *args, **kwargs)
+        timings.samples['challenge'].append(time.time() - start)
+
+class TimedRouterSession(MyRouterSession):
+    def onHello(self, realm, details):
+        return timings.timed('hello', MyRouterSession.onHello)(self, realm, details)
+
+    def onAuthenticate(self, signature, extra):
+        return timings.timed('authenticate', MyRouterSession.onAuthenticate)(self, signature, extra)
+
+# kilobytes on linux
+def maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# each client is two sockets here, both ends
+def files(clients):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    want = clients * 2 + 100
+    if soft < want:
+        soft = want if hard == resource.RLIM_INFINITY else min(want, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, ( soft, hard ))
+    return soft
+
+@inlineCallbacks
+def bench(reactor, args):
+    limit = files(args.clients)
+    if limit < args.clients * 2 + 100:
+        log.msg("bench: only {} open files, fewer clients will get in".format(limit))
+    d = tempfile.mkdtemp()
+    engine, dsn = args.engine, args.dsn
+    if dsn is None:
+        engine = 'SQLITE3'
+        dsn = 'database=' + os.path.join(d, 'bench.db')
+        scratch(args.schema, os.path.join(d, 'bench.db'))
+    db = DirectDb(engine, dsn, 'sys', prepare=False)
+    try:
+        yield seed(db, args.users, args.roles, args.roles)
+    finally:
+        db.close()
+
+    ra = sqlauthrouter.parser().parse_args([ '--engine', engine, '--dsn', dsn,
+        '--endpoint', 'tcp:0:interface=127.0.0.1:backlog={}'.format(args.backlog),
+        '--no-recover' ] + shlex.split(args.router))
+    sqlauthrouter.PendingAuth = TimedPendingAuth
+    parts = sqlauthrouter.build(ra, reactor)
+    parts['session_factory'].session = TimedRouterSession
+    parts['userdb'].get = timings.timed('user lookup', parts['userdb'].get)
+    parts['sessiondb'].add = timings.timed('session add', parts['sessiondb'].add)
+    port = yield parts['ready']
+    port = port.getHost().port
+
+    rv = { 'bench': 'connect', 'users': args.users, 'clients': args.clients, 'jobs': args.jobs,
+        'router': args.router }
+    clients = []
+    failed = [ 0 ]
+    try:
+        timings.clear()
+        lv = []
+        rss = maxrss()
+        sem = defer.DeferredSemaphore(args.jobs if args.jobs > 0 else args.clients)
+        @inlineCallbacks
+        def login(i):
+            start = time.time()
+            try:
+                c = yield connect(reactor, port, ra.realm, 'bench_' + str(i % args.users))
+                lv.append(time.time() - start)
+                clients.append(c)
+            except Exception as e:
+                failed[0] += 1
+                log.msg("bench: client {} failed {}".format(i, e))
+        start = time.time()
+        yield defer.gatherResults([ sem.run(login, i) for i in range(args.clients) ])
+        t = time.time() - start
+        # the session rows go in after the join, give them a moment
+        while len(timings.samples['session add']) < len(clients) and time.time() - start < t * 2 + 5:
+            yield task.deferLater(reactor, 0.1, lambda: None)
+        lv.sort()
+        rv['seconds'] = t
+        rv['joined'] = len(clients)
+        rv['failed'] = failed[0]
+        rv['handshakes_per_second'] = len(clients) / t
+        rv['joined_p50'] = percentile(lv, 0.5)
+        rv['joined_p99'] = percentile(lv, 0.99)
+        rv['maxrss_kb'] = maxrss()
+        rv['storm_rss_kb'] = maxrss() - rss
+        rv['steps'] = {}
+        for s in STEPS:
+            v = sorted(timings.samples[s])
+            rv['steps'][s] = { 'count': len(v), 'p50': percentile(v, 0.5), 'p99': percentile(v, 0.99),
+                'total': sum(v) }
+    finally:
+        for c in clients:
+            c.leave()
+        yield defer.gatherResults([ c.left for c in clients ])
+        shutil.rmtree(d)
+
+    def ms(v):
+        return '-' if v is None else '%.3f' % (v * 1000)
+    print("{} joined ({} failed) in {:.2f} seconds, {:.0f} handshakes/s, joined p50 {} ms p99 {} ms".format(
+        rv['joined'], rv['failed'], rv['seconds'], rv['handshakes_per_second'],
+        ms(rv['joined_p50']), ms(rv['joined_p99'])))
+    print("peak memory {} MB, the storm added {} MB".format(rv['maxrss_kb'] / 1024, rv['storm_rss_kb'] / 1024))
+    print(tabulate([ [ s, rv['steps'][s]['count'], ms(rv['steps'][s]['p50']), ms(rv['steps'][s]['p99']),
+        '%.2f' % rv['steps'][s]['total'] ] for s in STEPS ],
+        headers=[ 'step', 'count', 'p50 ms', 'p99 ms', 'total s' ]))
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(rv, f, indent=2)
+
+def run():
+    def_users = 1000
+    def_roles = 50
+    def_clients = 2000
+    def_jobs = 0
+    def_backlog = 1024
+    def_engine = 'SQLITE3'
+    def_router = '--direct'
+    def_schema = SCHEMA
+
+    p = argparse.ArgumentParser(description="WAMP-CRA connection storm against an in process sqlauthrouter")
+
+    p.add_argument('--users', action='store', dest='users', type=int, default=def_users,
+                        help='logins seeded, clients past this reuse them, default is: ' + str(def_users))
+    p.add_argument('--roles', action='store', dest='roles', type=int, default=def_roles,
+                        help='roles seeded, default is: ' + str(def_roles))
+    p.add_argument('-c', '--clients', action='store', dest='clients', type=int, default=def_clients,
+                        help='clients, default is: ' + str(def_clients))
+    p.add_argument('--jobs', action='store', dest='jobs', type=int, default=def_jobs,
+                        help='handshakes in flight at once, 0 is every client at once, default is: ' + str(def_jobs))
+    p.add_argument('--backlog', action='store', dest='backlog', type=int, default=def_backlog,
+                        help='the router\'s listen backlog, default is: ' + str(def_backlog))
+    p.add_argument('--router', action='store', dest='router', default=def_router,
+                        help='sqlauthrouter options, default is: ' + def_router)
+    p.add_argument('-e', '--engine', action='store', dest='engine', default=def_engine,
+                        help='with --dsn, the engine, default is: ' + def_engine)
+    p.add_argument('-d', '--dsn', action='store', dest='dsn', default=None,
+                        help='a scratch database with the sqlauth schema to seed and use, default is a new sqlite database')
+    p.add_argument('--schema', action='store', dest='schema', default=def_schema,
+                        help='the sqlite schema for the new database, default is: ' + def_schema)
+    p.add_argument('-j', '--json', action='store', dest='json', default=None,
+                        help='also write the results to this file')
+    p.add_argument('-v', '--verbose', action='store_true', dest='verbose',
+            default=False, help='Verbose logging for debugging')
+
+    args = p.parse_args()
+    if args.verbose:
+       log.startLogging(sys.stdout)
+
+    # thousands of sockets, select() stops at 1024
+    from autobahn.twisted.choosereactor import install_reactor
+    install_reactor()
+
+    task.react(bench, [ args ])
+
+
+if __name__ == '__main__':
+   run()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## hotlog.py - what logging costs AuthorizeRouter.authorize, per message
+##
+## authorize is called --messages times in a loop, no network and no
+## database: the session is made up, activity goes nowhere, and on the query
+## path the permission query is answered right away.  the paths:
+##   acl    - a loaded acl (--authorize trie), decided in place
+##   cache  - a permission cache hit (--authorize query, the default)
+##   query  - a cache miss, check_permission's lines included
+## each path with the router's logging (authorizerouter.LOG) being
+##   none     - nothing, the floor
+##   before   - the old way, every line formatted and handed to log.msg
+##   after    - logger.py, not --verbose, a level check per line
+## and, with an observer writing to /dev/null, what --verbose costs
+##   sampled  - --verbose --log-sample 100
+##   verbose  - --verbose, every line
+## reported is the best of --repeat runs, microseconds per message, and
+## what logging adds to none.
+##
+## python -m sqlauth.bench.hotlog --messages 100000 --json hotlog.json
+###############################################################################
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys, os, argparse, json, time
+from tabulate import tabulate
+
+from twisted.python import log
+from twisted.internet import defer
+
+from autobahn.wamp.interfaces import IRouter
+
+from sqlauth.twisted import authorizerouter
+from sqlauth.twisted import logger
+from sqlauth.twisted.authorizerouter import AuthorizeRouter
+from sqlauth.twisted.cache import PermissionCache
+
+PATHS = ( 'acl', 'cache', 'query', )
+MODES = ( 'none', 'before', 'after', 'sampled', 'verbose', )
+
+class Silent(logger.Logger):
+    """
+    no logging at all
+    """
+
+    def debug(self, fmt, *args, **kwargs):
+        return
+
+class Eager(logger.Logger):
+    """
+    the logging authorize had before logger.py, formatted whatever the level
+    """
+
+    def debug(self, fmt, *args, **kwargs):
+        log.msg("{}.{}".format(self.name, fmt.format(*args, **kwargs)))
+
+class Session(object):
+    def __init__(self, authid, session_id):
+        self._authid = authid
+        self._session_id = session_id
+
+class Acl(object):
+    loaded = True
+
+    def check(self, authid, uri, action):
+        return True
+
+class Nowhere(object):
+    """
+    the sessiondb and the database, answering at once
+    """
+
+    def activity(self, *args):
+        return
+
+    def call(self, *args, **kwargs):
+        return defer.succeed([ { 'allow': True } ])
+
+def router(path):
+    kwargs = { 'topic_base': 'sys.db', 'db': Nowhere(), 'direct': Nowhere() }
+    if path == 'acl':
+        kwargs['acl'] = Acl()
+    if path == 'cache':
+        kwargs['permcache'] = PermissionCache(size=100, ttl=0)
+    return AuthorizeRouter(None, u'realm1', **kwargs)
+
+# seconds per message, the best of repeat runs
+def measure(path, messages, repeat):
+    r = router(path)
+    session = Session(5, 1234)
+    uri = u'com.bench.t1.topic'
+    action = IRouter.ACTION_PUBLISH
+    r.authorize(session, uri, action)
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for j in xrange(messages):
+            r.authorize(session, uri, action)
+        t = (time.time() - start) / messages
+        if best is None or t < best:
+            best = t
+    return best
+
+def bench(args):
+    hot = authorizerouter.LOG
+    rv = { 'bench': 'hotlog', 'messages': args.messages, 'repeat': args.repeat, 'paths': {} }
+    for p in PATHS:
+        rv['paths'][p] = {}
+    try:
+        for mode in MODES:
+            if mode == 'sampled':
+                # what --verbose writes goes to /dev/null from here on
+                log.startLogging(open(os.devnull, 'w'), setStdout=False)
+            logger.set_level(logger.DEBUG if mode in ( 'sampled', 'verbose', ) else logger.WARN)
+            if mode == 'none':
+                authorizerouter.LOG = Silent(hot.name)
+            elif mode == 'before':
+                authorizerouter.LOG = Eager(hot.name)
+            else:
+                authorizerouter.LOG = logger.Logger(hot.name, sample=100 if mode == 'sampled' else 0)
+            for p in PATHS:
+                rv['paths'][p][mode] = measure(p, args.messages, args.repeat)
+    finally:
+        authorizerouter.LOG = hot
+        logger.set_level(logger.WARN)
+
+    def us(v):
+        return '%.2f' % (v * 1000000)
+    rows = []
+    for p in PATHS:
+        t = rv['paths'][p]
+        rows.append([ p ] + [ us(t[m]) for m in MODES ] +
+            [ us(t['before'] - t['none']), us(t['after'] - t['none']) ])
+    print(tabulate(rows, headers=[ 'path' ] + [ m + ' us' for m in MODES ] +
+        [ 'before adds us', 'after adds us' ]))
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(rv, f, indent=2)
+
+def run():
+    def_messages = 100000
+    def_repeat = 3
+
+    p = argparse.ArgumentParser(description="per message logging overhead of AuthorizeRouter.authorize")
+
+    p.add_argument('-n', '--messages', action='store', dest='messages', type=int, default=def_messages,
+                        help='authorize calls per run, default is: ' + str(def_messages))
+    p.add_argument('--repeat', action='store', dest='repeat', type=int, default=def_repeat,
+                        help='runs of each, the best is reported, default is: ' + str(def_repeat))
+    p.add_argument('-j', '--json', action='store', dest='json', default=None,
+                        help='also write the results to this file')
+
+    args = p.parse_args()
+
+    bench(args)
+
+
+if __name__ == '__main__':
+   run()
@@ -19,7 +19,7 @@
 
 from __future__ import absolute_import
 
-import sys, os, argparse, six, json
+import sys, os, argparse, six, json, time
 import types as vtypes
 from tabulate import tabulate
 
@@ -28,6 +28,7 @@ from twisted.python import log
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks
 from twisted.internet import defer
+from twisted.internet import task
 
 from autobahn.twisted.wamp import ApplicationRunner,ApplicationSession
 from autobahn.wamp import auth
@@ -52,12 +53,15 @@ class Component(ApplicationSession):
         log.msg("got args {}, kwargs {}".format(args,kwargs))
 
         # reap init variables meant only for us
-        for i in ( 'command', 'action', 'action_args', 'debug', 'authinfo', 'topic_base', ):
+        for i in ( 'command', 'action', 'action_args', 'debug', 'authinfo', 'topic_base', 'stream',
+                'batch', 'jobs', 'results', ):
             if i in kwargs:
                 if kwargs[i] is not None:
                     self.svar[i] = kwargs[i]
                 del kwargs[i]
 
+        self.failed = 0
+
         log.msg("sending to super.init args {}, kwargs {}".format(args,kwargs))
         ApplicationSession.__init__(self, *args, **kwargs)
 
@@ -90,13 +94,119 @@ class Component(ApplicationSession):
         else:
             raise Exception("don't know how to compute challenge for authmethod {}".format(challenge.method))
 
+    #
+    # a chunk of a streamed list, [[headers],[row]...], printed as it
+    # arrives.  the headers go out with the first chunk only.
+    #
+    def _progress(self, chunk):
+        log.msg("_progress: {} rows".format(len(chunk) - 1))
+        if len(chunk) < 2:
+            return
+        if self.chunks == 0:
+            print tabulate(chunk, headers="firstrow", tablefmt="simple")
+        else:
+            print tabulate(chunk[1:], tablefmt="plain")
+        self.chunks += 1
+        sys.stdout.flush()
+
+        return
+
+    #
+    # list with --stream, rows are printed by _progress as they come in,
+    # the result is just the count.
+    #
+    @inlineCallbacks
+    def _stream(self):
+        self.chunks = 0
+        aa = dict(self.svar['action_args'])
+        aa['stream'] = True
+        aa.setdefault('chunk', self.svar['stream'])
+        nv = yield self.call(self.svar['topic_base'] + '.' + self.svar['command'] + '.' +
+            self.svar['action'], action_args=aa,
+            options = CallOptions(timeout=2000,discloseMe = True,onProgress = self._progress))
+        if isinstance(nv, vtypes.DictType) and 'rows' in nv:
+            print "{} rows".format(nv['rows'])
+        else:
+            # a procedure that doesn't stream answers the usual way
+            print tabulate(nv, headers="firstrow", tablefmt="simple")
+
+        return
+
+    #
+    # one line of a batch, a json object like
+    #   { "command":"user", "action":"add", "args":{ "login":"greg", ... } }
+    # its status goes to stdout as a json line, in the order the calls
+    # finish.  the line number ties it back to the input.
+    #
+    @inlineCallbacks
+    def _batch_one(self, n, line):
+        line = line.strip()
+        if len(line) == 0 or line.startswith('#'):
+            return
+        st = { 'line': n }
+        try:
+            c = json.loads(line)
+            st['command'] = c['command']
+            st['action'] = c['action']
+            nv = yield self.call(self.svar['topic_base'] + '.' + c['command'] + '.' + c['action'],
+                action_args=c.get('args', {}),
+                options = CallOptions(timeout=2000,discloseMe = True))
+            st['status'] = 'ok'
+            if self.svar.get('results', False):
+                st['result'] = nv
+        except Exception as e:
+            self.failed += 1
+            st['status'] = 'error'
+            st['error'] = "{}".format(e)
+        print json.dumps(st)
+        sys.stdout.flush()
+
+        return
+
+    #
+    # every line of the batch file (or stdin), over this one session, with
+    # at most jobs calls in flight.  lines are read as they are needed, so
+    # stdin can be a stream.
+    #
+    @inlineCallbacks
+    def _batch(self):
+        fn = self.svar['batch']
+        f = sys.stdin if fn == '-' else open(fn)
+        start = time.time()
+        self.done = 0
+        try:
+            def work():
+                for n, line in enumerate(f, 1):
+                    self.done += 1
+                    yield self._batch_one(n, line)
+            w = work()
+            coop = task.Cooperator()
+            yield defer.DeferredList([ coop.coiterate(w) for i in range(max(1, self.svar.get('jobs', 1))) ])
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        sys.stderr.write("{} lines, {} failed, {:.1f} seconds\n".format(self.done, self.failed,
+            time.time() - start))
+
+        return
+
     @inlineCallbacks
     def onJoin(self, details):
         log.msg("onJoin session attached {}".format(details))
         rv = []
 
         try:
+            if 'batch' in self.svar:
+                yield self._batch()
+                log.msg("onJoin disconnecting : {}")
+                self.disconnect()
+                return
             log.msg("{}.{}.{}".format(self.svar['topic_base'],self.svar['command'],self.svar['action']))
+            if self.svar.get('stream', 0) > 0 and self.svar['action'] == 'list':
+                yield self._stream()
+                log.msg("onJoin disconnecting : {}")
+                self.disconnect()
+                return
             nv = yield self.call(self.svar['topic_base'] + '.' + self.svar['command'] + '.' +
                 self.svar['action'], action_args=self.svar['action_args'],
                 options = CallOptions(timeout=2000,discloseMe = True))
@@ -120,6 +230,7 @@ class Component(ApplicationSession):
                 else:
                     print "Result set {} {}, [no results]".format(i + 1, drv[str(i)]['title'])
         except Exception as e:
+            self.failed += 1
             sys.stderr.write("ERROR: {}\n".format(e))
 
         log.msg("onJoin disconnecting : {}")
@@ -153,6 +264,8 @@ def run():
     def_realm = 'realm1'
     def_topic_base = 'sys'
     def_action_args = '{}'
+    def_stream = 0
+    def_jobs = 10
 
     # http://stackoverflow.com/questions/3853722/python-argparse-how-to-insert-newline-the-help-text
     p = argparse.ArgumentParser(description="db admin manager for autobahn", formatter_class=SmartFormatter)
@@ -169,6 +282,8 @@ def run():
                         help='users "secret" password')
     p.add_argument('-t', '--topic', action='store', dest='topic_base', default=def_topic_base,
                         help='if you specify --dsn then you will need a topic to root it on, the default ' + def_topic_base + ' is fine.')
+    p.add_argument('--stream', action='store', dest='stream', type=int, nargs='?', const=500, default=def_stream,
+                        help='list in chunks of this many rows (500 if no number is given), printed as they arrive, default is ' + str(def_stream) + ', all at once')
     sp = p.add_subparsers(dest='command')
     session_p = sp.add_parser('session')
     session_p.add_argument('action', choices=['list','get','kill'], help='Session commands')
@@ -220,9 +335,20 @@ def run():
     router_p.add_argument('-a', '--args', action='store', dest='action_args', default=def_action_args,
                         help='action args, json format, default: ' + def_action_args)
 
+    batch_p = sp.add_parser('batch', formatter_class=SmartFormatter,
+                        help='run many commands over one connection')
+    batch_p.add_argument('batch', nargs='?', default='-',
+                        help='R|json lines, one command each, - (the default) is stdin:\n'
+                        '  {"command":"user","action":"add","args":{"login":"greg"}}\n'
+                        'the status of each is written to stdout as a json line')
+    batch_p.add_argument('-j', '--jobs', action='store', dest='jobs', type=int, default=def_jobs,
+                        help='calls in flight at once, default is: ' + str(def_jobs))
+    batch_p.add_argument('--results', action='store_true', dest='results', default=False,
+                        help='include each call\'s result in its status line')
+
     args = p.parse_args()
     if args.verbose:
-       log.startLogging(sys.stdout)
+       log.startLogging(sys.stderr if args.command == 'batch' else sys.stdout)
 
     component_config = types.ComponentConfig(realm=args.realm)
     ai = {
@@ -231,11 +357,19 @@ def run():
             'auth_password':args.password
             }
 
-    mdb = Component(config=component_config,
-            authinfo=ai,topic_base=args.topic_base,debug=args.verbose,
-            command=args.command,action=args.action,action_args=json.loads(args.action_args))
+    if args.command == 'batch':
+        mdb = Component(config=component_config,
+                authinfo=ai,topic_base=args.topic_base,debug=args.verbose,
+                command=args.command,batch=args.batch,jobs=args.jobs,results=args.results)
+    else:
+        mdb = Component(config=component_config,
+                authinfo=ai,topic_base=args.topic_base,debug=args.verbose,
+                command=args.command,action=args.action,action_args=json.loads(args.action_args),
+                stream=args.stream)
     runner = ApplicationRunner(args.wsocket, args.realm)
     runner.run(lambda _: mdb)
+    if mdb.failed > 0:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
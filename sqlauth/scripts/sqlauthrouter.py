@@ -34,11 +34,25 @@ from autobahn.twisted.wamp import Router
 from autobahn.twisted.wamp import RouterSession
 from sqlbridge.twisted.dbengine import DB
 from twisted.internet import defer
+from twisted.internet.task import LoopingCall
 from autobahn.twisted.wamp import ApplicationSession
 
 from sqlauth.twisted.userdb import UserDb
 from sqlauth.twisted.sessiondb import SessionDb
 from sqlauth.twisted.authorizerouter import AuthorizeRouter, AuthorizeSession
+from sqlauth.twisted.cache import PermissionCache, SessionMemo
+from sqlauth.twisted.acltrie import AclTrie
+from sqlauth.twisted.auditpolicy import AuditPolicy
+from sqlauth.twisted.singleflight import SingleFlight
+from sqlauth.twisted.directdb import DirectDb
+from sqlauth.backend import get_backend
+from sqlauth.twisted.activitypruner import ActivityPruner
+from sqlauth.twisted.routerinstance import RouterInstance
+from sqlauth.twisted import metrics
+from sqlauth.twisted import logger
+
+# a few lines per login and per session
+LOG = logger.Logger('MyRouterSession', hot=True)
 
 class SessionData(ApplicationSession):
     def __init__(self, *args, **kwargs):
@@ -48,7 +62,7 @@ class SessionData(ApplicationSession):
         sd = args[1]
 
         # reap init variables meant only for us
-        for i in ( 'topic_base', ):
+        for i in ( 'topic_base', 'metrics_interval', ):
             if i in kwargs:
                 if kwargs[i] is not None:
                     self.svar[i] = kwargs[i]
@@ -101,11 +115,36 @@ class SessionData(ApplicationSession):
         #    ses._transport.sendClose(code=3000,reason=six.u('killed'))
         #    return defer.succeed({ 'killed': sid })
 
+        #
+        # this call returns this router's epoch, the router_epoch of the sessions
+        # it opens.  sessionList uses it to tell its sessions from other routers'.
+        #
+        def session_instance(*args, **kwargs):
+            return { 'epoch': self.sessiondb.epoch }
+
         # this call returns a dictionary, keys are session id, value is a dictionary with at least 'authid' in it
         reg = yield self.register(list_session_id, self.svar['topic_base']+'.session.listid',
             RegisterOptions(details_arg = 'details'))
         reg = yield self.register(list_session_sys_id, self.svar['topic_base']+'.session.listsysid',
             RegisterOptions(details_arg = 'details'))
+        reg = yield self.register(session_instance, self.svar['topic_base']+'.session.instance',
+            RegisterOptions(details_arg = 'details'))
+
+        #
+        # this call returns the router's metrics, see metrics.Registry.snapshot.
+        # the same goes out on topic_base.metrics every metrics_interval seconds.
+        #
+        def metrics_get(*args, **kwargs):
+            return metrics.registry.snapshot()
+
+        def metrics_publish():
+            self.publish(self.svar['topic_base']+'.metrics', metrics.registry.snapshot())
+
+        reg = yield self.register(metrics_get, self.svar['topic_base']+'.metrics.get',
+            RegisterOptions(details_arg = 'details'))
+        if self.svar.get('metrics_interval', 0) > 0:
+            self.metrics_loop = LoopingCall(metrics_publish)
+            self.metrics_loop.start(self.svar['metrics_interval'], now=False)
 
     def onLeave(self, details):
         log.msg("onLeave: {}".format(details))
@@ -147,12 +186,16 @@ class MyRouterSession(RouterSession):
     """
     Our custom router session that authenticates via WAMP-CRA.
     """
+
+    # the session's authorization decisions while it is joined, see SessionMemo
+    _memo = None
+
     @defer.inlineCallbacks
     def onHello(self, realm, details):
         """
         Callback fired when client wants to attach session.
         """
-        log.msg("onHello: {} {}".format(realm, details))
+        LOG.debug("onHello: {} {}", realm, details)
 
         self._pending_auth = None
 
@@ -162,18 +205,18 @@ class MyRouterSession(RouterSession):
 
                     ## lookup user in user DB
                     salt, key, role, uid = yield self.factory.userdb.get(details.authid)
-                    log.msg("salt, key, role: {} {} {} {}".format(salt, key, role, uid))
+                    LOG.debug("onHello: salt, key, role: {} {} {} {}", salt, key, role, uid)
 
                     ## if user found ..
                     if key:
 
-                        log.msg("found key")
+                        LOG.debug("onHello: found key")
 
                         ## setup pending auth
                         self._pending_auth = PendingAuth(key, details.pending_session,
                             details.authid, role, authmethod, u"userdb", uid)
 
-                        log.msg("setting challenge")
+                        LOG.debug("onHello: setting challenge")
                         ## send challenge to client
                         extra = {
                             u'challenge': self._pending_auth.challenge
@@ -196,7 +239,7 @@ class MyRouterSession(RouterSession):
         """
         Callback fired when a client responds to an authentication challenge.
         """
-        log.msg("onAuthenticate: {} {}".format(signature, extra))
+        LOG.debug("onAuthenticate: {} {}", signature, extra)
 
         ## if there is a pending auth, and the signature provided by client matches ..
         if self._pending_auth:
@@ -218,26 +261,29 @@ class MyRouterSession(RouterSession):
             return types.Deny(message = u"no pending authentication")
 
     def onJoin(self, details):
-        log.msg("MyRouterSession.onJoin: {}".format(details))
+        LOG.debug("onJoin: {}", details)
+        if self.factory.memo_size > 0:
+            self._memo = SessionMemo(size=self.factory.memo_size)
         self.factory.sessiondb.add(details.authid, details.session, self)
         self.factory.sessiondb.activity(details.session, details.session, 'start', True)
         return
 
     def onLeave(self, details):
-        log.msg("MyRouterSession.onLeave: {}".format(details))
+        LOG.debug("onLeave: {}", details)
+        self._memo = None
+        if self.factory.auditpolicy is not None:
+            self.factory.auditpolicy.forget(self._session_id)
         self.factory.sessiondb.activity(self._session_id, details.message, 'end', True)
         self.factory.sessiondb.delete(self._session_id)
         return
 
     def onDisconnect(self, details):
-        log.msg("onDisconnect: {}".format(details))
+        LOG.debug("onDisconnect: {}", details)
         return
 
 
-def run():
-    import sys, argparse
-    from twisted.python import log
-    from twisted.internet.endpoints import serverFromString
+def parser():
+    import argparse
 
     ## parse command line arguments
     ##
@@ -248,6 +294,25 @@ def run():
     def_dsn = 'dbname=autobahn host=localhost user=autouser'
     def_endpoint='tcp:8080'
     def_engine = 'PG9_4'
+    def_cache_size = 10000
+    def_cache_ttl = 60
+    def_session_memo = 64
+    def_authorize = 'query'
+    def_activity_batch = 0
+    def_activity_interval = 1.0
+    def_activity_max = 50000
+    def_activity_rollup = 0
+    def_user_cache_size = 10000
+    def_user_cache_ttl = 300
+    def_user_negative_ttl = 5
+    def_activity_retention = 0
+    def_activity_prune_interval = 3600.0
+    def_heartbeat = 0
+    def_notify_check = 30.0
+    def_metrics_interval = 60.0
+    def_metrics_port = 0
+    def_log_rate = 0
+    def_log_sample = 0
 
     p = argparse.ArgumentParser(description="basicrouter example with database")
 
@@ -267,20 +332,109 @@ def run():
                         help='if specified the database in dsn will be connected and ready')
     p.add_argument('-t', '--topic', action='store', dest='topic_base', default=def_topic_base,
                         help='if you specify --dsn then you will need a topic to root it on, the default ' + def_topic_base + ' is fine.')
+    p.add_argument('--cache-size', action='store', dest='cache_size', type=int, default=def_cache_size,
+                        help='number of authorization decisions cached by the router, 0 turns the cache off, default ' + str(def_cache_size))
+    p.add_argument('--cache-ttl', action='store', dest='cache_ttl', type=int, default=def_cache_ttl,
+                        help='seconds a cached authorization decision is good for, 0 means until invalidated, default ' + str(def_cache_ttl))
+    p.add_argument('--session-memo', action='store', dest='session_memo', type=int, default=def_session_memo,
+                        help='authorization decisions each session remembers for itself, asked before the cache, 0 turns it off. they are dropped on any permission change and every --cache-ttl seconds, default ' + str(def_session_memo))
+    p.add_argument('--authorize', action='store', dest='authorize', choices=['query','trie'], default=def_authorize,
+                        help='query asks the database for each decision, trie loads all permissions into the router at startup, default ' + def_authorize)
+    p.add_argument('--activity-batch', action='store', dest='activity_batch', type=int, default=def_activity_batch,
+                        help='write activity records this many at a time, 0 writes each one as it happens, default ' + str(def_activity_batch))
+    p.add_argument('--activity-interval', action='store', dest='activity_interval', type=float, default=def_activity_interval,
+                        help='seconds between batched activity writes, default ' + str(def_activity_interval))
+    p.add_argument('--activity-max', action='store', dest='activity_max', type=int, default=def_activity_max,
+                        help='most activity records queued in memory, more than this are dropped, default ' + str(def_activity_max))
+    p.add_argument('--activity-rollup', action='store', dest='activity_rollup', type=float, default=def_activity_rollup,
+                        help='count activity in memory and add the counts to activity_rollup every this many seconds instead of writing a row per event, 0 is off, default ' + str(def_activity_rollup))
+    p.add_argument('--activity-partition', action='store_true', dest='activity_partition', default=False,
+                        help='keep activity in daily partitions (on postgres run sqlmigrate --apply --partition first), old ones are dropped after --activity-retention days')
+    p.add_argument('--activity-retention', action='store', dest='activity_retention', type=int, default=def_activity_retention,
+                        help='with --activity-partition, days of activity to keep, 0 keeps everything, default ' + str(def_activity_retention))
+    p.add_argument('--activity-prune-interval', action='store', dest='activity_prune_interval', type=float, default=def_activity_prune_interval,
+                        help='with --activity-partition, seconds between partition checks, default ' + str(def_activity_prune_interval))
+    p.add_argument('--user-cache-size', action='store', dest='user_cache_size', type=int, default=def_user_cache_size,
+                        help='number of logins whose credentials are cached by the router, 0 turns the cache off, default ' + str(def_user_cache_size))
+    p.add_argument('--user-cache-ttl', action='store', dest='user_cache_ttl', type=int, default=def_user_cache_ttl,
+                        help='seconds cached credentials are good for, default ' + str(def_user_cache_ttl))
+    p.add_argument('--user-negative-ttl', action='store', dest='user_negative_ttl', type=int, default=def_user_negative_ttl,
+                        help='seconds an unknown login is remembered as unknown, default ' + str(def_user_negative_ttl))
+    p.add_argument('--direct', action='store_true', dest='direct', default=False,
+                        help='the router talks to the database (--engine, --dsn) on its own connection pool for logins, permissions, sessions and activity instead of over wamp.  required for SQLITE3 and MYSQL, only postgres runs through sqlbridge')
+    p.add_argument('--no-prepare', action='store_false', dest='prepare', default=True,
+                        help='with --direct on postgres, run the hot path statements as plain sql instead of preparing them on each connection')
+    p.add_argument('--no-recover', action='store_false', dest='recover', default=True,
+                        help='do not close the sessions an earlier run of the router left open before listening')
+    p.add_argument('--heartbeat', action='store', dest='heartbeat', type=float, default=def_heartbeat,
+                        help='for several routers on one database, seconds between this router\'s heartbeats in router_instance, every router sharing the database needs it, 0 is off (one router), default ' + str(def_heartbeat))
+    p.add_argument('--notify', action='store_true', dest='notify', default=False,
+                        help='postgres only, LISTEN for the change notices the sqlauth triggers send (schema version 5), so changes made through any router or by hand reach this router\'s caches')
+    p.add_argument('--notify-check', action='store', dest='notify_check', type=float, default=def_notify_check,
+                        help='with --notify, seconds between pings through the notice channel, a missed ping invalidates every cache, 0 never pings, default ' + str(def_notify_check))
+    p.add_argument('--metrics-interval', action='store', dest='metrics_interval', type=float, default=def_metrics_interval,
+                        help='seconds between publishes of the router\'s metrics on topic_base.metrics, 0 never publishes (topic_base.metrics.get still answers), default ' + str(def_metrics_interval))
+    p.add_argument('--metrics-port', action='store', dest='metrics_port', type=int, default=def_metrics_port,
+                        help='serve the metrics in prometheus text format over http on this port of 127.0.0.1, 0 is off, default ' + str(def_metrics_port))
+    p.add_argument('--log-rate', action='store', dest='log_rate', type=int, default=def_log_rate,
+                        help='with --verbose, at most this many lines a second from the per message logging (authorize, logins, sessions, activity), 0 is no limit, default ' + str(def_log_rate))
+    p.add_argument('--log-sample', action='store', dest='log_sample', type=int, default=def_log_sample,
+                        help='with --verbose, only every this many\'th line of the per message logging, 0 logs them all, default ' + str(def_log_sample))
+    p.add_argument('--audit-policy', action='store', dest='audit_policy', default=None,
+                        help='json file deciding which authorizations are recorded in activity (by topic prefix, action, denials only, first N, sampling), default records everything')
+
+    return p
+
+#
+# the whole router, from parsed options, on a reactor that is either
+# running or about to be.  router is the Router class the authorization
+# session hands out (AuthorizeRouter, or something that wraps it, see
+# sqlauth.bench.authorize).  the parts are returned in a dictionary, ready
+# fires with the listening port once recovery is done and it is listening.
+#
+def build(args, reactor, router=AuthorizeRouter):
+    from twisted.internet.endpoints import serverFromString
 
-    args = p.parse_args()
-    if args.verbose:
-        log.startLogging(sys.stdout)
+    if not args.direct and not get_backend(args.engine).bridge:
+        raise Exception("engine {} needs --direct, its sql can't run through sqlbridge".format(args.engine))
 
-    ## we use an Autobahn utility to install the "best" available Twisted reactor
-    ##
-    from autobahn.twisted.choosereactor import install_reactor
-    reactor = install_reactor()
-    log.msg("Running on reactor {}".format(reactor))
+    # --verbose turns the hot path logging on, see logger.py
+    logger.start(args.verbose)
+    logger.limit(rate=args.log_rate, sample=args.log_sample)
 
     # database workers...
-    userdb = UserDb(topic_base=args.topic_base+'.db',debug=args.verbose)
-    sessiondb = SessionDb(topic_base=args.topic_base,debug=args.verbose)
+    # identical user and permission lookups in flight at the same time share one query
+    flight = SingleFlight()
+    userdb = UserDb(topic_base=args.topic_base+'.db',debug=args.verbose,
+        cache_size=args.user_cache_size,cache_ttl=args.user_cache_ttl,negative_ttl=args.user_negative_ttl,
+        flight=flight)
+    sessiondb = SessionDb(topic_base=args.topic_base,debug=args.verbose,
+        batch_size=args.activity_batch,batch_interval=args.activity_interval,batch_max=args.activity_max,
+        rollup_interval=args.activity_rollup)
+    permcache = None
+    if args.cache_size > 0:
+        permcache = PermissionCache(size=args.cache_size, ttl=args.cache_ttl)
+    auditpolicy = None
+    if args.audit_policy is not None:
+        auditpolicy = AuditPolicy.from_file(args.audit_policy)
+    direct = None
+    if args.direct:
+        direct = DirectDb(engine=args.engine,dsn=args.dsn,topic_base=args.topic_base,debug=args.verbose,
+            prepare=args.prepare)
+    pruner = None
+    if args.activity_partition:
+        pruner = ActivityPruner(engine=args.engine,topic_base=args.topic_base+'.db',
+            retention=args.activity_retention,interval=args.activity_prune_interval,debug=args.verbose)
+    instance = None
+    if args.heartbeat > 0:
+        instance = RouterInstance(engine=args.engine,topic_base=args.topic_base+'.db',
+            epoch=sessiondb.epoch,interval=args.heartbeat,debug=args.verbose)
+    notify = None
+    if args.notify:
+        notify = args.notify_check
+    acl = None
+    if args.authorize == 'trie':
+        acl = AclTrie(topic_base=args.topic_base+'.db',debug=args.verbose)
 
     ## create a WAMP router factory
     ##
@@ -289,7 +443,9 @@ def run():
     from autobahn.twisted.wamp import RouterFactory
     router_factory = RouterFactory()
     authorization_session = AuthorizeSession(component_config,
-        topic_base=args.topic_base+'.db',debug=args.verbose,db=sessiondb,router=AuthorizeRouter)
+        topic_base=args.topic_base+'.db',debug=args.verbose,db=sessiondb,router=router,
+        permcache=permcache,acl=acl,audit=auditpolicy,userdb=userdb,flight=flight,direct=direct,
+        notify=notify,memo_ttl=args.cache_ttl if args.session_memo > 0 else 0)
     router_factory.router = authorization_session.ret_func
 
     ## create a WAMP router session factory
@@ -302,11 +458,13 @@ def run():
 
     session_factory.userdb = userdb
     session_factory.sessiondb = sessiondb
+    session_factory.auditpolicy = auditpolicy
+    session_factory.memo_size = args.session_memo
 
     log.msg("userdb, sessiondb")
 
     sessiondb_component = SessionData(component_config,session_factory.sessiondb,
-        topic_base=args.topic_base)
+        topic_base=args.topic_base,metrics_interval=args.metrics_interval)
     session_factory.add(sessiondb_component)
     session_factory.add(authorization_session)
 
@@ -315,8 +473,34 @@ def run():
     db_session = DB(component_config, engine=args.engine,
         topic_base=args.topic_base+'.db', dsn=args.dsn, debug=args.verbose)
     session_factory.add(db_session)
-    session_factory.userdb.set_session(db_session)
-    session_factory.sessiondb.set_session(db_session)
+    dbsession = db_session
+    if direct is not None:
+        # whatever DirectDb doesn't answer itself still goes over wamp
+        direct.set_session(db_session)
+        dbsession = direct
+    session_factory.userdb.set_session(dbsession)
+    session_factory.sessiondb.set_session(dbsession)
+    if acl is not None:
+        acl.set_session(dbsession)
+    if pruner is not None:
+        pruner.set_session(dbsession)
+    if instance is not None:
+        instance.set_session(dbsession)
+
+    # what the metrics registry reads when asked, see metrics.py
+    metrics.registry.gauge('sqlauth_sessions_active', 'sessions open on this router', sessiondb.count)
+    if sessiondb.writer is not None:
+        metrics.registry.collect('activity_writer', sessiondb.writer.stats)
+    if direct is not None:
+        metrics.registry.collect('directdb', direct.stats)
+    if instance is not None:
+        metrics.registry.collect('router_instance', instance.stats)
+    if authorization_session.listener is not None:
+        metrics.registry.collect('notify', authorization_session.listener.stats)
+    if args.metrics_port > 0:
+        from twisted.web import server as webserver
+        serverFromString(reactor, 'tcp:{}:interface=127.0.0.1'.format(args.metrics_port)).listen(
+            webserver.Site(metrics.MetricsResource()))
 
     ## create a WAMP-over-WebSocket transport server factory
     ##
@@ -330,12 +514,25 @@ def run():
     ## this address clash detection was a goody I got from stackoverflow:
     ## http://stackoverflow.com/questions/12007316/exiting-twisted-application-after-listenfailure
     server = serverFromString(reactor, args.endpoint)
+    ready = defer.Deferred()
     def listen():
         srv = server.listen(transport_factory)
         def ListenFailed(reason):
             log.msg("On Startup Listen Failed with {}".format(reason))
             reactor.stop()
-        srv.addErrback(ListenFailed)
+        srv.addCallbacks(ready.callback, ListenFailed)
+
+    # sessions left open by a router that crashed are closed before anyone
+    # can connect, see SessionDb.recover.  with other routers on the
+    # database only the ones of routers that are gone, see RouterInstance.
+    @inlineCallbacks
+    def recover():
+        if instance is not None:
+            yield instance.recover()
+            instance.start()
+        elif args.recover:
+            yield sessiondb.recover()
+        listen()
 
     def addsession():
         log.msg("here are three sessions {} {} {}".format(authorization_session, sessiondb_component, db_session))
@@ -349,8 +546,47 @@ def run():
         session_factory.sessiondb.add(0, db_session._session_id, db_session)
         session_factory.sessiondb.add(0, authorization_session._session_id, authorization_session)
 
-    reactor.callWhenRunning(listen)
+    reactor.callWhenRunning(recover)
     reactor.callWhenRunning(addsession)
+    reactor.addSystemEventTrigger('before', 'shutdown', sessiondb.flush)
+    if direct is not None:
+        reactor.addSystemEventTrigger('after', 'shutdown', direct.close)
+    if acl is not None:
+        reactor.callWhenRunning(acl.load)
+    if pruner is not None:
+        reactor.callWhenRunning(pruner.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', pruner.stop)
+    if instance is not None:
+        reactor.addSystemEventTrigger('before', 'shutdown', instance.stop)
+
+    return {
+        'session_factory': session_factory,
+        'transport_factory': transport_factory,
+        'authorization_session': authorization_session,
+        'db_session': db_session,
+        'dbsession': dbsession,
+        'userdb': userdb,
+        'sessiondb': sessiondb,
+        'permcache': permcache,
+        'acl': acl,
+        'direct': direct,
+        'ready': ready
+    }
+
+def run():
+    p = parser()
+    args = p.parse_args()
+    if not args.direct and not get_backend(args.engine).bridge:
+        p.error("engine {} needs --direct, only postgres runs through sqlbridge".format(args.engine))
+    logger.start(args.verbose)
+
+    ## we use an Autobahn utility to install the "best" available Twisted reactor
+    ##
+    from autobahn.twisted.choosereactor import install_reactor
+    reactor = install_reactor()
+    log.msg("Running on reactor {}".format(reactor))
+
+    build(args, reactor)
     reactor.run()
 
 if __name__ == '__main__':
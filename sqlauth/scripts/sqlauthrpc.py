@@ -25,8 +25,10 @@
 ## all of these functions are simple front ends to database
 ## updates.  the database can be updated directly if needed.
 ##
-## this module is specific to the database type accessible via topic_base.
-## this is for the postgres database.
+## the sql lives in sqlauth.backend, one backend per database engine
+## (--engine).  it runs over topic_base.db.query (sqlbridge), or with --dsn
+## straight on the database.  only postgres runs through sqlbridge, sqlite
+## and mysql need --dsn.
 ## the more i think about it the more the database access routines
 ## belong in here, not in the basicrouter, I will probably move them
 ## so the database connection and the database calls are all in one file.
@@ -43,11 +45,13 @@
 ##   list   - show a list of topics and the roles that belong to them
 ##   add    - add a new topic
 ##   delete - delete a topic
-## activity (list,add)
+## activity (list,add,addbatch)
 ##   list   - show a list of activities that belong to active sessions
 ##   add    - add a new activity
+##   addbatch - add many activities in one insert
+##   rollup - add activity counts to activity_rollup
 ## session (list,add,delete)
-##   list   - list all sessions
+##   list   - list all sessions, with cleanup close the ones only the database has
 ##   add    - add a new session
 ##   delete - delete a session
 ##
@@ -55,7 +59,7 @@
 
 from __future__ import absolute_import
 
-import sys, os, argparse, six, json, logging
+import sys, os, argparse, six, json, logging, time
 from tabulate import tabulate
 import types as vtypes
 
@@ -72,8 +76,18 @@ from autobahn.wamp import types
 
 from autobahn import util
 
+from sqlauth.backend import get_backend
+from sqlauth.backend import columnar
+from sqlauth.twisted.directdb import DirectDb
+
 import argparse
 
+# activity.list rows per page
+ACTIVITY_LIMIT = 1000
+ACTIVITY_LIMIT_MAX = 10000
+STREAM_CHUNK = 500
+STREAM_CHUNK_MAX = 5000
+
 class Component(ApplicationSession):
     """
     This component serves most of the sqlauth admin functionality 
@@ -88,7 +102,7 @@ class Component(ApplicationSession):
         log.msg("got args {}, kwargs {}".format(args,kwargs))
 
         # reap init variables meant only for us
-        for i in ( 'debug', 'authinfo', 'topic_base', ):
+        for i in ( 'debug', 'authinfo', 'topic_base', 'rollup', 'engine', 'dsn', 'multi_router', ):
             if i in kwargs:
                 if kwargs[i] is not None:
                     self.svar[i] = kwargs[i]
@@ -99,43 +113,36 @@ class Component(ApplicationSession):
         self.operation = self.svar['topic_base'] + '.db.operation'
         self.watch = self.svar['topic_base'] + '.db.watch'
         self.info = self.svar['topic_base'] + '.db.info'
+        self.invalidate = self.svar['topic_base'] + '.db.invalidate'
+
+        # the sql for this engine.  it normally runs through sqlbridge, with a
+        # dsn it runs here on its own connection pool instead.
+        engine = self.svar.get('engine', 'PG9_4')
+        self.backend = get_backend(engine, self._query)
+        if not 'dsn' in self.svar and not self.backend.bridge:
+            raise Exception("engine {} needs --dsn, its sql can't run through sqlbridge".format(engine))
+        if 'dsn' in self.svar:
+            self.direct = DirectDb(engine, self.svar['dsn'], self.svar['topic_base'])
+            self.backend.set_runner(self.direct.query, self.direct.query_columns)
 
         log.msg("sending to super.init args {}, kwargs {}".format(args,kwargs))
         ApplicationSession.__init__(self, *args, **kwargs)
 
-    # simple function to change a dictionary from each row
-    # to an array of arrays, first row contains the column names
-    # second+ rows contain the data.  this routine does not assume
-    # that each row has the same keys, so it loops through the
-    # entire result set looking for all the unique keys if
-    # fullscan=True is in kwargs
+    #
+    # a list of dictionaries as [[headers],[row]...], see
+    # sqlauth.backend.columnar.  a result that is already columnar (from
+    # DirectDb's cursor) is passed through.  the headers come from the first
+    # row, pass fullscan=True if the rows don't all have the same keys.
+    #
     def _columnize(self, *args, **kwargs):
         if len(args) < 1:
             raise Exception("must supply list of dictionaries")
         if not isinstance(args[0], vtypes.ListType):
             raise Exception("fist argument must be list of dictionaries")
-        qv = args[0]
-        if len(qv) == 0:
-            return []
-        kv = {}
-        # pass argument fullscan=True to consider all rows for column headers
-        fs = kwargs.get('fullscan', False)
-
-        for r in qv:
-            for k in r.keys():
-                kv[k] = True
-            # here we only consider the first row if is fullscan is not set.
-            # in other words, every row contains the same column keys
-            if not fs:
-                break
-
-        rv = []
-        ra = kv.keys()
-        rv.append(ra)
-        #append a row in the array for each result, in the same order as the original row 1
-        for r in qv:
-            rv.append([r.get(c,None) for c in ra])
-
+        rv = columnar.encode(args[0], fullscan=kwargs.get('fullscan', False))
+        # columns=True, one array per column instead of one per row
+        if kwargs.get('columns', False):
+            return columnar.columns(rv)
         return rv
 
     #
@@ -152,6 +159,9 @@ class Component(ApplicationSession):
         if len(qv) == 0:
             return []
 
+        if columnar.is_result(qv):
+            return self._columnize(qv,**kwargs)
+
         # the title for each of the queries can be passed as
         # the second positional argument
         rtitle = []
@@ -161,17 +171,101 @@ class Component(ApplicationSession):
             for ri in range(len(qv)):
                 rtitle.append("Result Set {}".format(ri))
 
-        if isinstance(qv, vtypes.ListType):
-            if isinstance(qv[0], vtypes.DictType):
-                defer.returnValue(self._columnize(qv,**kwargs))
-            else:
-                rv = {}
-                for ri in range(len(qv)):
-                    rv[ri] = {}
-                    rv[ri]['title'] = rtitle[ri]
-                    rv[ri]['result'] = self._columnize(qv[ri],**kwargs)
-                defer.returnValue(rv)
+        rv = {}
+        for ri in range(len(qv)):
+            rv[ri] = {}
+            rv[ri]['title'] = rtitle[ri]
+            rv[ri]['result'] = self._columnize(qv[ri],**kwargs)
+        return rv
 
+    #
+    # streaming, for the list calls.  a caller that asks for progressive
+    # results (CallOptions(onProgress=...)) and passes stream true in
+    # action_args gets the rows in chunks instead of one result.  chunk in
+    # action_args is the rows per chunk, default STREAM_CHUNK.
+    # returns the chunk size, or None if the caller isn't streaming.
+    #
+    def _streaming(self, kwargs):
+        qa = kwargs.get('action_args', None) or {}
+        details = kwargs.get('details', None)
+        if not qa.get('stream', False) or details is None or details.progress is None:
+            return None
+        return max(1, min(int(qa.get('chunk', STREAM_CHUNK)), STREAM_CHUNK_MAX))
+
+    # does the caller want the list calls' results a column at a time?
+    def _columns(self, kwargs):
+        qa = kwargs.get('action_args', None) or {}
+        return qa.get('columns', False)
+
+    #
+    # send the rows a page at a time as progressive results, each one
+    # columnar on its own ([[headers],[row]...]).  fetch(after, limit)
+    # returns the page after key after (None for the first), in key order,
+    # columnar.  keep(row, headers), if given, picks the rows of a page that
+    # are sent.  only one page is held at a time.  the final result is the
+    # number of rows sent.
+    #
+    @inlineCallbacks
+    def _stream(self, details, chunk, fetch, key, after=None, keep=None):
+        sent = 0
+        while True:
+            qv = yield fetch(after, chunk)
+            if len(qv) < 2:
+                break
+            rows = qv[1:]
+            if keep is not None:
+                rows = [ r for r in rows if keep(r, qv[0]) ]
+            if len(rows) > 0:
+                details.progress([ qv[0] ] + rows)
+                sent += len(rows)
+            if len(qv) - 1 < chunk:
+                break
+            after = qv[-1][qv[0].index(key)]
+        log.msg("_stream sent {} rows".format(sent))
+        defer.returnValue({ 'rows': sent })
+
+    #
+    # with several routers on the database (--multi-router), the ids of the
+    # live ones (router_instance) and the epoch of the one we are connected to.
+    # no router_instance table (sqlmigrate hasn't run) is no live routers.
+    #
+    @inlineCallbacks
+    def _routers(self):
+        try:
+            live = yield self.backend.router_live(int(time.time()))
+        except Exception as e:
+            log.msg("_routers: no router instances, {}".format(e), logLevel = logging.WARNING)
+            live = []
+        epoch = yield self._epoch()
+        defer.returnValue(( set(live), epoch ))
+
+    # the epoch of the router we are connected to, what its sessions are recorded with
+    @inlineCallbacks
+    def _epoch(self):
+        rv = yield self.call(self.svar['topic_base'] + '.session.instance',
+            options=types.CallOptions(timeout=2000,discloseMe=True))
+        defer.returnValue(rv['epoch'])
+
+    # the backend's runner, topic_base.db.query
+    def _query(self, s, a):
+        return self.call(self.query, s, a, options=types.CallOptions(timeout=2000,discloseMe=True))
+
+    #
+    # tell the router that rows behind its cached authorization decisions
+    # have changed.  the keyword arguments are published as a dictionary, the
+    # router understands login_id (a login) and topic (a topic and everything
+    # below it).  no login_id and no topic means throw everything away.
+    # table='login' with login (the login name) is about credentials, the
+    # router's user cache drops that login.
+    #
+    def _invalidate(self, **kwargs):
+        log.msg("_invalidate {}".format(kwargs))
+        try:
+            self.publish(self.invalidate, kwargs)
+        except Exception as e:
+            log.msg("_invalidate: publish error {}".format(e))
+
+        return
 
     def onConnect(self):
         log.msg("onConnect")
@@ -205,42 +299,18 @@ class Component(ApplicationSession):
     @inlineCallbacks
     def userList(self, *args, **kwargs):
         log.msg("userList called {}".format(kwargs))
-        qv = yield self.call(self.query,
-                """
-                    with user_roles as (
-                        select lr.role_id, lr.login_id, r.name
-                          from loginrole lr, role r
-                         where lr.role_id = r.id
-                        )
-                    select
-                        l.id, l.login, l.fullname, l.tzname, private.array_accum(u.name) as roles
-		      from
-		        login l
-           left outer join
-                        user_roles u on l.id = u.login_id
-                     where
-                        l.login is not null
-		  group by
-		  	l.id
-		  order by
-		     	l.login
-		   """,
-                   {}, options=types.CallOptions(timeout=2000,discloseMe=True))
-        defer.returnValue(self._format_results(qv))
+        chunk = self._streaming(kwargs)
+        if chunk is not None:
+            rv = yield self._stream(kwargs['details'], chunk,
+                lambda after, limit: self.backend.user_list(after, limit, columnar=True), 'login')
+            defer.returnValue(rv)
+        qv = yield self.backend.user_list(columnar=True)
+        defer.returnValue(self._format_results(qv, columns=self._columns(kwargs)))
 
     @inlineCallbacks
     def userGet(self, *args, **kwargs):
         log.msg("userGet called {}".format(kwargs))
-        qv = yield self.call(self.query,
-                """
-                    select
-                        password, salt, login, fullname, tzname, id
-                      from
-                        login
-		     where
-		     	login = %(login)s
-		   """,
-                   kwargs['action_args'], options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.user_get(kwargs['action_args'])
         defer.returnValue(self._format_results(qv))
 
     #
@@ -286,22 +356,10 @@ class Component(ApplicationSession):
         password = auth.derive_key(qa['secret'].encode('utf8'), salt.encode('utf8')).decode('ascii')
         qa['salt'] = salt
         qa['password'] = password
-        qv = yield self.call(self.query,
-                """
-                    insert into
-                        login
-                    (
-                        login, fullname, password, salt, tzname
-                    )
-                    values
-                    (
-                        %(login)s, %(fullname)s, %(password)s, %(salt)s, %(tzname)s
-                    )
-                    returning
-                        id, login, fullname
-		   """,
-                   qa, options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.user_add(qa)
         # qv[0] contains the result
+        # the router may remember that this login didn't exist
+        self._invalidate(table='login', login=qa['login'])
         
         defer.returnValue(self._format_results(qv))
 
@@ -311,79 +369,29 @@ class Component(ApplicationSession):
     def userDelete(self, *args, **kwargs):
         log.msg("userDelete called {}".format(kwargs))
         qa = kwargs['action_args']
-        qv = yield self.call(self.query,
-                [
-                    """
-                    delete
-                      from
-                        loginrole
-                     where
-                       login_id = (
-                           select id from login where login = %(login)s
-                       )
-                 returning
-                        id, login_id, role_id
-		    """,
-                    """
-                    update
-                        login
-                       set
-                        login = null,
-                        salt = 'shutdown',
-                        password = 'inactive',
-                        old_login = %(login)s
-                     where
-                        login = %(login)s
-                 returning
-                        id, old_login as login, password, salt
-		    """
-                   ],
-                   qa, options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.user_delete(qa)
         # qv[0] contains the results as an array of dicts, one dict for each query that ran
+        for r in qv[0]:
+            self._invalidate(table='loginrole', login_id=r['login_id'])
+        self._invalidate(table='login', login=qa['login'])
 
         defer.returnValue(self._format_results(qv, ['Login to role association', 'Login']))
 
     @inlineCallbacks
     def roleList(self, *args, **kwargs):
         log.msg("roleList called {}".format(kwargs))
-        qv = yield self.call(self.query,
-                """
-                    with role_users as (
-                        select lr.role_id, lr.login_id, l.login
-                          from loginrole lr, login l
-                         where lr.login_id = l.id
-                        )
-                    select
-                        r.name, r.description, t.name as role_binding, private.array_accum(l.login) as users
-		      from
-                        role r
-                  left join
-                        topic t on t.id = r.bind_to
-           left outer join
-                        role_users l on l.role_id = r.id
-		  group by
-		  	r.name, r.description, t.name
-		  order by
-		     	r.name
-		   """,
-                   {}, options=types.CallOptions(timeout=2000,discloseMe=True))
-        defer.returnValue(self._format_results(qv))
+        chunk = self._streaming(kwargs)
+        if chunk is not None:
+            rv = yield self._stream(kwargs['details'], chunk,
+                lambda after, limit: self.backend.role_list(after, limit, columnar=True), 'name')
+            defer.returnValue(rv)
+        qv = yield self.backend.role_list(columnar=True)
+        defer.returnValue(self._format_results(qv, columns=self._columns(kwargs)))
 
     @inlineCallbacks
     def roleGet(self, *args, **kwargs):
         log.msg("roleGet called {}".format(kwargs))
-        qv = yield self.call(self.query,
-                """
-                    select
-                        r.name, r.description, t.name, r.id
-                      from
-                        role as r
-                  left join
-                        topic t on t.id = r.bind_to
-		     where
-		     	r.name = %(name)s
-		   """,
-                   kwargs['action_args'], options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.role_get(kwargs['action_args'])
         defer.returnValue(self._format_results(qv))
 
     #
@@ -433,54 +441,7 @@ class Component(ApplicationSession):
 
         # all of these operations are done in the same
         # transaction, they all work, or all fail.
-        qv = yield self.call(self.query,
-                [
-                    """
-                    insert into
-                        topic
-                    (
-                        name, description
-                    )
-                    values
-                    (
-                        %(bind_to_name)s, %(description)s
-                    )
-                    returning
-                        id, name as bind_to_name, description
-		    """,
-                    """
-                    insert into
-                        role
-                    (
-                        name, description, bind_to
-                    )
-                    values
-                    (
-                        %(name)s, %(description)s,
-                        (
-                            select id from topic where name = %(bind_to_name)s
-                        )
-                    )
-                    returning
-                        id, name, description, bind_to
-                    """,
-                    """
-                    insert into
-                        topicrole
-                    (
-                        topic_id, role_id, type_id, allow
-                    )
-                    values
-                    (
-                        ( select bind_to from role where name = %(name)s ),
-                        ( select id from role where name = %(name)s ),
-                        'admin',
-                        true
-                    )
-                    returning
-                        id, topic_id, role_id, type_id, allow
-		    """
-                ], qa, options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.role_add(qa)
         # qv[0] contains the result
 
         log.msg("roleAdd returned {}".format(qv))
@@ -511,19 +472,7 @@ class Component(ApplicationSession):
         # that means we have 'admin' womewhere in the heirarchy between the leaf and the root.
         # to do that, we need to get the bind_to topic for the role to be deleted.
 
-        qv = yield self.call(self.query,
-                """
-                    select
-                        t.name
-                      from
-                        topic t,
-                        role r
-		     where
-                        t.id = r.bind_to
-                       and
-                        r.name = %(name)s
-		   """,
-                   qa, options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.role_bind_topic(qa)
         if len(qv) == 0:
             raise Exception("cannot find roles bind_to topic name")
 
@@ -532,64 +481,10 @@ class Component(ApplicationSession):
         if not rv:
             raise Exception("no permission to delete roles bind_to topic")
 
-        qv = yield self.call(self.query,
-                [
-                    """
-                    delete
-                      from
-                        topicrole
-                     where
-                       role_id = (
-                           select id from role where name = %(name)s
-                       )
-                 returning
-                        id, topic_id, role_id
-		    """,
-                    """
-                    delete
-                      from
-                        loginrole
-                     where
-                       role_id = (
-                           select id from role where name = %(name)s
-                       )
-                 returning
-                        id, login_id, role_id
-		    """,
-                    """
-                    delete
-                      from
-                        topicrole
-                     where
-                       topic_id = (
-                           select bind_to from role where name = %(name)s
-                       )
-                 returning
-                        id, topic_id, role_id
-		    """,
-                    """
-                    delete
-                      from
-                        topic
-                     where
-                        id = (
-                           select bind_to from role where name = %(name)s
-                        )
-                 returning
-                        id, name, description
-		    """,
-                    """
-                    delete
-                      from
-                        role
-                     where
-                        name = %(name)s
-                 returning
-                        id, name, description
-		    """
-                   ],
-                   qa, options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.role_delete(qa)
         # qv[0] contains the results as an array of dicts, one dict for each query that ran
+        # the role could be granted anywhere to anyone, so the router starts over.
+        self._invalidate(table='role')
 
         rtitle = [
             "Topic Associations",
@@ -603,40 +498,18 @@ class Component(ApplicationSession):
     @inlineCallbacks
     def topicList(self, *args, **kwargs):
         log.msg("topicList called {}".format(kwargs))
-        qv = yield self.call(self.query,
-                """
-                    with topic_roles as (
-                        select distinct lr.role_id, lr.topic_id, r.name
-                          from topicrole lr, role r
-                         where lr.role_id = r.id
-                        )
-                    select
-                        t.id, t.name, t.description, private.array_accum(u.name) as roles
-		      from
-		        topic t
-           left outer join
-                        topic_roles u on t.id = u.topic_id
-		  group by
-		  	t.id
-		  order by
-		     	t.name
-		   """,
-                   {}, options=types.CallOptions(timeout=2000,discloseMe=True))
-        defer.returnValue(self._format_results(qv))
+        chunk = self._streaming(kwargs)
+        if chunk is not None:
+            rv = yield self._stream(kwargs['details'], chunk,
+                lambda after, limit: self.backend.topic_list(after, limit, columnar=True), 'name')
+            defer.returnValue(rv)
+        qv = yield self.backend.topic_list(columnar=True)
+        defer.returnValue(self._format_results(qv, columns=self._columns(kwargs)))
 
     @inlineCallbacks
     def topicGet(self, *args, **kwargs):
         log.msg("topicGet called {}".format(kwargs))
-        qv = yield self.call(self.query,
-                """
-                    select
-                        name, description, id
-                      from
-                        topic
-		     where
-		     	name = %(name)s
-		   """,
-                   kwargs['action_args'], options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.topic_get(kwargs['action_args'])
         defer.returnValue(self._format_results(qv))
 
     #
@@ -664,36 +537,17 @@ class Component(ApplicationSession):
         log.msg("topicrolePermission: topiclist {}".format(qa['topiclist']))
 
         try:
-            qv = yield self.call(self.query,
-                """
-                select
-                        t.name, length(t.name) as topic_length, tr.allow
-                  from topic as t,
-                        topicrole as tr,
-                        loginrole as lr
-                 where
-                        t.name in %(topiclist)s
-                   and
-                        t.id = tr.topic_id
-                   and
-                        tr.role_id = lr.role_id
-                   and
-                        tr.type_id = %(type_id)s
-                   and
-                        lr.login_id = %(authid)s
-              order by
-                        topic_length
-                """,
-                    qa, options = types.CallOptions(timeout=2000,discloseMe=True))
+            qv = yield self.backend.topicrole_permission(qa)
         except Exception as e:
             log.msg("topicrolePermission: exception {}".format(e))
 
         log.msg("topicrolePermission: initial result {}".format(qv))
 
         # the allow is not coming back as a boolean, coerce here.
+        # postgres says 't', sqlite and mysql say '1'.
         for i in qv:
             if not isinstance(i['allow'], vtypes.BooleanType):
-                if i['allow'] == 't':
+                if i['allow'] in ( 't', '1', ):
                     i['allow'] = True
                 else:
                     i['allow'] = False
@@ -737,21 +591,7 @@ class Component(ApplicationSession):
         if not rv:
             raise Exception("no permission to add a topic in that hierchy")
 
-        qv = yield self.call(self.query,
-                """
-                    insert into
-                        topic
-                    (
-                        name, description
-                    )
-                    values
-                    (
-                        %(name)s, %(description)s
-                    )
-                    returning
-                        id, name, description
-		   """,
-                   qa, options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.topic_add(qa)
         # qv[0] contains the result
         
         defer.returnValue(self._format_results(qv))
@@ -768,31 +608,9 @@ class Component(ApplicationSession):
         if not rv:
             raise Exception("no permission to add a topic in that hierchy")
 
-        qv = yield self.call(self.query,
-                [
-                    """
-                    delete
-                      from
-                        topicrole
-                     where
-                       topic_id = (
-                           select id from topic where name = %(name)s
-                       )
-                 returning
-                        id, topic_id, role_id
-		    """,
-                    """
-                    delete
-                      from
-                        topic
-                     where
-                        name = %(name)s
-                 returning
-                        id, name, description
-		    """
-                   ],
-                   qa, options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.topic_delete(qa)
         # qv[0] contains the results as an array of dicts, one dict for each query that ran
+        self._invalidate(table='topic', topic=qa['name'])
 
         defer.returnValue(self._format_results(qv, ['Topic to role association','Role']))
 
@@ -814,19 +632,7 @@ class Component(ApplicationSession):
         # check to make sure we have admin permission on the role
         # that is going to have the user added.
 
-        qv = yield self.call(self.query,
-                """
-                    select
-                        t.name
-                      from
-                        topic t,
-                        role r
-		     where
-                        t.id = r.bind_to
-                       and
-                        r.name = %(name)s
-		   """,
-                   qa, options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.role_bind_topic(qa)
         if len(qv) == 0:
             raise Exception("cannot find role {}, maybe it was misspelled".format(qa['name']))
 
@@ -843,24 +649,10 @@ class Component(ApplicationSession):
         # insert the record.  if it already exists we will
         # get a duplicate key exception on login_id, role_id.
         #
-        qv = yield self.call(self.query,
-                """
-                    insert into
-                        loginrole
-                    (
-                        login_id,
-                        role_id
-                    )
-                    values
-                    (
-                        ( select id from login where login = %(login)s ),
-                        ( select id from role where name = %(name)s )
-                    )
-                    returning
-                        id, login_id, role_id
-		   """,
-                   qa, options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.userrole_add(qa)
         # qv[0] contains the result
+        for r in qv:
+            self._invalidate(table='loginrole', login_id=r['login_id'])
         
         defer.returnValue(self._format_results(qv))
 
@@ -882,19 +674,7 @@ class Component(ApplicationSession):
         # check to make sure we have admin permission on the role
         # that is going to have the user added.
 
-        qv = yield self.call(self.query,
-                """
-                    select
-                        t.name
-                      from
-                        topic t,
-                        role r
-		     where
-                        t.id = r.bind_to
-                       and
-                        r.name = %(name)s
-		   """,
-                   qa, options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.role_bind_topic(qa)
         if len(qv) == 0:
             raise Exception("cannot find role {}, maybe it was misspelled".format(qa['name']))
 
@@ -906,20 +686,10 @@ class Component(ApplicationSession):
         #
         # delete the record.
         #
-        qv = yield self.call(self.query,
-                """
-                    delete
-                      from
-                        loginrole
-                     where
-                        login_id = ( select id from login where login = %(login)s )
-                       and
-                        role_id = ( select id from role where name = %(name)s )
-                    returning
-                        id, login_id, role_id
-		   """,
-                   qa, options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.userrole_delete(qa)
         # qv[0] contains the result
+        for r in qv:
+            self._invalidate(table='loginrole', login_id=r['login_id'])
         
         defer.returnValue(self._format_results(qv))
 
@@ -940,19 +710,7 @@ class Component(ApplicationSession):
         # check to make sure we have admin permission on the role
         # that is going to have the topic added.
 
-        qv = yield self.call(self.query,
-                """
-                    select
-                        t.name
-                      from
-                        topic t,
-                        role r
-		     where
-                        t.id = r.bind_to
-                       and
-                        r.name = %(name)s
-		   """,
-                   qa, options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.role_bind_topic(qa)
         if len(qv) == 0:
             raise Exception("cannot find role {}, maybe it was misspelled".format(qa['name']))
 
@@ -988,37 +746,13 @@ class Component(ApplicationSession):
                 else:
                     ti = [ ti ]
 
-        qva = []
-        for i in range(len(ti)):
-            type_id = ti[i]
-            qa['type_id_'+str(i)] = type_id
-            nst = """
-                    insert into
-                        topicrole
-                    (
-                        topic_id,
-                        role_id,
-                        type_id,
-                        allow
-                    )
-                    values
-                    (
-                        ( select id from topic where name = %(topic_name)s ),
-                        ( select id from role where name = %(name)s ),
-                        %(type_id_{})s,
-                        true
-                    )
-                    returning
-                        id, topic_id, role_id, type_id, allow
-		   """.format(i)
-            qva.append(nst)
         #
         # insert the record(s).  if they already exists we will
         # get a duplicate key exception on topic_id, role_id, type_id
         #
-        qv = yield self.call(self.query, qva, qa,
-                options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.topicrole_add(qa, ti)
         # qv[0] contains the result
+        self._invalidate(table='topicrole', topic=qa['topic_name'])
         
         defer.returnValue(self._format_results(qv))
 
@@ -1036,19 +770,7 @@ class Component(ApplicationSession):
         # check to make sure we have admin permission on the role
         # that is going to have the topic association deleted.
 
-        qv = yield self.call(self.query,
-                """
-                    select
-                        t.name
-                      from
-                        topic t,
-                        role r
-		     where
-                        t.id = r.bind_to
-                       and
-                        r.name = %(name)s
-		   """,
-                   qa, options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.role_bind_topic(qa)
         if len(qv) == 0:
             raise Exception("cannot find role {}, maybe it was misspelled".format(qa['name']))
 
@@ -1072,7 +794,6 @@ class Component(ApplicationSession):
         # we have admin on the topic, so proceed.
         #
 
-        qva = []
         ti = []
         if not 'activity' in qa:
             # we could run a different query, and just delete all topic/role
@@ -1088,87 +809,78 @@ class Component(ApplicationSession):
                 else:
                     ti = [ ti ]
 
-        for i in range(len(ti)):
-            type_id = ti[i]
-            qa['type_id_'+str(i)] = type_id
-            nst = """
-                    delete
-                      from
-                        topicrole
-                     where
-                        topic_id = ( select id from topic where name = %(topic_name)s )
-                       and
-                        role_id = ( select id from role where name = %(name)s )
-                       and
-                        type_id = %(type_id_{})s
-                    returning
-                        id, topic_id, role_id, type_id, allow
-		   """.format(i)
-            qva.append(nst)
         #
         # delete the record.
         #
-        qv = yield self.call(self.query, qva, qa,
-                options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.topicrole_delete(qa, ti)
         # qv[0] contains the result
+        self._invalidate(table='topicrole', topic=qa['topic_name'])
         
         defer.returnValue(self._format_results(qv))
 
+    #
+    # activityList, every argument is optional
+    #  login      -> only this login's activity
+    #  topic      -> only topics starting with this, like 'com.db'
+    #  type_id    -> a type (call,register,subscribe,publish) or an array of them
+    #  since      -> only activity at or after this time, 'YYYY-MM-DD HH:MM:SS'
+    #  until      -> only activity before this time
+    #  after_id   -> the id of the last row of the previous page
+    #  limit      -> rows per page, default 1000, at most 10000
+    #  stream     -> true to get every row, in chunks (see _streaming), limit is ignored
+    #
+    # pages are in id order.  to get the next page, pass the last id seen as after_id.
+    #
     @inlineCallbacks
     def activityList(self, *args, **kwargs):
         log.msg("activityList called {}".format(kwargs))
-	av = yield self.call(self.svar['topic_base'] + '.session.listid',
-            options=types.CallOptions(timeout=2000,discloseMe=True))
-        if len(av) == 0:
-            defer.returnValue([])
+        qa = kwargs.get('action_args', None) or {}
+        chunk = self._streaming(kwargs)
+        sessions = None
+        routers = None
+        if self.svar.get('multi_router', False):
+            live, epoch = yield self._routers()
+            routers = list(live)
+        else:
+            av = yield self.call(self.svar['topic_base'] + '.session.listid',
+                options=types.CallOptions(timeout=2000,discloseMe=True))
+            sessions = [ int(k) for k in av.keys() ]
+        if (routers if self.svar.get('multi_router', False) else sessions) == []:
+            defer.returnValue([] if chunk is None else { 'rows': 0 })
             return
 
-        active_sessions = av.keys()
-
         # this query picks up active activity, for which there is a current session
         # call, register, publish, subscribe are the interesting activities.
         # this activity could be bound to a session that no longer exists, that is why we
         # pick up the X.session.list from above, that returns just the
-        # active sessions. we use that to filter the list we get back from
-        # this query.  if the database is in sync with the router, then these two will
-        # be identical.  otherwise, if the router has crashed and cleanup hasn't happened,
-        # or is multiple routers are sharing the same sqlauth installation, then there
-        # could be more entries in the database than there is in the router.
-        qv = yield self.call(self.query,
-                """
-                    select
-                        a.id, a.session_id, s.ab_session_id, a.type_id, a.topic_name, l.login,
-                        to_char(a.modified_timestamp,'YYYY-MM-DD HH24:MI:SS') as action_timestamp
-		      from
-		        activity a,
-                        session s,
-                        login l
-                     where
-                        a.session_id = s.id
-                       and
-                        a.allow = true
-                       and
-                        a.type_id in ( 'call', 'register', 'subscribe', 'publish' )
-                       and
-                        s.login_id = l.id
-                       and
-                        s.ab_session_id is not null
-		  order by
-		     	a.id
-		   """,
-                   {}, options=types.CallOptions(timeout=2000,discloseMe=True))
-        if len(qv) == 0:
-            defer.returnValue([])
-            return
-
-        ra = qv[0].keys()
-        rv = []
-        rv.append(ra)
-        for r in qv:
-            if r['ab_session_id'] in active_sessions:
-                rv.append([r.get(c,None) for c in ra])
-
-        defer.returnValue(rv)
+        # active sessions, and only ask for activity in those.  if the database is in sync
+        # with the router, then these two will be identical.  otherwise, if the router has
+        # crashed and cleanup hasn't happened, or is multiple routers are sharing the same
+        # sqlauth installation, then there could be more entries in the database than there
+        # is in the router.  with --multi-router the routers keep track of each other
+        # (router_instance), and the activity of the sessions of every live router is listed.
+        #
+        # when the router only counts activity (sqlauthrouter --activity-rollup) the
+        # counts are read from activity_rollup instead, one row per session, topic and type.
+        ti = qa.get('type_id', None)
+        if isinstance(ti, vtypes.StringTypes):
+            ti = [ ti ]
+        def fetch(after, limit):
+            return self.backend.activity_list(rollup=self.svar.get('rollup', False),
+                sessions=sessions, routers=routers, login=qa.get('login', None),
+                topic=qa.get('topic', None), types=ti,
+                since=qa.get('since', None), until=qa.get('until', None),
+                after_id=after, limit=limit, columnar=True)
+
+        # streamed, every row from after_id on goes out a chunk at a time
+        if chunk is not None:
+            rv = yield self._stream(kwargs['details'], chunk, fetch, 'id', after=qa.get('after_id', None))
+            defer.returnValue(rv)
+
+        qv = yield fetch(qa.get('after_id', None),
+            min(int(qa.get('limit', ACTIVITY_LIMIT)), ACTIVITY_LIMIT_MAX))
+
+        defer.returnValue(self._format_results(qv, columns=self._columns(kwargs)))
 
     # activityAdd
     #  ab_session_id  -> the autobahn session id
@@ -1179,32 +891,46 @@ class Component(ApplicationSession):
     def activityAdd(self, *args, **kwargs):
         log.msg("activityAdd called {}".format(kwargs))
         qa = kwargs['action_args']
-        qv = yield self.call(self.query,
-                """
-                    insert into
-                        activity
-                    (
-                        session_id,topic_name,type_id,allow
-                    )
-                    values
-                    (
-                        (
-                            select
-                                    id
-                              from
-                                    session
-                             where
-                                    ab_session_id = %(ab_session_id)s
-                        ),
-                        %(topic_name)s, %(type_id)s, %(allow)s
-                    )
-                    returning
-                        id,session_id,topic_name,type_id,allow,%(ab_session_id)s as ab_session_id
-                """,
-                   qa, options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.activity_add(qa)
 
         defer.returnValue(self._format_results(qv))
 
+    # activityAddBatch
+    #  activity       -> array of activities, each one a dictionary with the
+    #                    same keys activityAdd takes (ab_session_id, topic_name, type_id, allow)
+    #
+    # the router's activity writer queues activities and sends them here in
+    # batches.  the whole batch is a single insert, the count is returned.
+    @inlineCallbacks
+    def activityAddBatch(self, *args, **kwargs):
+        qa = kwargs['action_args']
+        log.msg("activityAddBatch called {} activities".format(len(qa['activity'])))
+        if len(qa['activity']) == 0:
+            defer.returnValue([])
+
+        qv = yield self.backend.activity_addbatch(qa['activity'])
+
+        defer.returnValue(self._format_results(qv))
+
+    # activityRollup
+    #  activity       -> array of counters, each one a dictionary with
+    #                    ab_session_id, topic_name, type_id, allow, count,
+    #                    first_seen and last_seen (seconds since the epoch)
+    #
+    # the router's activity rollup sends the counts it has gathered since the
+    # last time.  counters that already have a row are added to it, the rest
+    # are inserted.  both statements run in the same transaction.
+    @inlineCallbacks
+    def activityRollup(self, *args, **kwargs):
+        qa = kwargs['action_args']
+        log.msg("activityRollup called {} counters".format(len(qa['activity'])))
+        if len(qa['activity']) == 0:
+            defer.returnValue([])
+
+        qv = yield self.backend.activity_rollup(qa['activity'])
+
+        defer.returnValue(self._format_results(qv, self.backend.rollup_titles))
+
 
     #
     # this builds a list of sessions.  Two sources for the list are used, and
@@ -1214,83 +940,90 @@ class Component(ApplicationSession):
     # in both places. The list can be inconsistent if:
     # 1) the data exists in the database but not in memory.  This can occur on
     #    a Autobahn router restart.  The router should set all ab_session_id to null
-    #    on startup (they can get this way if the router crashed).
+    #    on startup (they can get this way if the router crashed).  These orphans are
+    #    left out of the list, with cleanup true in action_args they are closed
+    #    (ab_session_id set to null).
     # 2) the data exists in memory but not the database.  This would indicate there is
     #    a problem writing to the database?  I am not sure why this would happen.
+    #    These are listed with a warning of '*'.
+    # with --multi-router the sessions of the other live routers are listed as the
+    # database has them, only this router's are compared.
     #
     @inlineCallbacks
     def sessionList(self, *args, **kwargs):
-        log.msg("sessionList()")
+        qa = kwargs.get('action_args', None) or {}
         sidkeys = yield self.call('sys.session.listid')
-        log.msg("sessionList:sidkeys {}".format(sidkeys))
-
-        qv = yield self.call(self.query,
-                """select s.login_id,s.ab_session_id,s.tzname,
-                          to_char(s.created_timestamp,'YYYY-MM-DD HH24:MI:SS') as started,
-                          to_char(now() - s.created_timestamp, 'HH24:MI:SS') as duration,
-                          s.id,
-                          l.login,
-                          l.fullname
-                     from session s,
-                          login l
-                   where l.id = s.login_id
-                     and s.ab_session_id is not null""",
-                   {}, options=types.CallOptions(timeout=2000,discloseMe=True))
-        rv = {}
-        for k in qv:
-	    sid = k['ab_session_id']
-            log.msg("sessionList:qv.key({})".format(sid))
-	    if sid in sidkeys:
-	        rv[sid] = k
-	    else:
-                log.msg("sessionList:warning")
-	        k['warning'] = '!'
-                log.msg("sessionList: db has extra sessions, should set ab_session_id null:{}, authid: {}!".format(sid,k['login_id']),
+        log.msg("sessionList() {} sessions in the router".format(len(sidkeys)))
+        live = set(sidkeys.keys())
+        others = set()
+        cleanup = qa.get('cleanup', False)
+        if self.svar.get('multi_router', False):
+            routers, epoch = yield self._routers()
+            others = routers - set([ epoch ])
+            if cleanup and not epoch in routers:
+                # router_instance is missing, empty or hasn't seen our router,
+                # another router's sessions would look like orphans
+                log.msg("sessionList: router {} isn't in router_instance, no cleanup".format(epoch),
                     logLevel = logging.WARNING)
-                #uncomment this if we want to see invalid sessions, they were probably left there
-                #after an unplanned stop of the Autobahn router.  These should be set to null
-                #before starting the router, with the statement:
-                #update session set ab_session_id = null wher ab_session_id is not null
-                #after that, then start the router.
-	        #rv[sid] = k
-        rvkeys = rv.keys()
-        log.msg("sessionList:rvkeys {}".format(rvkeys))
-        for k in sidkeys:
-	    if k in rvkeys:
-                log.msg("sessionList:continue")
-	        continue
-            log.msg("sessionList:on {}".format(k))
-            sib = sidkeys[k]
-            log.msg("sessionList: session in memory but not in db, this can happen if sessions are deleted while running the Autobahn router, ab_session_id:{}, authid: {}!".format(k,sib['authid']),
-                logLevel = logging.WARNING)
-            rv[k] = { 'ab_session_id':k,
-                      'login_id': sib['authid'],
-		      'warning': '*'}
-
-        log.msg("sessionList:Ended up with {}".format(rv.values()))
-
-        defer.returnValue(self._format_results(rv.values(), fullscan=True))
+                cleanup = False
+
+        # streamed, the database's sessions a chunk at a time, then the ones
+        # only the router has.
+        chunk = self._streaming(kwargs)
+        if chunk is not None:
+            indb = set()
+            def keep(k, headers):
+                if k[headers.index('router_epoch')] in others:
+                    return True
+                sid = k[headers.index('ab_session_id')]
+                indb.add(sid)
+                return sid in live
+            rv = yield self._stream(kwargs['details'], chunk,
+                lambda after, limit: self.backend.session_list(after, limit, columnar=True), 'id', keep=keep)
+            mv = self._sessionMissing(sidkeys, live - indb)
+            if len(mv) > 0:
+                kwargs['details'].progress(self._columnize(mv))
+            rv['rows'] += len(mv)
+            yield self._sessionReconcile(rv['rows'], indb - live, len(mv), cleanup)
+            defer.returnValue(rv)
+
+        qv = yield self.backend.session_list()
+        indb = set([ k['ab_session_id'] for k in qv if not k['router_epoch'] in others ])
+        rv = [ k for k in qv if k['router_epoch'] in others or k['ab_session_id'] in live ]
+        mv = self._sessionMissing(sidkeys, live - indb)
+        rv.extend(mv)
+        yield self._sessionReconcile(len(rv), indb - live, len(mv), cleanup)
+
+        defer.returnValue(self._format_results(rv, fullscan=True))
+
+    # the rows for sessions the router has and the database doesn't
+    def _sessionMissing(self, sidkeys, missing):
+        return [ { 'ab_session_id':k,
+                   'login_id': sidkeys[k]['authid'],
+                   'warning': '*'} for k in missing ]
+
+    #
+    # one line about how the database and the router compare, and with
+    # cleanup the orphans (open in the database only) are closed
+    #
+    @inlineCallbacks
+    def _sessionReconcile(self, listed, orphans, missing, cleanup):
+        closed = 0
+        if cleanup and len(orphans) > 0:
+            closed = yield self.backend.session_orphans_close(orphans)
+        level = logging.INFO
+        if len(orphans) > closed or missing > 0:
+            level = logging.WARNING
+        log.msg("sessionList: {} listed, {} only in the database ({} closed), {} only in the router".format(
+            listed, len(orphans), closed, missing), logLevel = level)
+
+        return
 
     @inlineCallbacks
     def sessionAdd(self, *args, **kwargs):
         log.msg("sessionAdd called {}".format(kwargs))
         qa = kwargs['action_args']
-        qv = yield self.call(self.query,
-                """
-                    insert into
-                        session
-                    (
-                        login_id, ab_session_id, tzname
-                    )
-                    values
-                    (
-                        %(login_id)s, %(ab_session_id)s,
-                        ( select tzname from login where id = %(login_id)s )
-                    )
-                    returning
-                        id, login_id, ab_session_id, tzname
-		   """,
-                   qa, options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.session_add(qa)
 
         defer.returnValue(self._format_results(qv))
 
@@ -1298,18 +1031,7 @@ class Component(ApplicationSession):
     def sessionDelete(self, *args, **kwargs):
         log.msg("sessionDelete called {}".format(kwargs))
         qa = kwargs['action_args']
-        qv = yield self.call(self.query,
-                """
-                    update
-                        session
-                       set
-                        ab_session_id = null
-                     where
-                        ab_session_id = %(ab_session_id)s
-                    returning
-                        id, login_id
-		   """,
-                   qa, options=types.CallOptions(timeout=2000,discloseMe=True))
+        qv = yield self.backend.session_delete(qa)
 
         defer.returnValue(self._format_results(qv))
 
@@ -1325,12 +1047,17 @@ class Component(ApplicationSession):
         # done.  but, since we authenticate before we register these
         # routines that record the session, we need to do this now. make sense?
         # also, we want to do this before we do any actions, like register, so
-        # that our activity tracker will work.
+        # that our activity tracker will work.  a router running --direct has
+        # recorded these sessions itself already, they are only added if missing.
+        # they carry the router's epoch, like the ones it records, so that they
+        # are closed with the router's and not before (see router_reap).
         #
-        log.msg("onJoin add our session record {}:{},{}".format(
-            self.svar['topic_base']+'.session.add', details.authid, details.session))
-        rv = yield self.sessionAdd( action_args={ 'login_id':details.authid, 'ab_session_id':details.session })
-        log.msg("onJoin added late session record {}".format(rv))
+        epoch = yield self._epoch()
+        log.msg("onJoin add our session record {}:{},{},{}".format(
+            self.svar['topic_base']+'.session.add', details.authid, details.session, epoch))
+        rv = yield self.backend.session_add_missing({ 'login_id':details.authid, 'ab_session_id':details.session,
+            'router_epoch':epoch })
+        log.msg("onJoin added late session record")
         #
         # just a little more goofiness, there are a few sessions set up by the authentication, authorization,
         # and database components connected to the main router.  We now query for those sessions
@@ -1339,7 +1066,8 @@ class Component(ApplicationSession):
         sysses = yield self.call('sys.session.listsysid')
         log.msg("onJoin :sysses {}".format(sysses))
         for dt in sysses.values():
-            rv = yield self.sessionAdd( action_args={ 'login_id':details.authid, 'ab_session_id':dt })
+            rv = yield self.backend.session_add_missing({ 'login_id':details.authid, 'ab_session_id':dt,
+                'router_epoch':epoch })
 
         # call the activityAdd manually, first, so we catch all of the registrations
         # in the activity table
@@ -1369,6 +1097,8 @@ class Component(ApplicationSession):
             'topicrole.add': {'method': self.topicroleAdd },
             'topicrole.delete': {'method': self.topicroleDelete },
             'activity.list': {'method': self.activityList },
+            'activity.addbatch': {'method': self.activityAddBatch },
+            'activity.rollup': {'method': self.activityRollup },
             'session.list': {'method': self.sessionList },
             'session.add': {'method': self.sessionAdd },
             'session.delete': {'method': self.sessionDelete },
@@ -1413,8 +1143,9 @@ def run():
     def_realm = 'realm1'
     def_topic_base = 'sys'
     def_action_args = '{}'
+    def_engine = 'PG9_4'
 
-    p = argparse.ArgumentParser(description="sqlauthrpc postgres backend rpc definitions")
+    p = argparse.ArgumentParser(description="sqlauthrpc backend rpc definitions")
 
     p.add_argument('-w', '--websocket', action='store', dest='wsocket', default=def_wsocket,
                         help='web socket definition, default is: '+def_wsocket)
@@ -1428,10 +1159,20 @@ def run():
                         help='users "secret" password')
     p.add_argument('-t', '--topic', action='store', dest='topic_base', default=def_topic_base,
                         help='if you specify --dsn then you will need a topic to root it on, the default ' + def_topic_base + ' is fine.')
+    p.add_argument('-e', '--engine', action='store', dest='engine', default=def_engine,
+                        help='database engine, PG9_4, SQLITE3 or MYSQL (SQLITE3 and MYSQL need --dsn), default is: '+def_engine)
+    p.add_argument('-d', '--dsn', action='store', dest='dsn', default=None,
+                        help='run the sql here instead of through sqlbridge, like database=/var/lib/sqlauth/auth.db for sqlite.  required for SQLITE3 and MYSQL')
+    p.add_argument('--activity-rollup', action='store_true', dest='rollup',
+            default=False, help='activity.list reads the activity_rollup counts, use this when the router runs with --activity-rollup')
+    p.add_argument('--multi-router', action='store_true', dest='multi_router',
+            default=False, help='several routers share the database (they run with --heartbeat), session.list and activity.list cover all of the live ones')
 
     args = p.parse_args()
     if args.verbose:
        log.startLogging(sys.stdout)
+    if args.dsn is None and not get_backend(args.engine).bridge:
+        p.error("engine {} needs --dsn, only postgres runs through sqlbridge".format(args.engine))
 
     component_config = types.ComponentConfig(realm=args.realm)
     ai = {
@@ -1441,7 +1182,8 @@ def run():
             }
 
     mdb = Component(config=component_config,
-            authinfo=ai,topic_base=args.topic_base,debug=args.verbose)
+            authinfo=ai,topic_base=args.topic_base,debug=args.verbose,rollup=args.rollup,
+            engine=args.engine,dsn=args.dsn,multi_router=args.multi_router)
     runner = ApplicationRunner(args.wsocket, args.realm)
     runner.run(lambda _: mdb)
 
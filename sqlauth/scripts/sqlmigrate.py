@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## sqlmigrate.py - bring the sqlauth schema up to date
+##
+## lists the migrations (sqlauth.backend.migrate) the database doesn't have
+## yet, applies them with --apply (--partition for the one that partitions
+## activity on postgres 13 or later), and with --check runs EXPLAIN on the hot
+## path queries to make sure each one gets an index.  --seed fills a scratch
+## database with enough rows for the check to mean something.
+###############################################################################
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys, os, argparse
+from tabulate import tabulate
+
+from twisted.python import log
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet import defer
+
+from sqlauth.backend import migrate
+from sqlauth.twisted.directdb import DirectDb
+
+@inlineCallbacks
+def migrate_db(reactor, args):
+    db = DirectDb(args.engine, args.dsn, 'sys', prepare=False)
+    m = migrate.Migrator(db.backend, options=( 'partition', ) if args.partition else ())
+    rv = 0
+    try:
+        cv = yield m.current()
+        ml = yield m.pending()
+        print("schema version {}, {} pending".format(cv, len(ml)))
+        for i in ml:
+            print("  {}".format(i))
+            for st in i.steps:
+                print("    {}".format(st))
+        wl = yield m.waiting()
+        for i in wl:
+            print("  {}, not applied".format(i))
+        if args.apply and len(ml) > 0:
+            yield m.apply()
+            cv = yield m.current()
+            print("schema version is now {}".format(cv))
+        if args.seed > 0:
+            yield migrate.seed(db.backend, logins=args.seed)
+        if args.check:
+            cl = yield m.check()
+            print(tabulate([ [ c['query'], 'ok' if c['ok'] else 'SCAN', ', '.join(c['scans']) ] for c in cl ],
+                headers=[ 'query', 'plan', 'scanned' ]))
+            if len([ c for c in cl if not c['ok'] ]) > 0:
+                rv = 1
+    finally:
+        db.close()
+    sys.exit(rv)
+
+def run():
+    prog = os.path.basename(__file__)
+
+    def_engine = 'PG9_4'
+    def_seed = 0
+
+    p = argparse.ArgumentParser(description="sqlmigrate list, apply and check sqlauth schema migrations")
+
+    p.add_argument('-e', '--engine', action='store', dest='engine', default=def_engine,
+                        help='database engine, PG9_4, SQLITE3 or MYSQL, default is: '+def_engine)
+    p.add_argument('-d', '--dsn', action='store', dest='dsn', required=True,
+                        help='the database, like dbname=autobahn host=localhost user=autouser')
+    p.add_argument('-a', '--apply', action='store_true', dest='apply',
+            default=False, help='apply the pending migrations (if not specified, they are listed but not applied)')
+    p.add_argument('--partition', action='store_true', dest='partition',
+            default=False, help='with --apply, also partition activity by day, postgres 13 or later, it rewrites the table')
+    p.add_argument('-c', '--check', action='store_true', dest='check',
+            default=False, help='EXPLAIN the hot path queries, exit 1 if any of them scans a table it should not')
+    p.add_argument('--seed', action='store', dest='seed', type=int, default=def_seed,
+                        help='add this many seed_ logins (with roles, topics, sessions and activity) first, for a scratch database only')
+    p.add_argument('-v', '--verbose', action='store_true', dest='verbose',
+            default=False, help='Verbose logging for debugging')
+
+    args = p.parse_args()
+    if args.verbose:
+       log.startLogging(sys.stdout)
+
+    task.react(migrate_db, [ args ])
+
+
+if __name__ == '__main__':
+   run()
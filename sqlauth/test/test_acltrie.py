@@ -0,0 +1,185 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## test_acltrie.py - AclTrie answers what the permission query answers
+##
+## random logins, roles, topics and grants go into an in memory sqlite
+## database with the sqlauth schema.  then for every login, uri and action
+## AclTrie.check is compared with AuthorizeRouter.check_permission, which
+## runs statements.PERMISSION_QUERY on the same database.  some of the
+## grants are an allow and a deny on the same topic for the same login (deny
+## wins), and some logins have no role at all.
+###############################################################################
+
+import os
+import random
+import sqlite3
+import unittest
+
+from twisted.internet import defer
+
+import sqlauth
+from sqlauth.twisted.acltrie import AclTrie, ACTIONS
+from sqlauth.twisted.authorizerouter import AuthorizeRouter
+from sqlauth.twisted.directdb import DirectDb, _text
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(sqlauth.__file__))),
+    'config', 'SQLITE.sql')
+SEGMENTS = ( 'a', 'b', 'c', )
+DEPTH = 3
+ROLES = 6
+LOGINS = 10
+
+class Sqlite(object):
+    """
+    the query calls AclTrie and check_permission make, on a sqlite connection
+    """
+
+    # the statements are rewritten the way DirectDb does it
+    paramstyle = 'named'
+    _prepare = DirectDb.__dict__['_prepare']
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def call(self, procedure, s, a=None, options=None):
+        s, a = self._prepare(s, a)
+        cur = self.conn.execute(s, a)
+        names = [ d[0] for d in cur.description ]
+        return defer.succeed([ dict(zip(names, [ _text(v) for v in r ])) for r in cur.fetchall() ])
+
+# the result of a deferred that has already fired
+def result(d):
+    rv = []
+    d.addBoth(rv.append)
+    if hasattr(rv[0], 'raiseException'):
+        rv[0].raiseException()
+    return rv[0]
+
+# every topic of the tree, a, a.a, a.a.a ... c.c.c
+def topics():
+    rv = []
+    level = [ '' ]
+    for i in range(DEPTH):
+        level = [ (p + '.' if p else '') + s for p in level for s in SEGMENTS ]
+        rv.extend(level)
+    return rv
+
+class AclTrieTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        with open(SCHEMA) as f:
+            self.conn.executescript(f.read())
+        self.conn.executemany("insert into activity_type ( id, name ) values ( ?, ? )",
+            [ ( a, a ) for a in ACTIONS ])
+        self.db = Sqlite(self.conn)
+        self.router = AuthorizeRouter(None, u'realm1', topic_base='sys.db', direct=self.db)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def seed(self, r):
+        c = self.conn
+        for i in range(ROLES):
+            c.execute("insert into role ( name ) values ( ? )", ( 'role' + str(i), ))
+        role_ids = [ v[0] for v in c.execute("select id from role") ]
+        for i in range(LOGINS):
+            c.execute("insert into login ( login, password ) values ( ?, 'x' )", ( 'user' + str(i), ))
+        login_ids = [ v[0] for v in c.execute("select id from login") ]
+        # the first two logins have no role
+        for l in login_ids[2:]:
+            for role_id in r.sample(role_ids, r.randint(1, 3)):
+                c.execute("insert into loginrole ( login_id, role_id ) values ( ?, ? )", ( l, role_id ))
+        for t in r.sample(topics(), len(topics()) // 2):
+            c.execute("insert into topic ( name ) values ( ? )", ( t, ))
+        self.grants(r, role_ids, 60)
+
+        return login_ids
+
+    # n random grants, a third of them with the opposite grant alongside
+    def grants(self, r, role_ids, n, topic_ids=None):
+        c = self.conn
+        if topic_ids is None:
+            topic_ids = [ v[0] for v in c.execute("select id from topic") ]
+        for i in range(n):
+            row = [ r.choice(topic_ids), r.choice(role_ids), r.choice(ACTIONS), r.random() < 0.7 ]
+            rows = [ row ]
+            if r.random() < 0.3:
+                # the same role, or another one the login may also have
+                rows.append([ row[0], r.choice(( row[1], r.choice(role_ids), )), row[2], not row[3] ])
+            for v in rows:
+                c.execute("""insert or ignore into topicrole ( topic_id, role_id, type_id, allow )
+                    values ( ?, ?, ?, ? )""", v)
+
+        return
+
+    def uris(self):
+        rv = topics()
+        rv.extend([ t + '.leaf' for t in topics() ])
+        rv.extend([ 'x', 'x.a', 'a.x.b' ])
+        return rv
+
+    def compare(self, trie, login_ids):
+        checked = 0
+        for authid in login_ids + [ 9999 ]:
+            for uri in self.uris():
+                for action in ACTIONS + ( 'start', ):
+                    want = result(self.router.check_permission(authid, uri, action))
+                    self.assertEqual(trie.check(authid, uri, action), want,
+                        "login {} {} {}: the query says {}".format(authid, uri, action, want))
+                    checked += 1
+        return checked
+
+    def test_load(self):
+        for seed in range(5):
+            if seed > 0:
+                self.tearDown()
+                self.setUp()
+            r = random.Random(seed)
+            login_ids = self.seed(r)
+            trie = AclTrie(topic_base='sys.db', app_session=self.db)
+            result(trie.load())
+            self.assertTrue(trie.loaded)
+            self.assertTrue(self.compare(trie, login_ids) > 0)
+
+    # the incremental refreshes the change notices trigger
+    def test_invalidate(self):
+        r = random.Random(100)
+        login_ids = self.seed(r)
+        role_ids = [ v[0] for v in self.conn.execute("select id from role") ]
+        trie = AclTrie(topic_base='sys.db', app_session=self.db)
+        result(trie.load())
+        for i in range(5):
+            # the grants under one top level topic change
+            top = r.choice(SEGMENTS)
+            below = [ v[0] for v in self.conn.execute("select id from topic where name = ? or name like ?",
+                ( top, top + '.%' )) ]
+            if not below:
+                continue
+            self.conn.execute("delete from topicrole where topic_id = ?", ( r.choice(below), ))
+            self.grants(r, role_ids, 10, below)
+            result(trie.invalidate(topic=top))
+            # and one login's roles
+            login_id = r.choice(login_ids)
+            self.conn.execute("delete from loginrole where login_id = ?", ( login_id, ))
+            for role_id in r.sample(role_ids, r.randint(0, 2)):
+                self.conn.execute("insert into loginrole ( login_id, role_id ) values ( ?, ? )", ( login_id, role_id ))
+            result(trie.invalidate(login_id=login_id))
+            self.compare(trie, login_ids)
@@ -0,0 +1,220 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## test_activitywriter.py - ActivityWriter's queue, drops, inflight limit,
+## and flush_session, and ActivityRollup's counters
+##
+## the flush function hands back deferreds the test fires itself, so every
+## write is in flight until the test says it is done.
+###############################################################################
+
+import unittest
+
+from twisted.internet import defer
+
+from sqlauth.twisted.activitywriter import ActivityWriter, ActivityRollup
+
+class Flush(object):
+    """
+    a flush function whose writes finish when the test says so
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.deferreds = []
+
+    def __call__(self, batch):
+        d = defer.Deferred()
+        self.batches.append(batch)
+        self.deferreds.append(d)
+        return d
+
+    def finish(self, i=0, fail=False):
+        d = self.deferreds[i]
+        if fail:
+            d.errback(Exception("write failed"))
+        else:
+            d.callback([])
+
+def record(sid, n=0):
+    return { 'ab_session_id': sid, 'topic_name': 't' + str(n), 'type_id': 'call', 'allow': True }
+
+class ActivityWriterTest(unittest.TestCase):
+
+    def test_batch_size(self):
+        f = Flush()
+        w = ActivityWriter(f, batch_size=3)
+        for i in range(7):
+            w.add(record(1, i))
+        self.assertEqual([ len(b) for b in f.batches ], [ 3, 3 ])
+        self.assertEqual(len(w.pending), 1)
+        f.finish(0)
+        f.finish(1)
+        self.assertEqual(w.stats()['written'], 6)
+        self.assertEqual(w.inflight, 0)
+
+    def test_drop_newest(self):
+        f = Flush()
+        w = ActivityWriter(f, batch_size=100, max_pending=3, drop='newest')
+        rv = [ w.add(record(1, i)) for i in range(5) ]
+        self.assertEqual(rv, [ True, True, True, False, False ])
+        self.assertEqual([ r['topic_name'] for r in w.pending ], [ 't0', 't1', 't2' ])
+        self.assertEqual(w.dropped, 2)
+
+    def test_drop_oldest(self):
+        f = Flush()
+        w = ActivityWriter(f, batch_size=100, max_pending=3, drop='oldest')
+        for i in range(5):
+            self.assertTrue(w.add(record(i, i)))
+        self.assertEqual([ r['topic_name'] for r in w.pending ], [ 't2', 't3', 't4' ])
+        self.assertEqual(w.dropped, 2)
+        # the dropped sessions have nothing queued any more
+        self.assertEqual(sorted(w.queued.keys()), [ 2, 3, 4 ])
+
+    def test_bad_drop(self):
+        self.assertRaises(Exception, ActivityWriter, Flush(), drop='middle')
+
+    def test_inflight(self):
+        f = Flush()
+        w = ActivityWriter(f, batch_size=2, max_inflight=2)
+        for i in range(8):
+            w.add(record(1, i))
+        # two writes out, the rest waits for one of them
+        self.assertEqual(len(f.batches), 2)
+        self.assertEqual(len(w.pending), 4)
+        w.flush()
+        self.assertEqual(len(f.batches), 2)
+        f.finish(0)
+        w.flush()
+        self.assertEqual(len(f.batches), 3)
+
+    def test_failed(self):
+        f = Flush()
+        w = ActivityWriter(f, batch_size=2)
+        w.add(record(1))
+        w.add(record(1))
+        f.finish(0, fail=True)
+        self.assertEqual(w.stats()['failed'], 2)
+        self.assertEqual(w.inflight, 0)
+        self.assertEqual(len(w.writing), 0)
+
+    def test_stop(self):
+        f = Flush()
+        w = ActivityWriter(f, batch_size=2, max_inflight=1)
+        for i in range(5):
+            w.add(record(1, i))
+        d = w.stop()
+        # stop writes everything, max_inflight or not
+        self.assertEqual([ len(b) for b in f.batches ], [ 2, 2, 1 ])
+        fired = []
+        d.addCallback(fired.append)
+        for i in range(3):
+            f.finish(i)
+        self.assertEqual(len(fired), 1)
+
+    def test_flush_session(self):
+        f = Flush()
+        w = ActivityWriter(f, batch_size=4, max_inflight=1)
+        for i in range(4):
+            w.add(record(i % 2, i))
+        # one write in flight with the first four, more of session 1 queued
+        w.add(record(1, 4))
+        w.add(record(2, 5))
+        w.add(record(1, 6))
+        self.assertEqual(w.queued, { 1: 2, 2: 1 })
+        fired = []
+        w.flush_session(1).addCallback(fired.append)
+        # session 1's records go out now, in spite of max_inflight
+        self.assertEqual([ r['topic_name'] for r in f.batches[1] ], [ 't4', 't6' ])
+        self.assertEqual([ r['topic_name'] for r in w.pending ], [ 't5' ])
+        self.assertEqual(w.queued, { 2: 1 })
+        # and it waits for them and for the write that was already out
+        f.finish(1)
+        self.assertEqual(fired, [])
+        f.finish(0)
+        self.assertEqual(len(fired), 1)
+
+    def test_flush_session_nothing(self):
+        f = Flush()
+        w = ActivityWriter(f, batch_size=4)
+        fired = []
+        w.flush_session(9).addCallback(fired.append)
+        self.assertEqual(len(fired), 1)
+        self.assertEqual(f.batches, [])
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class ActivityRollupTest(unittest.TestCase):
+
+    def counters(self, batch):
+        return sorted([ ( r['ab_session_id'], r['topic_name'], r['count'], r['first_seen'], r['last_seen'], )
+            for r in batch ])
+
+    def test_counts(self):
+        f = Flush()
+        c = Clock()
+        w = ActivityRollup(f, clock=c)
+        w.add(record(1, 0))
+        c.now += 5
+        w.add(record(1, 0))
+        w.add(record(1, 1))
+        w.add(record(2, 0))
+        self.assertEqual(w.stats()['counters'], 3)
+        w.flush()
+        self.assertEqual(self.counters(f.batches[0]), [
+            ( 1, 't0', 2, 1000.0, 1005.0, ), ( 1, 't1', 1, 1005.0, 1005.0, ), ( 2, 't0', 1, 1005.0, 1005.0, ) ])
+        self.assertEqual(w.stats()['counters'], 0)
+        f.finish(0)
+        self.assertEqual(w.written, 3)
+
+    def test_max_keys(self):
+        f = Flush()
+        w = ActivityRollup(f, max_keys=3, clock=Clock())
+        for i in range(5):
+            w.add(record(1, i % 2))
+        self.assertEqual(f.batches, [])
+        w.add(record(2, 0))
+        self.assertEqual(len(f.batches), 1)
+        self.assertEqual(w.keys, 0)
+
+    def test_flush_session(self):
+        f = Flush()
+        w = ActivityRollup(f, clock=Clock())
+        w.add(record(1, 0))
+        w.flush()
+        w.add(record(1, 0))
+        w.add(record(1, 1))
+        w.add(record(2, 0))
+        fired = []
+        w.flush_session(1).addCallback(fired.append)
+        # only session 1's counters go, session 2 waits for the interval
+        self.assertEqual(self.counters(f.batches[1]), [ ( 1, 't0', 1, 1000.0, 1000.0, ), ( 1, 't1', 1, 1000.0, 1000.0, ) ])
+        self.assertEqual(w.keys, 1)
+        self.assertEqual(list(w.counts.keys()), [ 2 ])
+        # and it waits for the flush that was out already
+        f.finish(1)
+        self.assertEqual(fired, [])
+        f.finish(0)
+        self.assertEqual(len(fired), 1)
+        self.assertEqual(len(w.writing), 0)
@@ -0,0 +1,164 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## test_cache.py - LruCache expiry and eviction, PermissionCache
+## invalidation and generations, SessionMemo
+###############################################################################
+
+import unittest
+
+from sqlauth.twisted.cache import LruCache, PermissionCache, SessionMemo, topic_covers
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class LruCacheTest(unittest.TestCase):
+
+    def test_ttl(self):
+        c = Clock()
+        lc = LruCache(size=10, ttl=60, clock=c)
+        lc.set('a', 1)
+        lc.set('b', 2, ttl=10)
+        c.now += 9.9
+        self.assertEqual(lc.get('a'), 1)
+        self.assertEqual(lc.get('b'), 2)
+        c.now += 0.1
+        self.assertEqual(lc.get('b', 'gone'), 'gone')
+        # an expired entry is taken out when it is found
+        self.assertEqual(len(lc), 1)
+        c.now += 50
+        self.assertFalse('a' in lc)
+
+    def test_no_ttl(self):
+        c = Clock()
+        lc = LruCache(size=10, ttl=0, clock=c)
+        lc.set('a', 1)
+        c.now += 1000000
+        self.assertEqual(lc.get('a'), 1)
+
+    def test_eviction(self):
+        lc = LruCache(size=3, ttl=0)
+        for k in ( 'a', 'b', 'c', ):
+            lc.set(k, k)
+        # a is used, so b is the least recently used
+        lc.get('a')
+        lc.set('d', 'd')
+        self.assertEqual(sorted(lc._entries.keys()), [ 'a', 'c', 'd' ])
+        # setting again counts as a use
+        lc.set('c', 'C')
+        lc.set('e', 'e')
+        self.assertEqual(sorted(lc._entries.keys()), [ 'c', 'd', 'e' ])
+        self.assertEqual(lc.stats()['evictions'], 2)
+
+    def test_stats(self):
+        lc = LruCache(size=3, ttl=0)
+        lc.set('a', 1)
+        lc.get('a')
+        lc.get('b')
+        st = lc.stats()
+        self.assertEqual(( st['hits'], st['misses'], st['size'], ), ( 1, 1, 1, ))
+
+    def test_delete_matching(self):
+        lc = LruCache(size=10, ttl=0)
+        for i in range(6):
+            lc.set(i, i)
+        self.assertEqual(lc.delete_matching(lambda k: k % 2 == 0), 3)
+        self.assertEqual(sorted(lc._entries.keys()), [ 1, 3, 5 ])
+
+class PermissionCacheTest(unittest.TestCase):
+
+    def fill(self, pc):
+        for authid in ( 1, 2, ):
+            for uri in ( 'com', 'com.db', 'com.db.x', 'com.dbx', ):
+                pc.put(authid, uri, 'call', True)
+
+    def test_topic_covers(self):
+        self.assertTrue(topic_covers('com', 'com'))
+        self.assertTrue(topic_covers('com', 'com.db'))
+        self.assertFalse(topic_covers('com.db', 'com.dbx'))
+
+    def test_invalidate_topic(self):
+        pc = PermissionCache(size=100, ttl=0)
+        self.fill(pc)
+        pc.invalidate(topic='com.db')
+        self.assertEqual(sorted(pc._entries.keys()), [ ( 1, 'com', 'call', ), ( 1, 'com.dbx', 'call', ),
+            ( 2, 'com', 'call', ), ( 2, 'com.dbx', 'call', ) ])
+
+    def test_invalidate_login(self):
+        pc = PermissionCache(size=100, ttl=0)
+        self.fill(pc)
+        # notices carry the id as a string or a number
+        pc.invalidate(login_id='1')
+        self.assertEqual(set([ k[0] for k in pc._entries.keys() ]), set([ 2 ]))
+
+    def test_invalidate_all(self):
+        pc = PermissionCache(size=100, ttl=0)
+        self.fill(pc)
+        pc.invalidate()
+        self.assertEqual(len(pc), 0)
+
+    def test_login_table(self):
+        pc = PermissionCache(size=100, ttl=0)
+        self.fill(pc)
+        g = pc.generation
+        pc.invalidate(table='login', login_id=1)
+        self.assertEqual(len(pc), 8)
+        self.assertEqual(pc.generation, g)
+
+    def test_generation(self):
+        c = Clock()
+        pc = PermissionCache(size=100, ttl=60, clock=c)
+        g = pc.generation
+        pc.invalidate(topic='com')
+        # a lookup that started before the invalidation doesn't get stored
+        pc.put(1, 'com.db', 'call', True, generation=g)
+        self.assertEqual(pc.lookup(1, 'com.db', 'call'), None)
+        pc.put(1, 'com.db', 'call', False, generation=pc.generation)
+        self.assertEqual(pc.lookup(1, 'com.db', 'call'), False)
+        c.now += 60
+        self.assertEqual(pc.lookup(1, 'com.db', 'call', 'expired'), 'expired')
+
+class SessionMemoTest(unittest.TestCase):
+
+    def test_generation(self):
+        m = SessionMemo(size=10)
+        # the first lookup takes on the generation
+        self.assertEqual(m.lookup('a', 'call', 1), None)
+        m.put('a', 'call', True, 1)
+        self.assertEqual(m.lookup('a', 'call', 1), True)
+        # a decision from another generation isn't kept
+        m.put('b', 'call', True, 0)
+        self.assertEqual(m.lookup('b', 'call', 1), None)
+        # a newer generation empties it
+        self.assertEqual(m.lookup('a', 'call', 2), None)
+        self.assertEqual(len(m), 0)
+        self.assertEqual(m.lookup('a', 'call', 2), None)
+
+    def test_size(self):
+        m = SessionMemo(size=2)
+        m.lookup('x', 'call', 5)
+        for u in ( 'a', 'b', 'c', ):
+            m.put(u, 'call', False, 5)
+        self.assertEqual(len(m), 2)
+        self.assertEqual(m.lookup('c', 'call', 5), None)
+        self.assertEqual(m.lookup('a', 'call', 5), False)
@@ -0,0 +1,262 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## test_directdb.py - DirectDb's statement rewriting, text results and the
+## prepared statement path
+##
+## _prepare is checked for both paramstyles without a database.  the
+## prepared path runs StatementRegistry against a cursor that only records
+## what it is given, like a postgres connection would see it.  the rest runs
+## a DirectDb on a scratch sqlite database, under trial for the reactor.
+###############################################################################
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from twisted.trial import unittest as trial
+from twisted.internet.defer import inlineCallbacks
+
+import sqlauth
+from sqlauth.backend.columnar import Columns
+from sqlauth.twisted import statements
+from sqlauth.twisted.statements import StatementRegistry
+from sqlauth.twisted.directdb import DirectDb, _text
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(sqlauth.__file__))),
+    'config', 'SQLITE.sql')
+
+class Prepare(object):
+    """
+    DirectDb._prepare for a paramstyle, no pool
+    """
+
+    _prepare = DirectDb.__dict__['_prepare']
+
+    def __init__(self, paramstyle):
+        self.paramstyle = paramstyle
+
+class PrepareTest(unittest.TestCase):
+
+    def test_named(self):
+        s, a = Prepare('named')._prepare("select * from login where login = %(login)s and id = %(id)s",
+            { 'login': 'adm', 'id': 1, 'unused': 2 })
+        self.assertEqual(s, "select * from login where login = :login and id = :id")
+        self.assertEqual(a, { 'login': 'adm', 'id': 1 })
+
+    def test_named_in(self):
+        p = Prepare('named')
+        for v in ( ( 'a', 'b', 'c', ), [ 'a', 'b', 'c', ], ):
+            s, a = p._prepare("select 1 where t in %(t)s and t <> %(x)s", { 't': v, 'x': 'd' })
+            self.assertEqual(s, "select 1 where t in (:t_0,:t_1,:t_2) and t <> :x")
+            self.assertEqual(a, { 't_0': 'a', 't_1': 'b', 't_2': 'c', 'x': 'd' })
+
+    def test_named_percent(self):
+        s, a = Prepare('named')._prepare("select strftime('%%s', %(ts)s)", { 'ts': '2026-10-17' })
+        self.assertEqual(s, "select strftime('%s', :ts)")
+        self.assertEqual(a, { 'ts': '2026-10-17' })
+
+    def test_no_args(self):
+        for p in ( 'named', 'pyformat', ):
+            s, a = Prepare(p)._prepare("select 1", None)
+            self.assertEqual(s, "select 1")
+            self.assertEqual(a, {})
+
+    # the text is left for the driver, lists become tuples for 'in'
+    def test_pyformat(self):
+        sql = "select 1 where t in %(t)s and u in %(u)s and s = %(s)s"
+        s, a = Prepare('pyformat')._prepare(sql, { 't': [ 'a', 'b', ], 'u': ( 1, ), 's': '{"a"}' })
+        self.assertEqual(s, sql)
+        self.assertEqual(a, { 't': ( 'a', 'b', ), 'u': ( 1, ), 's': '{"a"}' })
+
+class TextTest(unittest.TestCase):
+
+    def test_text(self):
+        self.assertEqual(_text(None), None)
+        self.assertEqual(_text(True), 't')
+        self.assertEqual(_text(False), 'f')
+        self.assertEqual(_text(42), '42')
+        self.assertEqual(_text(1.5), '1.5')
+        self.assertEqual(_text(u'caf\xe9'), 'caf\xc3\xa9')
+        self.assertEqual(_text('adm'), 'adm')
+
+class Cursor(object):
+    """
+    records what is executed, statements naming one of fail raise
+    """
+
+    def __init__(self, conn):
+        self.connection = conn
+
+    def execute(self, s, a=None):
+        for f in self.connection.fail:
+            if f in s:
+                raise Exception("no " + f)
+        self.connection.executed.append(( s, a, ))
+
+    def close(self):
+        pass
+
+class Connection(object):
+
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.executed = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+class PreparedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reg = StatementRegistry()
+        self.login = self.reg.register('login', statements.LOGIN_QUERY)
+        self.perm = self.reg.register('permission', statements.PERMISSION_QUERY, statements.PERMISSION_PREPARE)
+        self.calls = []
+
+    def execute(self, cur, s, a, prepared=False):
+        self.calls.append(( s, a, prepared, ))
+        return [ { 'n': '1' } ]
+
+    def test_statement(self):
+        self.assertEqual(self.reg.find(statements.PERMISSION_QUERY), self.perm)
+        self.assertEqual(self.reg.find("select 1"), None)
+        self.assertEqual(self.perm.args, [ 'topiclist', 'action', 'authid', ])
+        self.assertTrue("t.name = any($1::text[])" in self.perm.prepare_sql)
+        self.assertTrue(self.perm.prepare_sql.startswith("prepare sqlauth_permission as"))
+        self.assertEqual(self.perm.execute_sql,
+            "execute sqlauth_permission (%(topiclist)s, %(action)s, %(authid)s)")
+
+    # a statement that won't prepare is rolled back and left as plain sql
+    def test_prepare_connection(self):
+        conn = Connection(fail=( 'sqlauth_login', ))
+        self.reg.prepare_connection(conn)
+        self.assertEqual([ s for s, a in conn.executed ], [ self.perm.prepare_sql ])
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertEqual(conn.commits, 1)
+        self.assertTrue(self.reg.is_prepared(conn, self.perm))
+        self.assertFalse(self.reg.is_prepared(conn, self.login))
+        self.assertFalse(self.reg.is_prepared(Connection(), self.perm))
+
+    def test_run_prepared(self):
+        conn = Connection()
+        self.reg.prepare_connection(conn)
+        a = { 'topiclist': ( 'a', 'a.b', ), 'action': 'call', 'authid': '1' }
+        rv = self.reg.run(conn.cursor(), self.perm, a, self.execute)
+        self.assertEqual(rv, [ { 'n': '1' } ])
+        # tuples go as an array literal
+        self.assertEqual(self.calls, [ ( self.perm.execute_sql,
+            { 'topiclist': u'{"a","a.b"}', 'action': 'call', 'authid': '1' }, True, ) ])
+        self.assertEqual(self.perm.stats()['prepared_calls'], 1)
+
+    def test_run_plain(self):
+        a = { 'topiclist': ( 'a', ), 'action': 'call', 'authid': '1' }
+        self.reg.run(Connection().cursor(), self.perm, a, self.execute)
+        self.assertEqual(self.calls, [ ( statements.PERMISSION_QUERY, a, False, ) ])
+        st = self.perm.stats()
+        self.assertEqual(( st['calls'], st['prepared_calls'], st['errors'], ), ( 1, 0, 0, ))
+
+    def test_run_error(self):
+        def execute(cur, s, a, prepared=False):
+            raise Exception("down")
+        self.assertRaises(Exception, self.reg.run, Connection().cursor(), self.login, { 'login': 'x' }, execute)
+        st = self.reg.stats()['sqlauth_login']
+        self.assertEqual(( st['calls'], st['errors'], ), ( 1, 1, ))
+
+class DirectDbTest(trial.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'auth.db')
+        conn = sqlite3.connect(self.path)
+        with open(SCHEMA) as f:
+            conn.executescript(f.read())
+        conn.executemany("insert into login ( id, login, password, tzname ) values ( ?, ?, 'x', 'UTC' )",
+            [ ( i, 'user' + str(i), ) for i in range(1, 4) ])
+        conn.commit()
+        conn.close()
+        self.db = DirectDb('SQLITE3', 'database=' + self.path, 'sys', prepare=False)
+        # the pool starts with the reactor, which only starts once when
+        # something other than trial runs the tests
+        if not self.db.pool.running:
+            self.db.pool.start()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    @inlineCallbacks
+    def test_query(self):
+        rv = yield self.db.query("select id, login from login where login in %(l)s order by id",
+            { 'l': [ 'user1', 'user3', ] })
+        self.assertEqual(rv, [ { 'id': '1', 'login': 'user1' }, { 'id': '3', 'login': 'user3' } ])
+        # the same through call(), like an app_session
+        rv = yield self.db.call('sys.db.query', "select login from login where id = %(id)s", { 'id': 2 })
+        self.assertEqual(rv, [ { 'login': 'user2' } ])
+
+    @inlineCallbacks
+    def test_operation(self):
+        rv = yield self.db.operation("update login set fullname = %(f)s where id = %(id)s", { 'f': 'One', 'id': 1 })
+        self.assertEqual(rv, None)
+        # a list is one transaction, a result for each statement
+        rv = yield self.db.query([
+            "update login set fullname = %(f)s where id = %(id)s",
+            "select fullname from login where id = %(id)s" ], { 'f': 'Uno', 'id': 1 })
+        self.assertEqual(rv, [ [], [ { 'fullname': 'Uno' } ] ])
+
+    @inlineCallbacks
+    def test_query_columns(self):
+        rv = yield self.db.query_columns("select id, login from login where id < %(id)s order by id", { 'id': 3 })
+        self.assertTrue(isinstance(rv, Columns))
+        self.assertEqual(list(rv), [ [ 'id', 'login' ], ( '1', 'user1', ), ( '2', 'user2', ) ])
+
+    # more values than sqlite allows parameters, one json argument
+    @inlineCallbacks
+    def test_in_list(self):
+        b = self.db.backend
+        ids = range(1, 2001)
+        rv = yield self.db.query("select count(*) as n from login where " + b.in_list('id', 'ids', 'bigint'),
+            { 'ids': b.in_arg(ids) })
+        self.assertEqual(rv, [ { 'n': '3' } ])
+
+    # on sqlite every orphan in one statement
+    @inlineCallbacks
+    def test_orphans_close(self):
+        conn = sqlite3.connect(self.path)
+        conn.executemany("insert into session ( login_id, ab_session_id ) values ( 1, ? )",
+            [ ( i, ) for i in range(1, 1501) ])
+        conn.commit()
+        conn.close()
+        n = yield self.db.backend.session_orphans_close(range(1, 1201))
+        self.assertEqual(n, 1200)
+        rv = yield self.db.query("select count(*) as n from session where ab_session_id is not null")
+        self.assertEqual(rv, [ { 'n': '300' } ])
+
+    def test_no_direct_path(self):
+        return self.assertFailure(self.db.call('sys.user.list'), Exception)
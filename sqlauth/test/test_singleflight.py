@@ -0,0 +1,83 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## test_singleflight.py - one lookup per key, everyone waiting shares it
+###############################################################################
+
+import unittest
+
+from twisted.internet import defer
+
+from sqlauth.twisted.singleflight import SingleFlight
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sf = SingleFlight()
+        self.calls = []
+
+    def lookup(self, key):
+        d = defer.Deferred()
+        self.calls.append(( key, d, ))
+        return d
+
+    def test_coalesce(self):
+        got = []
+        for i in range(3):
+            self.sf.do('k', self.lookup, 'k').addCallback(got.append)
+        self.sf.do('j', self.lookup, 'j').addCallback(got.append)
+        self.assertEqual([ c[0] for c in self.calls ], [ 'k', 'j' ])
+        self.assertEqual(len(self.sf), 2)
+        self.calls[0][1].callback('K')
+        self.assertEqual(got, [ 'K', 'K', 'K' ])
+        self.assertEqual(self.sf.stats(), { 'pending': 1, 'issued': 2, 'coalesced': 2 })
+
+    def test_forget(self):
+        self.sf.do('k', self.lookup, 'k')
+        self.calls[0][1].callback('K')
+        # once it is answered the next caller asks again
+        self.sf.do('k', self.lookup, 'k')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_own_deferred(self):
+        got = []
+        d1 = self.sf.do('k', self.lookup, 'k')
+        d2 = self.sf.do('k', self.lookup, 'k')
+        d1.addCallback(lambda rv: 'changed')
+        d2.addCallback(got.append)
+        self.calls[0][1].callback('K')
+        self.assertEqual(got, [ 'K' ])
+
+    def test_failure(self):
+        failed = []
+        for i in range(2):
+            self.sf.do('k', self.lookup, 'k').addErrback(lambda f: failed.append(f.value))
+        self.calls[0][1].errback(ValueError('no'))
+        self.assertEqual(len(failed), 2)
+        self.assertTrue(isinstance(failed[0], ValueError))
+        self.assertEqual(len(self.sf), 0)
+
+    def test_synchronous(self):
+        got = []
+        self.sf.do('k', lambda: 'now').addCallback(got.append)
+        self.assertEqual(got, [ 'now' ])
+        self.assertEqual(len(self.sf), 0)
+        failed = []
+        self.sf.do('k', lambda: 1 / 0).addErrback(failed.append)
+        self.assertEqual(len(failed), 1)
@@ -0,0 +1,162 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## test_sqlauthrpc.py - sqlauthrpc joining a router that runs --direct
+##
+## the router (sqlauthrouter.build) runs on a scratch sqlite database and
+## records its own sessions there.  sqlauthrpc then connects, records its
+## session and the router's system sessions again, and registers its
+## procedures.  run by trial's TestCase, the reactor runs for each test.
+###############################################################################
+
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer, task
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.endpoints import clientFromString
+
+from autobahn.wamp import auth
+from autobahn.wamp import types
+from autobahn.twisted.websocket import WampWebSocketClientFactory
+
+import sqlauth
+from sqlauth.scripts import sqlauthrouter
+from sqlauth.scripts import sqlauthrpc
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(sqlauth.__file__))),
+    'config', 'SQLITE.sql')
+SECRET = '123test'
+
+class Component(sqlauthrpc.Component):
+    """
+    sqlauthrpc, telling the test when onJoin is done and leaving the reactor be
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.joined = defer.Deferred()
+        self.left = defer.Deferred()
+        sqlauthrpc.Component.__init__(self, *args, **kwargs)
+
+    @inlineCallbacks
+    def onJoin(self, details):
+        try:
+            yield sqlauthrpc.Component.onJoin(self, details)
+        except Exception as e:
+            self.joined.errback(e)
+            return
+        self.joined.callback(details)
+
+    def onLeave(self, details):
+        if not self.joined.called:
+            self.joined.errback(Exception("not let in: {}".format(details.reason)))
+        self.disconnect()
+
+    def onDisconnect(self):
+        if not self.left.called:
+            self.left.callback(None)
+
+class DirectRouterTest(unittest.TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'auth.db')
+        conn = sqlite3.connect(self.path)
+        with open(SCHEMA) as f:
+            conn.executescript(f.read())
+        conn.executemany("insert into activity_type ( id, name ) values ( ?, ? )",
+            [ ( a, a ) for a in ( 'call', 'register', 'subscribe', 'publish', 'start', 'end', 'admin', ) ])
+        # like the shipped database, login 0 has the router's own sessions
+        salt = os.urandom(32).encode('base_64').strip()
+        conn.executemany("insert into login ( id, login, fullname, password, salt, tzname ) values ( ?, ?, ?, ?, ?, 'UTC' )",
+            [ ( i, l, l, auth.derive_key(SECRET, salt).decode('ascii'), salt, ) for i, l in ( ( 0, 'sys', ), ( 1, 'adm', ), ) ])
+        # and adm (1) has everything under sys
+        conn.execute("insert into role ( id, name ) values ( 1, 'admin' )")
+        conn.execute("insert into loginrole ( login_id, role_id ) values ( 1, 1 )")
+        conn.execute("insert into topic ( id, name ) values ( 1, 'sys' )")
+        conn.executemany("insert into topicrole ( topic_id, role_id, type_id, allow ) values ( 1, 1, ?, 1 )",
+            [ ( a, ) for a in ( 'call', 'register', 'subscribe', 'publish', ) ])
+        conn.commit()
+        conn.close()
+        self.dsn = 'database=' + self.path
+
+        ra = sqlauthrouter.parser().parse_args([ '--engine', 'SQLITE3', '--dsn', self.dsn, '--direct',
+            '--endpoint', 'tcp:0:interface=127.0.0.1', '--no-recover',
+            # no timers left behind
+            '--metrics-interval', '0', '--session-memo', '0' ])
+        self.parts = sqlauthrouter.build(ra, reactor)
+        self.port = yield self.parts['ready']
+        self.rpc = None
+
+    @inlineCallbacks
+    def tearDown(self):
+        if self.rpc is not None:
+            if self.rpc._transport is not None:
+                self.rpc._transport.sendClose()
+                yield self.rpc.left.addTimeout(10, reactor)
+            self.rpc.direct.close()
+        yield self.parts['sessiondb'].flush()
+        yield self.port.stopListening()
+        self.parts['direct'].close()
+        # the router's sqlbridge pool, trial would stop it with the reactor
+        self.parts['db_session'].db['instance'].disconnect()
+        shutil.rmtree(self.dir)
+
+    def connect(self):
+        self.rpc = Component(config=types.ComponentConfig(realm=u'realm1'),
+            authinfo={ 'auth_type': 'wampcra', 'auth_user': 'adm', 'auth_password': SECRET },
+            topic_base='sys', engine='SQLITE3', dsn=self.dsn)
+        f = WampWebSocketClientFactory(lambda: self.rpc,
+            url='ws://127.0.0.1:{}/ws'.format(self.port.getHost().port), debug=False)
+        d = clientFromString(reactor, 'tcp:127.0.0.1:{}'.format(self.port.getHost().port)).connect(f)
+        d.addErrback(lambda err: self.rpc.joined.errback(err) if not self.rpc.joined.called else None)
+        return self.rpc.joined.addTimeout(30, reactor)
+
+    def sessions(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return [ r[0] for r in conn.execute("select ab_session_id from session where ab_session_id is not null") ]
+        finally:
+            conn.close()
+
+    def epochs(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return set([ r[0] for r in conn.execute("select router_epoch from session where ab_session_id is not null") ])
+        finally:
+            conn.close()
+
+    @inlineCallbacks
+    def test_join(self):
+        details = yield self.connect()
+        # every procedure is registered
+        rv = yield self.rpc.call('sys.session.list', action_args={})
+        self.assertTrue(len(rv) > 1)
+        # and every session is in the database once
+        sl = self.sessions()
+        self.assertEqual(len(sl), len(set(sl)))
+        want = set(self.parts['sessiondb'].get_system_sessions().values())
+        want.add(details.session)
+        self.assertEqual(want - set(sl), set())
+        # all of them the router's, none left for router_reap
+        self.assertEqual(self.epochs(), set([ self.parts['sessiondb'].epoch ]))
@@ -0,0 +1,265 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## acltrie.py - in memory copy of the topic permission graph
+##
+## the topic, topicrole and loginrole tables are loaded into a trie, one node
+## per '.' separated topic segment.  each node carries an allow and a deny
+## bitset (one bit per role) for each of the activity types.  a login is
+## just a bitset of its roles, so an authorization is a walk down the trie
+## with no database access at all.
+###############################################################################
+
+import types as vtypes
+
+from twisted.python import log
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from autobahn.wamp import types
+
+from sqlauth.twisted.cache import topic_covers
+
+# the activity types that can be granted on a topic
+ACTIONS = ( 'call', 'register', 'publish', 'subscribe', 'admin', )
+ACTION_INDEX = dict((a, i) for i, a in enumerate(ACTIONS))
+
+# the allow column is not always a boolean coming back from the bridge, coerce it.
+def _bool(v):
+    if isinstance(v, vtypes.BooleanType):
+        return v
+    return v == 't' or v == 'true' or v == 'True' or v == 1 or v == '1'
+
+class AclNode(object):
+    """
+    one '.' separated segment of a topic name
+    """
+    __slots__ = ( 'children', 'allow', 'deny', )
+
+    def __init__(self):
+        self.children = {}
+        self.allow = [0] * len(ACTIONS)
+        self.deny = [0] * len(ACTIONS)
+
+    def reset(self):
+        self.allow = [0] * len(ACTIONS)
+        self.deny = [0] * len(ACTIONS)
+        for c in self.children.values():
+            c.reset()
+        return
+
+class AclTrie(object):
+    """
+    compiled topic permissions, answers check_permission without a query
+    """
+
+    #
+    # like UserDb, the trie needs an app_session that can call topic_base.query.
+    # it can be set later with set_session. nothing is answered until load() has
+    # completed, check loaded before calling check().
+    #
+    def __init__(self, topic_base, debug=False, app_session=None, retry=5):
+        log.msg("AclTrie:__init__()")
+        self.app_session = app_session
+        self.topic_base = topic_base
+        self.query = topic_base + '.query'
+        self.debug = debug
+        self.retry = retry
+        self.loaded = False
+        self.loading = False
+        # bumped on every change notice, a full load that sees it move
+        # while it was running is repeated.
+        self.generation = 0
+
+        self.root = AclNode()
+        self.role_bit = {}
+        self.login_mask = {}
+
+        return
+
+    def set_session(self, app_session):
+        log.msg("AclTrie:set_session()")
+        self.app_session = app_session
+
+        return
+
+    def _bit(self, role_bit, role_id):
+        role_id = str(role_id)
+        if not role_id in role_bit:
+            role_bit[role_id] = 1 << len(role_bit)
+        return role_bit[role_id]
+
+    def _node(self, root, name):
+        node = root
+        for p in name.split('.'):
+            child = node.children.get(p)
+            if child is None:
+                child = AclNode()
+                node.children[p] = child
+            node = child
+        return node
+
+    def _grant(self, root, role_bit, name, role_id, type_id, allow):
+        a = ACTION_INDEX.get(type_id)
+        if a is None:
+            return
+        node = self._node(root, name)
+        if _bool(allow):
+            node.allow[a] |= self._bit(role_bit, role_id)
+        else:
+            node.deny[a] |= self._bit(role_bit, role_id)
+        return
+
+    #
+    # check_permission, in memory.
+    # the first (shortest) topic along the uri that has a grant for any of the
+    # login's roles decides.  if that topic has both an allow and a deny for
+    # the login's roles then deny wins.
+    #
+    def check(self, authid, uri, action):
+        mask = self.login_mask.get(str(authid), 0)
+        a = ACTION_INDEX.get(action)
+        if not mask or a is None:
+            return False
+        node = self.root
+        for p in uri.split('.'):
+            node = node.children.get(p)
+            if node is None:
+                return False
+            if (node.allow[a] | node.deny[a]) & mask:
+                return not (node.deny[a] & mask)
+        return False
+
+    @inlineCallbacks
+    def _query(self, query, args):
+        rv = yield self.app_session.call(self.query, query, args,
+            options=types.CallOptions(timeout=2000,discloseMe=True))
+        returnValue(rv)
+
+    #
+    # load the whole permission graph, the new trie replaces the old one only
+    # once it is complete.  if the database isn't there yet we try again in
+    # retry seconds.
+    #
+    @inlineCallbacks
+    def load(self):
+        if self.loading:
+            return
+        self.loading = True
+        generation = self.generation
+        log.msg("AclTrie.load()")
+        try:
+            tv = yield self._query("""
+                select t.name, tr.role_id, tr.type_id, tr.allow
+                  from topic as t,
+                       topicrole as tr
+                 where t.id = tr.topic_id""", {})
+            lv = yield self._query("""
+                select lr.login_id, lr.role_id
+                  from loginrole as lr""", {})
+        except Exception as e:
+            log.msg("AclTrie.load: error {}, retry in {} seconds".format(e, self.retry))
+            self.loading = False
+            reactor.callLater(self.retry, self.load)
+            return
+
+        root = AclNode()
+        role_bit = {}
+        login_mask = {}
+        for r in tv:
+            self._grant(root, role_bit, r['name'], r['role_id'], r['type_id'], r['allow'])
+        for r in lv:
+            k = str(r['login_id'])
+            login_mask[k] = login_mask.get(k, 0) | self._bit(role_bit, r['role_id'])
+
+        self.root = root
+        self.role_bit = role_bit
+        self.login_mask = login_mask
+        self.loaded = True
+        self.loading = False
+        log.msg("AclTrie.load: {} grants, {} logins, {} roles".format(len(tv), len(login_mask), len(role_bit)))
+
+        # something changed while we were reading, read it again
+        if generation != self.generation:
+            yield self.load()
+
+        return
+
+    # a login gained or lost a role, refresh its role bits
+    @inlineCallbacks
+    def load_login(self, login_id):
+        log.msg("AclTrie.load_login({})".format(login_id))
+        rv = yield self._query("""
+            select lr.role_id
+              from loginrole as lr
+             where lr.login_id = %(login_id)s""", { 'login_id': login_id })
+        mask = 0
+        for r in rv:
+            mask |= self._bit(self.role_bit, r['role_id'])
+        if mask:
+            self.login_mask[str(login_id)] = mask
+        else:
+            self.login_mask.pop(str(login_id), None)
+
+        return
+
+    # grants on topic, or below it, changed.  rebuild that part of the trie.
+    @inlineCallbacks
+    def load_topic(self, topic):
+        log.msg("AclTrie.load_topic({})".format(topic))
+        rv = yield self._query("""
+            select t.name, tr.role_id, tr.type_id, tr.allow
+              from topic as t,
+                   topicrole as tr
+             where t.id = tr.topic_id
+               and ( t.name = %(topic)s or t.name like %(below)s )""",
+            { 'topic': topic, 'below': topic + '.%' })
+        self._node(self.root, topic).reset()
+        for r in rv:
+            if topic_covers(topic, r['name']):
+                self._grant(self.root, self.role_bit, r['name'], r['role_id'], r['type_id'], r['allow'])
+
+        return
+
+    #
+    # same arguments as PermissionCache.invalidate, the change notices
+    # published by sqlauthrpc are passed straight through.
+    #
+    def invalidate(self, login_id=None, topic=None, table=None, **kwargs):
+        if table == 'login':
+            return
+        self.generation += 1
+        if not self.loaded:
+            # the load in progress (or the next one) will pick it up
+            return
+
+        def reload_all(err):
+            log.msg("AclTrie.invalidate: incremental refresh failed {}, reloading".format(err.value))
+            return self.load()
+
+        if login_id is None and topic is None:
+            d = self.load()
+        elif login_id is not None:
+            d = self.load_login(login_id)
+        else:
+            d = self.load_topic(topic)
+        if topic is not None and login_id is not None:
+            d.addCallback(lambda _: self.load_topic(topic))
+        d.addErrback(reload_all)
+
+        return d
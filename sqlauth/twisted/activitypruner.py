@@ -0,0 +1,131 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## activitypruner.py - keeps the activity partitions, drops the old ones
+##
+## activity is split by day (see Backend.activity_partition_add).  every
+## interval seconds the pruner makes sure today has a partition (and on
+## postgres the next few days), then drops every partition that ends on or
+## before the retention window.  a whole table goes at once, there are no
+## deletes and nothing for vacuum to do.
+###############################################################################
+
+import sys
+import datetime
+
+from twisted.python import log
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import LoopingCall
+from autobahn.wamp import types
+
+from sqlauth.twisted import logger
+
+from sqlauth.backend import get_backend
+
+class ActivityPruner(object):
+    """
+    daily activity partitions with a retention window
+    """
+
+    #
+    # engine     -> the database engine, like the router's --engine
+    # topic_base -> 'sys.db', the queries go to topic_base.query on app_session
+    # retention  -> days of activity kept, 0 keeps everything
+    # interval   -> seconds between runs
+    # ahead      -> days of partitions made ahead of time (postgres)
+    #
+    def __init__(self, engine, topic_base, retention=0, interval=3600.0, ahead=2,
+            debug=False, app_session=None):
+        logger.start(debug is not None and debug)
+        log.msg("ActivityPruner:__init__({} days)".format(retention))
+        self.topic_base = topic_base
+        self.query = topic_base + '.query'
+        self.retention = retention
+        self.interval = interval
+        self.ahead = ahead
+        self.debug = debug
+        self.app_session = app_session
+        self.backend = get_backend(engine, self._query)
+
+        self.dropped = 0
+        self.failed = 0
+        self._loop = None
+        self._running = False
+
+        return
+
+    def set_session(self, app_session):
+        log.msg("ActivityPruner:set_session()")
+        self.app_session = app_session
+
+        return
+
+    def _query(self, s, a):
+        return self.app_session.call(self.query, s, a,
+            options=types.CallOptions(timeout=2000,discloseMe=True))
+
+    def start(self):
+        log.msg("ActivityPruner.start(every {} seconds)".format(self.interval))
+        if self._loop is None:
+            self._loop = LoopingCall(self.prune)
+            self._loop.start(self.interval, now=True)
+
+        return
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+        return
+
+    #
+    # one run.  a run that fails is logged and the next one tries again,
+    # a run still going when the next is due is left to finish.
+    #
+    @inlineCallbacks
+    def prune(self):
+        if self._running or self.app_session is None:
+            return
+        self._running = True
+        try:
+            today = datetime.datetime.utcnow().date()
+            yield self.backend.activity_partition_add(today.isoformat(), self.ahead)
+            if self.retention > 0:
+                cutoff = (today - datetime.timedelta(days=self.retention)).isoformat()
+                pl = yield self.backend.activity_partitions()
+                for p in pl:
+                    if p['upper'] <= cutoff:
+                        yield self.backend.activity_partition_drop(p['name'])
+                        self.dropped += 1
+        except Exception as e:
+            self.failed += 1
+            log.msg("ActivityPruner.prune: error {}".format(e))
+        finally:
+            self._running = False
+
+        return
+
+    def stats(self):
+        return {
+            'retention': self.retention,
+            'dropped': self.dropped,
+            'failed': self.failed
+        }
@@ -0,0 +1,316 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## activitywriter.py - buffered activity recording
+##
+## activity records are queued in memory and handed to a flush function a
+## batch at a time, when the batch fills up or every interval seconds,
+## whichever comes first.  the queue is bounded, when the database can't
+## keep up records are dropped rather than letting the router grow without
+## limit.
+##
+## ActivityRollup goes further and only keeps counts, see activity_rollup.
+##
+## a record names its session by ab_session_id, the database finds the
+## session row when the batch is written.  once the session is closed
+## (SessionDb.delete) that can't be done any more, so a closing session's
+## records are written first, with flush_session.
+###############################################################################
+
+import time
+
+from twisted.python import log
+from twisted.internet import defer
+from twisted.internet.task import LoopingCall
+
+class ActivityWriter(object):
+    """
+    batches activity records for the database
+    """
+
+    #
+    # flush        -> function called with a list of records, it returns a deferred
+    # batch_size   -> records per flush
+    # interval     -> seconds between time based flushes
+    # max_pending  -> most records held in memory, beyond that records are dropped
+    # max_inflight -> most flushes outstanding at once.  while this many are
+    #                 running records just queue up (backpressure)
+    # drop         -> 'newest' drops the record being added, 'oldest' drops the
+    #                 oldest queued record to make room
+    #
+    def __init__(self, flush, batch_size=500, interval=1.0, max_pending=50000,
+            max_inflight=2, drop='newest'):
+        if drop not in ( 'newest', 'oldest', ):
+            raise Exception("drop must be newest or oldest, not {}".format(drop))
+        self.flush_fn = flush
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_inflight = max_inflight
+        self.drop = drop
+
+        self.pending = []
+        # ab_session_id -> records of it in pending
+        self.queued = {}
+        self.inflight = 0
+        # the writes in flight, see flush_session
+        self.writing = set()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._loop = None
+
+        return
+
+    def start(self):
+        log.msg("ActivityWriter.start({} records or {} seconds)".format(self.batch_size, self.interval))
+        if self._loop is None:
+            self._loop = LoopingCall(self.flush)
+            self._loop.start(self.interval, now=False)
+
+        return
+
+    #
+    # stop the timer and write out everything that is queued, regardless of
+    # max_inflight.  the deferred fires when the last batch is done.
+    #
+    def stop(self):
+        log.msg("ActivityWriter.stop({} pending)".format(len(self.pending)))
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        dl = []
+        while self.pending:
+            dl.append(self._write())
+
+        return defer.DeferredList(dl)
+
+    def add(self, record):
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            if self.drop == 'newest':
+                return False
+            self._unqueue([ self.pending.pop(0) ])
+        self.pending.append(record)
+        k = record['ab_session_id']
+        self.queued[k] = self.queued.get(k, 0) + 1
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+        return True
+
+    def flush(self):
+        if not self.pending or self.inflight >= self.max_inflight:
+            return defer.succeed(None)
+
+        return self._write()
+
+    #
+    # write ab_session_id's queued records now, whatever max_inflight, for a
+    # session that is closing.  the deferred fires once they, and every
+    # batch already in flight (which may hold more of them), are written.
+    #
+    def flush_session(self, ab_session_id):
+        dl = list(self.writing)
+        if self.queued.get(ab_session_id, 0) > 0:
+            batch = [ r for r in self.pending if r['ab_session_id'] == ab_session_id ]
+            self.pending = [ r for r in self.pending if r['ab_session_id'] != ab_session_id ]
+            dl.append(self._write(batch))
+
+        return defer.DeferredList(dl)
+
+    def _unqueue(self, batch):
+        for r in batch:
+            k = r['ab_session_id']
+            n = self.queued.get(k, 0) - 1
+            if n > 0:
+                self.queued[k] = n
+            else:
+                self.queued.pop(k, None)
+
+        return
+
+    # batch -> these records, taken out of pending already.  the next
+    # batch_size of pending if not given.
+    def _write(self, batch=None):
+        if batch is None:
+            batch = self.pending[:self.batch_size]
+            del self.pending[:self.batch_size]
+        self._unqueue(batch)
+        self.inflight += 1
+
+        def done(rv):
+            self.inflight -= 1
+            self.written += len(batch)
+            return rv
+
+        def failed(err):
+            # the records are lost, requeueing them would only make a slow database slower
+            self.inflight -= 1
+            self.failed += len(batch)
+            log.msg("ActivityWriter: batch of {} failed, error {}".format(len(batch), err.value))
+            return None
+
+        d = defer.maybeDeferred(self.flush_fn, batch)
+        d.addCallbacks(done, failed)
+        if not d.called:
+            self.writing.add(d)
+            d.addBoth(self._written, d)
+
+        return d
+
+    def _written(self, rv, d):
+        self.writing.discard(d)
+        return rv
+
+    def stats(self):
+        return {
+            'pending': len(self.pending),
+            'inflight': self.inflight,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed
+        }
+
+class ActivityRollup(object):
+    """
+    counts activity in memory and writes the counts, not the events
+    """
+
+    #
+    # instead of a row per event, events are counted by
+    # (ab_session_id, topic_name, type_id, allow) along with when they were first
+    # and last seen.  every interval seconds the counts are handed to flush,
+    # which adds them to the activity_rollup table.  max_keys bounds the number
+    # of distinct counters, reaching it forces an early flush.  the counters
+    # are kept by session, so a closing session's can go out on their own
+    # (flush_session).
+    #
+    def __init__(self, flush, interval=10.0, max_keys=100000, clock=None):
+        self.flush_fn = flush
+        self.interval = interval
+        self.max_keys = max_keys
+        self.clock = clock or time.time
+
+        # ab_session_id -> { ( topic_name, type_id, allow ) -> [ count, first, last ] }
+        self.counts = {}
+        self.keys = 0
+        self.events = 0
+        self.written = 0
+        self.failed = 0
+        # the flushes in flight, see flush_session
+        self.writing = set()
+        self._loop = None
+
+        return
+
+    def start(self):
+        log.msg("ActivityRollup.start({} seconds)".format(self.interval))
+        if self._loop is None:
+            self._loop = LoopingCall(self.flush)
+            self._loop.start(self.interval, now=False)
+
+        return
+
+    def stop(self):
+        log.msg("ActivityRollup.stop({} counters)".format(self.keys))
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+        return self.flush()
+
+    #
+    # write ab_session_id's counters now, for a session that is closing.  the
+    # deferred fires once they, and every flush already in flight (which may
+    # hold more of them), are written.
+    #
+    def flush_session(self, ab_session_id):
+        dl = list(self.writing)
+        sc = self.counts.pop(ab_session_id, None)
+        if sc is not None:
+            self.keys -= len(sc)
+            dl.append(self._write({ ab_session_id: sc }))
+
+        return defer.DeferredList(dl)
+
+    def add(self, record):
+        sid = record['ab_session_id']
+        k = ( record['topic_name'], record['type_id'], record['allow'], )
+        now = self.clock()
+        sc = self.counts.get(sid)
+        if sc is None:
+            sc = self.counts[sid] = {}
+        c = sc.get(k)
+        if c is None:
+            sc[k] = [ 1, now, now ]
+            self.keys += 1
+        else:
+            c[0] += 1
+            c[2] = now
+        self.events += 1
+        if self.keys >= self.max_keys:
+            self.flush()
+
+        return True
+
+    def flush(self):
+        if not self.counts:
+            return defer.succeed(None)
+        counts = self.counts
+        self.counts = {}
+        self.keys = 0
+
+        return self._write(counts)
+
+    def _write(self, counts):
+        batch = []
+        for sid, sc in counts.items():
+            for k, c in sc.items():
+                batch.append({ 'ab_session_id':sid, 'topic_name':k[0], 'type_id':k[1], 'allow':k[2],
+                    'count':c[0], 'first_seen':c[1], 'last_seen':c[2] })
+
+        def done(rv):
+            self.written += len(batch)
+            return rv
+
+        def failed(err):
+            self.failed += len(batch)
+            log.msg("ActivityRollup: {} counters failed, error {}".format(len(batch), err.value))
+            return None
+
+        d = defer.maybeDeferred(self.flush_fn, batch)
+        d.addCallbacks(done, failed)
+        if not d.called:
+            self.writing.add(d)
+            d.addBoth(self._written, d)
+
+        return d
+
+    def _written(self, rv, d):
+        self.writing.discard(d)
+        return rv
+
+    def stats(self):
+        return {
+            'counters': self.keys,
+            'events': self.events,
+            'written': self.written,
+            'failed': self.failed
+        }
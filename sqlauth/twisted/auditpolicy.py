@@ -0,0 +1,136 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## auditpolicy.py - decide which authorizations are written to activity
+##
+## the policy is a dictionary (normally read from a json file) like:
+##
+## {
+##   "default": { "record": true },
+##   "rules": [
+##     { "prefix": "com.feed", "actions": ["publish"], "record": false },
+##     { "prefix": "com.chat", "sample": 0.05 },
+##     { "prefix": "com.bank", "deny_only": true },
+##     { "prefix": "com.game", "first": 10 }
+##   ]
+## }
+##
+## the rule with the longest prefix covering the uri (and listing the action,
+## if it lists actions at all) is used, otherwise default.  a rule can have:
+##   record    -> false means nothing is recorded
+##   deny_only -> true means only denied actions are recorded
+##   first     -> record only the first N of each session on each uri
+##   sample    -> record this fraction (0.0 - 1.0) of what is left
+###############################################################################
+
+import json
+import random
+
+from twisted.python import log
+
+from sqlauth.twisted.cache import LruCache, topic_covers
+
+class AuditPolicy(object):
+    """
+    in process filter in front of SessionDb.activity
+    """
+
+    #
+    # policy    -> dictionary as above
+    # max_first -> most (session, uri) counters kept for 'first' rules per session,
+    #              a session that uses more uris than this stops being recorded
+    #              on the new ones.
+    #
+    def __init__(self, policy=None, max_first=10000, rng=None):
+        if policy is None:
+            policy = {}
+        self.default = policy.get('default', { 'record': True })
+        self.rules = sorted(policy.get('rules', []), key=lambda r: len(r['prefix']), reverse=True)
+        for r in self.rules:
+            if 'actions' in r and not isinstance(r['actions'], list):
+                r['actions'] = [ r['actions'] ]
+        self.max_first = max_first
+        self.random = rng or random.random
+        self._rule = LruCache(size=10000, ttl=0)
+        self._first = {}
+        self.recorded = 0
+        self.skipped = 0
+
+        return
+
+    @classmethod
+    def from_file(cls, path):
+        log.msg("AuditPolicy.from_file({})".format(path))
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def rule(self, uri, action):
+        r = self._rule.get((uri, action))
+        if r is not None:
+            return r
+        r = self.default
+        for c in self.rules:
+            if 'actions' in c and not action in c['actions']:
+                continue
+            if topic_covers(c['prefix'], uri):
+                r = c
+                break
+        self._rule.set((uri, action), r)
+        return r
+
+    def should_record(self, session_id, uri, action, allow):
+        r = self.rule(uri, action)
+        rv = self._check(r, session_id, uri, allow)
+        if rv:
+            self.recorded += 1
+        else:
+            self.skipped += 1
+        return rv
+
+    def _check(self, r, session_id, uri, allow):
+        if not r.get('record', True):
+            return False
+        if r.get('deny_only', False) and allow:
+            return False
+        if 'first' in r:
+            seen = self._first.setdefault(session_id, {})
+            n = seen.get(uri, None)
+            if n is None:
+                if len(seen) >= self.max_first:
+                    return False
+                n = 0
+            if n >= r['first']:
+                return False
+            seen[uri] = n + 1
+        if 'sample' in r and self.random() >= r['sample']:
+            return False
+        return True
+
+    # the session is gone, drop its 'first' counters
+    def forget(self, session_id):
+        self._first.pop(session_id, None)
+        return
+
+    def stats(self):
+        return {
+            'rules': len(self.rules),
+            'recorded': self.recorded,
+            'skipped': self.skipped,
+            'sessions': len(self._first)
+        }
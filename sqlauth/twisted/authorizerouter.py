@@ -26,6 +26,7 @@
 
 import json
 import sys
+import time
 import six
 import types as vtypes
 
@@ -39,8 +40,25 @@ from autobahn.wamp.interfaces import IRouter
 from autobahn.twisted.wamp import Router
 from autobahn.twisted.wamp import RouterSession
 from twisted.internet import defer
+from twisted.internet.task import LoopingCall
 from autobahn.twisted.wamp import ApplicationSession
 
+from sqlauth.twisted.singleflight import SingleFlight
+from sqlauth.twisted.notifylistener import NotifyListener
+from sqlauth.twisted.statements import PERMISSION_QUERY
+from sqlauth.twisted import metrics
+from sqlauth.twisted import logger
+
+AUTHORIZE = metrics.registry.counter('sqlauth_authorize_total',
+    'authorization decisions, by decision and path (root, memo, acl, cache or query)', ( 'decision', 'path', ))
+PERMCACHE = metrics.registry.counter('sqlauth_permcache_total',
+    'permission cache lookups', ( 'result', ))
+CHECK_PERMISSION = metrics.registry.histogram('sqlauth_check_permission_seconds',
+    'the permission query, seconds')
+
+# a line per message, formatted only with --verbose
+LOG = logger.Logger('AuthorizeRouter', hot=True)
+
 class AuthorizeSession(ApplicationSession):
     def ret_func(self, *args, **kwargs):
         log.msg("in ret_func {} {}".format(args,kwargs))
@@ -62,7 +80,7 @@ class AuthorizeSession(ApplicationSession):
         log.msg("AuthorizeSession __init__ {},{}".format(args,kwargs))
 
         # reap init variables meant only for us
-        for i in ( 'topic_base', 'app_session', 'debug', 'db', 'router',  ):
+        for i in ( 'topic_base', 'app_session', 'debug', 'db', 'router', 'permcache', 'acl', 'audit', 'userdb', 'flight', 'direct', 'notify', 'memo_ttl', ):
             if i in kwargs:
                 if kwargs[i] is not None:
                     self.svar[i] = kwargs[i]
@@ -70,8 +88,20 @@ class AuthorizeSession(ApplicationSession):
 
         if 'debug' in self.svar:
             self.debug = self.svar['debug']
-            if self.debug:
-                log.startLogging(sys.stdout)
+            logger.start(self.debug)
+
+        # the sessions' decision memos (SessionMemo) are good for this generation,
+        # bumped by every permission change, and every memo_ttl seconds
+        self.generation = 0
+        self.memo_expiry = None
+        if self.svar.get('memo_ttl', 0) > 0:
+            self.memo_expiry = LoopingCall(self.bump)
+
+        # the database's change notices (postgres), notify is seconds between checks
+        self.listener = None
+        if 'notify' in self.svar and 'topic_base' in self.svar:
+            self.listener = NotifyListener(self, self.svar['topic_base'], self.invalidate,
+                check=self.svar['notify'], debug=self.svar.get('debug', False))
 
         log.msg("PreAuthRouter is ready {},{}".format(args,kwargs))
 
@@ -79,12 +109,53 @@ class AuthorizeSession(ApplicationSession):
 
         return
 
+    #
+    # the sqlauthrpc admin calls publish a change notice on topic_base.invalidate
+    # whenever they change the rows behind an authorization decision.  the notice
+    # is a dictionary, like { 'table':'loginrole', 'login_id':5 } or
+    # { 'table':'topicrole', 'topic':'com.db' }, see PermissionCache.invalidate
+    #
+    def invalidate(self, change=None):
+        log.msg("AuthorizeSession.invalidate({})".format(change))
+        if change is None:
+            change = {}
+        if change.get('table', None) != 'login':
+            self.bump()
+        if 'permcache' in self.svar:
+            self.svar['permcache'].invalidate(**change)
+        if 'acl' in self.svar:
+            d = self.svar['acl'].invalidate(**change)
+            # decisions made from the acl before it has reloaded are stale too
+            if isinstance(d, defer.Deferred):
+                d.addBoth(lambda r: self.bump() or r)
+        if 'userdb' in self.svar:
+            self.svar['userdb'].invalidate(**change)
+        return
+
+    # every session's decision memo is emptied the next time it is used
+    def bump(self):
+        self.generation += 1
+
+        return
+
+    @inlineCallbacks
+    def onJoin(self, details):
+        log.msg("AuthorizeSession.onJoin: {}".format(details))
+        if 'topic_base' in self.svar:
+            yield self.subscribe(self.invalidate, self.svar['topic_base'] + '.invalidate')
+        if self.listener is not None:
+            self.listener.start()
+        if self.memo_expiry is not None and not self.memo_expiry.running:
+            self.memo_expiry.start(self.svar['memo_ttl'], now=False)
+
+        return
+
 class AuthorizeRouter(Router):
     def __init__(self, *args, **kwargs):
         self.svar = {}
 
         # reap init variables meant only for us
-        for i in ( 'topic_base', 'app_session', 'debug', 'db', 'router', ):
+        for i in ( 'topic_base', 'app_session', 'debug', 'db', 'router', 'permcache', 'acl', 'audit', 'userdb', 'flight', 'direct', 'notify', 'memo_ttl', ):
             if i in kwargs:
                 if kwargs[i] is not None:
                     self.svar[i] = kwargs[i]
@@ -92,14 +163,25 @@ class AuthorizeRouter(Router):
 
         if 'debug' in self.svar:
             self.debug = self.svar['debug']
-            if self.debug:
-                log.startLogging(sys.stdout)
+            logger.start(self.debug)
 
         if 'db' in self.svar:
             self.sessiondb = self.svar['db']
 
-        if 'app_session' in self.svar:
-            self.app_session = self.svar['app_session']
+        # the AuthorizeSession, its generation stamps the sessions' decision memos
+        self.app_session = self.svar.get('app_session', None)
+
+        # DirectDb, when set permission queries skip the wamp round trip
+        self.dbsession = self.svar.get('direct', self.svar.get('app_session', None))
+
+        # decisions are cached per router, this is None if caching is off
+        self.permcache = self.svar.get('permcache', None)
+        # compiled permissions (AclTrie), None means every decision is a query
+        self.acl = self.svar.get('acl', None)
+        # AuditPolicy, decides which decisions reach the activity table, None records them all
+        self.audit = self.svar.get('audit', None)
+        # identical check_permission queries in flight at the same time are made once
+        self.flight = self.svar.get('flight', None) or SingleFlight()
 
         log.msg("sending to super.init args {}, kwargs {}".format(args,kwargs))
 
@@ -129,7 +211,7 @@ class AuthorizeRouter(Router):
     #
     @inlineCallbacks
     def check_permission(self, authid, uri, action):
-        log.msg("AuthorizeRouter.check_permission: {} {} {}".format(authid, uri, action))
+        LOG.debug("check_permission: {} {} {}", authid, uri, action)
         look = []
         pieces = uri.split('.')
         accum = ''
@@ -139,64 +221,106 @@ class AuthorizeRouter(Router):
             extra = '.'
             look.append(accum)
 
-        query = """
-        select t.name, length(t.name) as topic_length, tr.allow
-          from topic as t,
-               topicrole as tr,
-               loginrole as lr
-         where
-            t.name in %(topiclist)s
-           and
-            t.id = tr.topic_id
-           and
-            tr.role_id = lr.role_id
-           and
-            tr.type_id = %(action)s
-           and
-            lr.login_id = %(authid)s
-      order by
-            topic_length"""
-        log.msg("AuthorizeRouter.check_permission: query: {}".format(query))
+        # the text is shared with DirectDb, which prepares it (see statements.py)
+        query = PERMISSION_QUERY
+        LOG.debug("check_permission: query: {}", query)
         args = { 'topiclist': tuple(look), 'authid': authid, 'action': action }
-        log.msg("AuthorizeRouter.check_permission: args: {}".format(args))
+        LOG.debug("check_permission: args: {}", args)
 
-        rv = yield self.app_session.call(self.query, query, args, options = types.CallOptions(timeout=2000,discloseMe=True))
+        start = time.time()
+        rv = yield CHECK_PERMISSION.track(self.dbsession.call(self.query, query, args,
+            options = types.CallOptions(timeout=2000,discloseMe=True)), start)
 
-        log.msg("AuthorizeRouter.check_permission: rv: {}".format(rv))
+        LOG.debug("check_permission: rv: {}", rv)
 
         perm = False
         if len(rv) > 0:
             perm = rv[0]['allow']
             if not isinstance(perm, vtypes.BooleanType):
-                log.msg("perm is NOT boolean {}", perm)
-                if perm == 't':
+                LOG.debug("check_permission: perm is NOT boolean {}", perm)
+                # sqlite keeps booleans as 1 and 0
+                if perm == 't' or perm == '1':
                     perm = True
                 else:
                     perm = False
-            log.msg("perm is {}".format(perm))
+            LOG.debug("check_permission: perm is {}", perm)
 
         returnValue(perm)
 
         return
 
+    #
+    # the query path, used when there is no compiled acl or it hasn't loaded yet.
+    #
     @inlineCallbacks
-    def authorize(self, session, uri, action):
-        authid = session._authid
-        if authid is None:
-            authid = 1
-        log.msg("AuthorizeRouter.authorize: {} {} {} {} {}".format(authid,
-            session._session_id, uri, IRouter.ACTION_TO_STRING[action], action))
-        if authid != 1:
-            rv = yield self.check_permission(authid, uri, IRouter.ACTION_TO_STRING[action])
-        else:
-            rv = yield True
+    def authorize_query(self, session, authid, uri, action, memo=None, memo_generation=None):
+        rv = None
+        path = 'query'
+        if self.permcache is not None:
+            rv = self.permcache.lookup(authid, uri, action)
+            PERMCACHE.inc('miss' if rv is None else 'hit')
+            if rv is not None:
+                path = 'cache'
+        if rv is None:
+            generation = None
+            if self.permcache is not None:
+                generation = self.permcache.generation
+            rv = yield self.flight.do(('permission', authid, uri, action, generation),
+                self.check_permission, authid, uri, action)
+            if self.permcache is not None:
+                self.permcache.put(authid, uri, action, rv, generation)
+
+        LOG.debug("authorize: rv is {}", rv)
+        if memo is not None:
+            memo.put(uri, action, rv, memo_generation)
+        AUTHORIZE.inc('allow' if rv else 'deny', path)
+        self.record(session, uri, action, rv)
 
-        log.msg("AuthorizeRouter.authorize: rv is {}".format(rv))
+        returnValue(rv)
 
-        if not uri.startswith(self.svar['topic_base']):
-            self.sessiondb.activity(session._session_id, uri, IRouter.ACTION_TO_STRING[action], rv)
+        return
 
-        returnValue(rv)
+    def record(self, session, uri, action, rv):
+        if uri.startswith(self.svar['topic_base']):
+            return
+        if self.audit is not None and not self.audit.should_record(session._session_id, uri, action, rv):
+            return
+        self.sessiondb.activity(session._session_id, uri, action, rv)
 
         return
 
+    #
+    # the session's own memo is asked first (MyRouterSession._memo, a SessionMemo),
+    # then with a loaded acl the decision is made right here, no deferred and no
+    # database.  otherwise we hand back the deferred from authorize_query.
+    #
+    def authorize(self, session, uri, action):
+        authid = session._authid
+        if authid is None:
+            authid = 1
+        action = IRouter.ACTION_TO_STRING[action]
+        LOG.debug("authorize: {} {} {} {}", authid, session._session_id, uri, action)
+        memo = getattr(session, '_memo', None)
+        generation = None
+        rv = None
+        if authid == 1:
+            rv = True
+            path = 'root'
+        else:
+            if memo is not None:
+                generation = self.app_session.generation
+                rv = memo.lookup(uri, action, generation)
+                path = 'memo'
+            if rv is None:
+                if self.acl is None or not self.acl.loaded:
+                    return self.authorize_query(session, authid, uri, action, memo, generation)
+                rv = self.acl.check(authid, uri, action)
+                path = 'acl'
+                if memo is not None:
+                    memo.put(uri, action, rv, generation)
+
+        LOG.debug("authorize: rv is {}", rv)
+        AUTHORIZE.inc('allow' if rv else 'deny', path)
+        self.record(session, uri, action, rv)
+
+        return rv
@@ -0,0 +1,211 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## cache.py - in memory caches used by the router
+##
+## LruCache is a small size capped, time limited, least recently used cache.
+## PermissionCache sits in front of AuthorizeRouter.check_permission so that
+## repeat authorizations are answered without a trip to the database.
+## SessionMemo is one session's own decisions, in front of both.
+###############################################################################
+
+import time
+
+from collections import OrderedDict
+from twisted.python import log
+
+class LruCache(object):
+    """
+    size capped least recently used cache with a time to live on each entry
+    """
+
+    #
+    # size  -> maximum number of entries, the least recently used entry is
+    #          evicted when this is exceeded.
+    # ttl   -> seconds an entry is good for.  0 (or None) means entries never expire.
+    # clock -> function returning the current time in seconds, time.time by default
+    #
+    def __init__(self, size=10000, ttl=60, clock=None):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock or time.time
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        return
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    # return the value for key, or default if it isn't there (or has expired).
+    # a hit moves the entry to the most recently used end.
+    def get(self, key, default=None):
+        try:
+            expires, value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires is not None and expires <= self.clock():
+            self.misses += 1
+            return default
+        self._entries[key] = (expires, value)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl:
+            expires = self.clock() + ttl
+        self._entries.pop(key, None)
+        self._entries[key] = (expires, value)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+        return
+
+    # remove every entry for which match(key) is true, returns the count removed
+    def delete_matching(self, match):
+        dk = [k for k in self._entries.keys() if match(k)]
+        for k in dk:
+            del self._entries[k]
+        return len(dk)
+
+    def clear(self):
+        self._entries.clear()
+        return
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+#
+# is uri equal to, or underneath, topic in the '.' hierarchy?
+# com.db is under com, com.dbx is not.
+#
+def topic_covers(topic, uri):
+    return uri == topic or uri.startswith(topic + '.')
+
+class PermissionCache(LruCache):
+    """
+    cache of authorization decisions keyed by (authid, uri, action)
+    """
+
+    def __init__(self, size=10000, ttl=60, clock=None):
+        LruCache.__init__(self, size=size, ttl=ttl, clock=clock)
+        # bumped on every invalidation.  a lookup that started before an
+        # invalidation must not store its (possibly stale) answer afterwards.
+        self.generation = 0
+
+        return
+
+    def put(self, authid, uri, action, allow, generation=None):
+        if generation is not None and generation != self.generation:
+            log.msg("PermissionCache.put: discarding stale decision {} {} {}".format(authid, uri, action))
+            return
+        self.set((authid, uri, action), allow)
+        return
+
+    def lookup(self, authid, uri, action, default=None):
+        return self.get((authid, uri, action), default)
+
+    #
+    # invalidate
+    #  login_id -> forget every decision made for this login
+    #  topic    -> forget every decision for a uri at or below this topic
+    #
+    # with neither argument everything is forgotten.  this is the
+    # handler for the change notices published by the sqlauthrpc admin calls,
+    # notices about the login table (credentials) don't concern us.
+    #
+    def invalidate(self, login_id=None, topic=None, table=None, **kwargs):
+        if table == 'login':
+            return
+        self.generation += 1
+        if login_id is None and topic is None:
+            log.msg("PermissionCache.invalidate: all")
+            self.clear()
+            return
+        n = 0
+        if login_id is not None:
+            login_id = str(login_id)
+            n += self.delete_matching(lambda k: str(k[0]) == login_id)
+        if topic is not None:
+            n += self.delete_matching(lambda k: topic_covers(topic, k[1]))
+        log.msg("PermissionCache.invalidate: login_id {} topic {}, {} removed".format(login_id, topic, n))
+        return
+
+class SessionMemo(object):
+    """
+    one session's authorization decisions, keyed by (uri, action)
+    """
+
+    #
+    # MyRouterSession carries one from onJoin to onLeave, and AuthorizeRouter
+    # asks it before the acl, the PermissionCache or the database.  a session
+    # keeps using a handful of uris, so it stays small: past size decisions
+    # nothing more is remembered.
+    #
+    # there is no expiry and no invalidation per entry.  every lookup and put
+    # comes with the router's generation (AuthorizeSession.generation), bumped
+    # on every permission change and every --cache-ttl seconds, and a memo
+    # from an older generation is emptied before it is used.
+    #
+    def __init__(self, size=64):
+        self.size = size
+        self.generation = None
+        self._decisions = {}
+
+        return
+
+    def __len__(self):
+        return len(self._decisions)
+
+    def lookup(self, uri, action, generation):
+        if generation != self.generation:
+            self._decisions.clear()
+            self.generation = generation
+            return None
+        return self._decisions.get((uri, action))
+
+    # generation is the one the decision was made in
+    def put(self, uri, action, allow, generation):
+        if generation != self.generation:
+            return
+        if len(self._decisions) >= self.size:
+            return
+        self._decisions[(uri, action)] = allow
+
+        return
@@ -0,0 +1,264 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## directdb.py - in process database access for the router
+##
+## normally UserDb, SessionDb, AclTrie and AuthorizeRouter reach the database
+## by calling sys.db.query (and sys.session.add, sys.activity.add ...) over
+## wamp, through the router, to the sqlbridge DB session and sqlauthrpc.
+## DirectDb stands in for that app_session.  it has the same call() the
+## others already use, but the handful of procedures they call are run right
+## here on an adbapi connection pool.  anything else is passed on to the
+## real app_session, if there is one.
+##
+## like sqlbridge, queries use %(name)s arguments, a list or tuple argument
+## is expanded for 'in', and every value comes back as text.
+###############################################################################
+
+import re
+import sys
+import six
+
+from twisted.python import log
+from twisted.internet import defer
+
+from sqlauth.backend import get_backend
+from sqlauth.backend.columnar import Columns
+from sqlauth.twisted import statements
+from sqlauth.twisted.statements import StatementRegistry
+from sqlauth.twisted import logger
+
+# %(name)s placeholders, and the literal %% escape
+_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%%')
+
+#
+# sqlbridge hands back every column as text, and the code on top of it
+# (check_permission, UserDb, AclTrie) expects that.  booleans are 't' and 'f'
+# like postgres writes them.
+#
+def _text(v):
+    if v is None:
+        return None
+    if isinstance(v, bool):
+        return 't' if v else 'f'
+    if isinstance(v, six.text_type):
+        return v.encode('utf8')
+    return str(v)
+
+class DirectDb(object):
+    """
+    database access without the wamp round trip, same call() as an app_session
+    """
+
+    #
+    # engine    -> any engine name sqlauth.backend knows (PG9_4, SQLITE3, MYSQL ...)
+    # dsn       -> postgres: 'dbname=autobahn host=localhost user=autouser'
+    #              sqlite: 'database=/var/lib/sqlauth/auth.db'
+    #              mysql: 'db=autobahn host=localhost user=autouser passwd=x'
+    # topic_base -> the router's topic base, 'sys'.  the queries answered here
+    #              are topic_base.db.query, topic_base.db.operation, and the
+    #              topic_base.session.* and topic_base.activity.* calls SessionDb makes.
+    # app_session -> where every other call goes, optional
+    # prepare   -> on postgres PREPARE the hot path statements (see statements.py)
+    #              on each pooled connection.  they are timed either way.
+    #
+    def __init__(self, engine, dsn, topic_base, debug=False, app_session=None,
+            min_conn=2, max_conn=5, prepare=True):
+        logger.start(debug is not None and debug)
+        log.msg("DirectDb:__init__({})".format(engine))
+        self.engine = engine
+        self.dsn = dsn
+        self.topic_base = topic_base
+        self.debug = debug
+        self.app_session = app_session
+
+        self.statements = StatementRegistry()
+        self.statements.register('login', statements.LOGIN_QUERY)
+        self.statements.register('permission', statements.PERMISSION_QUERY, statements.PERMISSION_PREPARE)
+        self.statements.register('session_add', statements.SESSION_ADD)
+        self.statements.register('session_delete', statements.SESSION_DELETE)
+        self.statements.register('activity_add', statements.ACTIVITY_ADD)
+
+        self.backend = get_backend(engine, self.query)
+        self.backend.set_runner(self.query, self.query_columns)
+        self.paramstyle = self.backend.paramstyle
+        openfun = None
+        if prepare and self.backend.can_prepare:
+            openfun = self.statements.prepare_connection
+        self.pool = self.backend.connect(dsn, min_conn=min_conn, max_conn=max_conn, openfun=openfun)
+
+        db = topic_base + '.db'
+        self.procedures = {
+            db + '.query': self._call_query,
+            db + '.operation': self._call_operation,
+            topic_base + '.session.add': self.session_add,
+            topic_base + '.session.delete': self.session_delete,
+            topic_base + '.activity.add': self.activity_add,
+            topic_base + '.activity.addbatch': self.activity_addbatch,
+            topic_base + '.activity.rollup': self.activity_rollup,
+        }
+
+        return
+
+    def set_session(self, app_session):
+        log.msg("DirectDb:set_session()")
+        self.app_session = app_session
+
+        return
+
+    # per statement call counts and timings
+    def stats(self):
+        return self.statements.stats()
+
+    def close(self):
+        log.msg("DirectDb:close() statements {}".format(self.stats()))
+        # at reactor shutdown the pool closes itself first
+        if self.pool.running:
+            self.pool.close()
+
+        return
+
+    #
+    # the app_session interface.  options (CallOptions) doesn't mean anything
+    # here and is dropped.
+    #
+    def call(self, procedure, *args, **kwargs):
+        fn = self.procedures.get(procedure)
+        if fn is None:
+            if self.app_session is None:
+                return defer.fail(Exception("DirectDb: no direct path for {}".format(procedure)))
+            return self.app_session.call(procedure, *args, **kwargs)
+        kwargs.pop('options', None)
+        return fn(*args, **kwargs)
+
+    #
+    # rewrite a %(name)s statement for the driver.  tuples and lists become
+    # ( a, b, c ), for 'in', like sqlbridge does.
+    #
+    def _prepare(self, s, a):
+        if a is None:
+            a = {}
+        if self.paramstyle == 'pyformat':
+            pa = {}
+            for k, v in a.items():
+                pa[k] = tuple(v) if isinstance(v, list) else v
+            return s, pa
+
+        pa = {}
+        def sub(m):
+            k = m.group(1)
+            if k is None:
+                return '%'
+            v = a[k]
+            if isinstance(v, ( tuple, list, )):
+                names = []
+                for i in range(len(v)):
+                    pa[k + '_' + str(i)] = v[i]
+                    names.append(':' + k + '_' + str(i))
+                return '(' + ','.join(names) + ')'
+            pa[k] = v
+            return ':' + k
+        return _PLACEHOLDER.sub(sub, s), pa
+
+    def _execute(self, cur, s, a):
+        st = self.statements.find(s)
+        if st is not None:
+            return self.statements.run(cur, st, a or {}, self._execute_sql)
+        return self._execute_sql(cur, s, a)
+
+    # a prepared EXECUTE already has driver ready arguments
+    def _execute_sql(self, cur, s, a, prepared=False):
+        if not prepared:
+            s, a = self._prepare(s, a)
+        if self.debug:
+            log.msg("DirectDb._execute({} with args {})".format(s, a))
+        cur.execute(s, a)
+        if cur.description is None:
+            return []
+        names = [ d[0] for d in cur.description ]
+        return [ dict(zip(names, [ _text(v) for v in r ])) for r in cur.fetchall() ]
+
+    def _run(self, conn, s, a):
+        cur = conn.cursor()
+        try:
+            if isinstance(s, list):
+                # a list of statements is a transaction, like sqlbridge
+                return [ self._execute(cur, q, a) for q in s ]
+            return self._execute(cur, s, a)
+        finally:
+            cur.close()
+
+    # query, s can be a single statement or a list run in one transaction
+    def query(self, s, a=None):
+        return self.pool.runWithConnection(self._run, s, a)
+
+    #
+    # one statement, the result as columnar.Columns, [ headers, row ... ]
+    # with each row a tuple straight from the cursor, no dictionaries
+    #
+    def _run_columns(self, conn, s, a):
+        cur = conn.cursor()
+        try:
+            s, a = self._prepare(s, a)
+            if self.debug:
+                log.msg("DirectDb._run_columns({} with args {})".format(s, a))
+            cur.execute(s, a)
+            if cur.description is None:
+                return Columns()
+            rv = Columns()
+            rv.append([ d[0] for d in cur.description ])
+            rv.extend([ tuple(map(_text, r)) for r in cur.fetchall() ])
+            return rv
+        finally:
+            cur.close()
+
+    def query_columns(self, s, a=None):
+        return self.pool.runWithConnection(self._run_columns, s, a)
+
+    def operation(self, s, a=None):
+        d = self.pool.runWithConnection(self._run, s, a)
+        d.addCallback(lambda _: None)
+        return d
+
+    def _call_query(self, s, a=None, **kwargs):
+        return self.query(s, a)
+
+    def _call_operation(self, s, a=None, **kwargs):
+        return self.operation(s, a)
+
+    #
+    # the calls SessionDb makes, same action_args as the sqlauthrpc versions.
+    # the results aren't used by SessionDb, so nothing is returned from the
+    # inserts beyond a count.
+    #
+    def session_add(self, action_args=None, **kwargs):
+        return self.operation(statements.SESSION_ADD, dict({ 'router_epoch': None }, **action_args))
+
+    def session_delete(self, action_args=None, **kwargs):
+        return self.operation(statements.SESSION_DELETE, action_args)
+
+    def activity_add(self, action_args=None, **kwargs):
+        return self.operation(statements.ACTIVITY_ADD, action_args)
+
+    # the set based versions from the engine's backend
+    def activity_addbatch(self, action_args=None, **kwargs):
+        return self.backend.activity_addbatch(action_args['activity'])
+
+    def activity_rollup(self, action_args=None, **kwargs):
+        return self.backend.activity_rollup(action_args['activity'])
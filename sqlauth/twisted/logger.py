@@ -0,0 +1,159 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## logger.py - level gated, lazily formatted logging for the hot paths
+##
+## the format string and its arguments are handed over as they are, and
+## only formatted (and passed to twisted's log.msg) when the level is on:
+##   log = logger.Logger('AuthorizeRouter')
+##   log.debug("authorize: {} {} {}", authid, uri, action)
+## so a debug line costs a level check unless the router runs --verbose.
+## the process has one level, WARN unless start() is asked for verbose,
+## which also starts twisted logging to stdout, once, however many
+## components ask.
+##
+## a Logger can be limited, for lines that come with every message:
+##   rate   -> at most this many lines a second
+##   sample -> only every sample'th line
+## the next line that gets through says how many were left out.  the
+## loggers made with hot=True (one line per message) are limited together
+## with limit(), the router's --log-rate and --log-sample.
+###############################################################################
+
+import sys
+import time
+import logging
+
+from twisted.python import log
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARN = logging.WARNING
+ERROR = logging.ERROR
+
+# the process' level, see start() and set_level()
+level = WARN
+_started = False
+# the hot=True loggers, and the rate and sample they get, see limit()
+_hot = []
+_limits = { 'rate': 0, 'sample': 0 }
+
+def set_level(lv):
+    global level
+    level = lv
+
+    return
+
+#
+# what the components call with their debug flag, in place of
+# log.startLogging.  verbose turns on everything and logs to stdout.
+#
+def start(verbose=False):
+    global _started
+    if not verbose:
+        return
+    set_level(DEBUG)
+    if not _started:
+        _started = True
+        log.startLogging(sys.stdout)
+
+    return
+
+def enabled(lv):
+    return lv >= level
+
+def limit(rate=0, sample=0):
+    _limits['rate'] = rate
+    _limits['sample'] = sample
+    for l in _hot:
+        l.rate = rate
+        l.sample = sample
+
+    return
+
+class Logger(object):
+    """
+    one component's log lines, named after it
+    """
+
+    def __init__(self, name, rate=0, sample=0, hot=False):
+        self.name = name
+        self.rate = rate
+        self.sample = sample
+        if hot:
+            self.rate = rate or _limits['rate']
+            self.sample = sample or _limits['sample']
+            _hot.append(self)
+        self.seen = 0
+        self.skipped = 0
+        self.window = 0
+        self.in_window = 0
+
+        return
+
+    # should this line go out, given rate and sample
+    def _admit(self):
+        self.seen += 1
+        if self.sample > 1 and self.seen % self.sample != 0:
+            self.skipped += 1
+            return False
+        if self.rate > 0:
+            now = int(time.time())
+            if now != self.window:
+                self.window = now
+                self.in_window = 0
+            if self.in_window >= self.rate:
+                self.skipped += 1
+                return False
+            self.in_window += 1
+        return True
+
+    def _emit(self, lv, fmt, args, kwargs):
+        if (self.rate > 0 or self.sample > 1) and not self._admit():
+            return
+        try:
+            s = fmt.format(*args, **kwargs) if args or kwargs else fmt
+        except Exception as e:
+            s = "{} (bad log format: {} {})".format(fmt, args, e)
+        if self.skipped > 0:
+            s = "{} ({} left out)".format(s, self.skipped)
+            self.skipped = 0
+        log.msg("{}.{}".format(self.name, s), logLevel=lv)
+
+        return
+
+    def debug(self, fmt, *args, **kwargs):
+        if DEBUG < level:
+            return
+        self._emit(DEBUG, fmt, args, kwargs)
+
+    def info(self, fmt, *args, **kwargs):
+        if INFO < level:
+            return
+        self._emit(INFO, fmt, args, kwargs)
+
+    def warn(self, fmt, *args, **kwargs):
+        if WARN < level:
+            return
+        self._emit(WARN, fmt, args, kwargs)
+
+    def error(self, fmt, *args, **kwargs):
+        if ERROR < level:
+            return
+        self._emit(ERROR, fmt, args, kwargs)
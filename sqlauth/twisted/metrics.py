@@ -0,0 +1,304 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## metrics.py - counters and latency histograms for the router's hot path
+##
+## registry is the one Registry of the process.  the modules on the hot path
+## declare what they count when they are imported, and count as they go:
+##   AUTHORIZE = metrics.registry.counter('sqlauth_authorize_total',
+##       'authorization decisions', ( 'decision', 'path', ))
+##   AUTHORIZE.inc('allow', 'cache')
+## label values are given in the order the labels were declared.  a
+## histogram counts observations into fixed buckets (seconds), so the cost
+## per observation is the same however long the router runs.
+##
+## gauges are read when the registry is (a function), and collect() adds a
+## component's stats() dictionary as it is, so the numbers the components
+## already keep come along.
+##
+## the router serves snapshot() on topic_base.metrics.get, publishes it on
+## topic_base.metrics, and with --metrics-port serves prometheus() over
+## http, see MetricsResource.
+###############################################################################
+
+import time
+import types as vtypes
+
+from twisted.internet import defer
+from twisted.web import resource
+
+# seconds
+BUCKETS = ( 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, )
+
+class Counter(object):
+    """
+    a count for each combination of label values
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+        return
+
+    def inc(self, *values):
+        self.values[values] = self.values.get(values, 0) + 1
+
+        return
+
+    def snapshot(self):
+        return [ [ list(k), v ] for k, v in self.values.items() ]
+
+    def samples(self):
+        return [ ( '', k, v ) for k, v in self.values.items() ]
+
+class Histogram(object):
+    """
+    observations counted into buckets, with their count and sum, for each
+    combination of label values
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+        return
+
+    def observe(self, v, *values):
+        h = self.values.get(values)
+        if h is None:
+            # one count per bucket and one past the last, then count and sum
+            h = self.values[values] = [ 0 ] * (len(self.buckets) + 1) + [ 0, 0.0 ]
+        i = 0
+        for b in self.buckets:
+            if v <= b:
+                break
+            i += 1
+        h[i] += 1
+        h[-2] += 1
+        h[-1] += v
+
+        return
+
+    # the time since start, from time.time()
+    def since(self, start, *values):
+        self.observe(time.time() - start, *values)
+
+        return
+
+    # d (a deferred, or a value) timed from start, either way it turns out
+    def track(self, d, start, *values):
+        if not isinstance(d, defer.Deferred):
+            self.since(start, *values)
+            return d
+        def done(r):
+            self.since(start, *values)
+            return r
+        return d.addBoth(done)
+
+    # the upper bound of the bucket the q quantile falls in, '+Inf' past
+    # the last one (a string, json has no infinity)
+    def quantile(self, h, q):
+        n = h[-2]
+        if n == 0:
+            return None
+        want = q * n
+        accum = 0
+        for i in range(len(self.buckets)):
+            accum += h[i]
+            if accum >= want:
+                return self.buckets[i]
+        return '+Inf'
+
+    def snapshot(self):
+        rv = []
+        for k, h in self.values.items():
+            rv.append([ list(k), { 'count': h[-2], 'sum': h[-1],
+                'p50': self.quantile(h, 0.5), 'p99': self.quantile(h, 0.99) } ])
+        return rv
+
+    def samples(self):
+        rv = []
+        for k, h in self.values.items():
+            accum = 0
+            for i in range(len(self.buckets)):
+                accum += h[i]
+                rv.append(( '_bucket', k + ( ( 'le', str(self.buckets[i]) ), ), accum ))
+            rv.append(( '_bucket', k + ( ( 'le', '+Inf' ), ), h[-2] ))
+            rv.append(( '_sum', k, h[-1] ))
+            rv.append(( '_count', k, h[-2] ))
+        return rv
+
+class Gauge(object):
+    """
+    a number read from fn when the registry is read
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.labels = ()
+        self.fn = fn
+
+        return
+
+    def snapshot(self):
+        return [ [ [], self.fn() ] ]
+
+    def samples(self):
+        return [ ( '', (), self.fn() ) ]
+
+class Registry(object):
+    """
+    every metric of the process, by name
+    """
+
+    def __init__(self, prefix='sqlauth'):
+        self.prefix = prefix
+        self.metrics = {}
+        self.collectors = {}
+
+        return
+
+    # declared twice (a module reloaded, a second router) is the same metric
+    def _add(self, cls, name, *args):
+        m = self.metrics.get(name)
+        if m is None or not isinstance(m, cls):
+            m = self.metrics[name] = cls(name, *args)
+        return m
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self._add(Histogram, name, help, labels, buckets)
+
+    # a gauge is replaced, fn belongs to whoever declared it last
+    def gauge(self, name, help, fn):
+        self.metrics[name] = Gauge(name, help, fn)
+        return self.metrics[name]
+
+    # name -> fn, fn returning a dictionary, like the components' stats()
+    def collect(self, name, fn):
+        self.collectors[name] = fn
+
+        return
+
+    #
+    # everything, for topic_base.metrics.get and the publish.  each metric is
+    #   { 'type':'counter', 'help':..., 'labels':[ 'decision', 'path' ],
+    #     'values':[ [ [ 'allow', 'cache' ], 12 ], ... ] }
+    # a histogram's value is { count, sum, p50, p99 }, the quantiles being
+    # bucket bounds.  collectors are under 'stats', as they come.
+    #
+    def snapshot(self):
+        rv = { 'time': time.time(), 'metrics': {}, 'stats': {} }
+        for name, m in self.metrics.items():
+            rv['metrics'][name] = { 'type': m.kind, 'help': m.help, 'labels': list(m.labels),
+                'values': m.snapshot() }
+        for name, fn in self.collectors.items():
+            try:
+                rv['stats'][name] = fn()
+            except Exception as e:
+                rv['stats'][name] = { 'error': "{}".format(e) }
+        return rv
+
+    #
+    # the prometheus text format.  the numbers in the collectors' dictionaries
+    # become gauges, prefix_name_key (prefix_name_key_subkey for a dictionary
+    # in the dictionary, like DirectDb's per statement stats), anything else
+    # in them is left out.
+    #
+    def prometheus(self):
+        lines = []
+        for name in sorted(self.metrics.keys()):
+            m = self.metrics[name]
+            lines.append("# HELP {} {}".format(name, m.help))
+            lines.append("# TYPE {} {}".format(name, m.kind))
+            for suffix, values, v in m.samples():
+                pairs = list(zip(m.labels, values[:len(m.labels)])) + list(values[len(m.labels):])
+                lines.append("{}{}{} {}".format(name, suffix, _labels(pairs), _number(v)))
+        for cname in sorted(self.collectors.keys()):
+            try:
+                st = self.collectors[cname]()
+            except Exception:
+                continue
+            for k, v in _flat(st):
+                name = _name("{}_{}_{}".format(self.prefix, cname, k))
+                lines.append("# TYPE {} gauge".format(name))
+                lines.append("{} {}".format(name, _number(v)))
+        return '\n'.join(lines) + '\n'
+
+# ( key, number ) for each number in d, nested keys joined with _
+def _flat(d, prefix=''):
+    rv = []
+    for k in sorted(d.keys()):
+        v = d[k]
+        if isinstance(v, vtypes.DictType):
+            rv.extend(_flat(v, prefix + str(k) + '_'))
+        elif isinstance(v, ( int, long, float, )) and not isinstance(v, vtypes.BooleanType):
+            rv.append(( prefix + str(k), v ))
+    return rv
+
+# metric names are letters, digits and _
+def _name(s):
+    return ''.join([ c if c.isalnum() or c == '_' else '_' for c in s ])
+
+def _labels(pairs):
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join([ '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in pairs ]) + '}'
+
+def _number(v):
+    if v is None:
+        return 'NaN'
+    if isinstance(v, float):
+        return repr(v)
+    return str(v)
+
+registry = Registry()
+
+class MetricsResource(resource.Resource):
+    """
+    the registry in prometheus text, for --metrics-port
+    """
+
+    isLeaf = True
+
+    def __init__(self, registry=registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+        return
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'text/plain; version=0.0.4')
+        return self.registry.prometheus().encode('utf8')
@@ -0,0 +1,168 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## notifylistener.py - change notices from postgres, for every router
+##
+## the triggers migration 5 puts on login, role, topic, loginrole and
+## topicrole NOTIFY CHANNEL with a json change notice, the same dictionary
+## sqlauthrpc publishes on topic_base.invalidate:
+##   { "table":"loginrole", "login_id":5 }
+##   { "table":"topicrole", "topic":"com.db", "role_id":3 }
+##   { "table":"login", "login":"greg", "login_id":5 }
+## so a change made through any sqlauthrpc (or by hand in psql) reaches
+## every router on the database, not just the one sqlauthrpc is connected to.
+##
+## the LISTEN is sqlbridge's topic_base.watch, which publishes each
+## notification's payload on a topic of its own.  to find out if notices
+## are being missed (the connection went away, the LISTEN with it) a ping is
+## sent through the channel every check seconds.  if the last one never came
+## back everything is invalidated, the full reload fallback.
+##
+## a change to a role can't be narrowed to logins or topics by the caches,
+## so its notice invalidates every permission.
+###############################################################################
+
+import sys
+import json
+
+from twisted.python import log
+from twisted.internet import defer, reactor, task
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import LoopingCall
+from autobahn import util
+from autobahn.wamp import types
+
+from sqlauth.twisted import logger
+
+CHANNEL = 'sqlauth_invalidate'
+
+class NotifyListener(object):
+    """
+    turns the database's change notices into invalidate calls
+    """
+
+    #
+    # app_session -> a joined session that can call topic_base.watch and subscribe
+    # topic_base  -> 'sys.db'
+    # on_change   -> called with each change notice (a dictionary), {} is everything
+    # check       -> seconds between pings, 0 never checks
+    #
+    def __init__(self, app_session, topic_base, on_change, channel=CHANNEL, check=30.0,
+            debug=False):
+        logger.start(debug is not None and debug)
+        log.msg("NotifyListener:__init__({})".format(channel))
+        self.app_session = app_session
+        self.topic_base = topic_base
+        self.on_change = on_change
+        self.channel = channel
+        self.check_interval = check
+        self.debug = debug
+
+        # our pings, others' are ignored
+        self.id = util.newid()
+        self.sent = 0
+        self.pending = None
+
+        self.notices = 0
+        self.missed = 0
+        self._loop = None
+
+        return
+
+    #
+    # LISTEN, through sqlbridge.  the database connection may not be up
+    # yet, so it is tried tries times, wait seconds apart.  only postgres has
+    # LISTEN, the other engines never get past this (the notices published
+    # by sqlauthrpc still arrive).  returns True if it worked.
+    #
+    @inlineCallbacks
+    def start(self, tries=30, wait=1.0):
+        log.msg("NotifyListener.start({})".format(self.channel))
+        topic = None
+        for i in range(tries):
+            try:
+                topic = yield self.app_session.call(self.topic_base + '.watch', self.channel,
+                    options=types.CallOptions(timeout=2000,discloseMe=True))
+                yield self.app_session.subscribe(self.notice, topic)
+                break
+            except Exception as e:
+                topic = None
+                log.msg("NotifyListener.start(try {},error{})".format(i + 1, e))
+                yield task.deferLater(reactor, wait, lambda: None)
+        if topic is None:
+            log.msg("NotifyListener.start: no notices from the database")
+            defer.returnValue(False)
+        log.msg("NotifyListener.start: notices arrive on {}".format(topic))
+        if self.check_interval > 0 and self._loop is None:
+            self._loop = LoopingCall(self.check)
+            self._loop.start(self.check_interval, now=False)
+        defer.returnValue(True)
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+        return
+
+    def notice(self, payload):
+        try:
+            change = json.loads(payload)
+        except (TypeError, ValueError):
+            log.msg("NotifyListener.notice: not json {}".format(payload))
+            return
+        if 'ping' in change:
+            if change['ping'] == self.pending:
+                self.pending = None
+            return
+        log.msg("NotifyListener.notice({})".format(change))
+        self.notices += 1
+        self.on_change(change)
+
+        return
+
+    #
+    # the ping sent last time should be back by now.  if it isn't notices
+    # may have been lost, so everything is invalidated.
+    #
+    @inlineCallbacks
+    def check(self):
+        if self.pending is not None:
+            self.missed += 1
+            log.msg("NotifyListener.check: ping {} never came back, invalidating everything".format(self.pending))
+            # {} is every permission, the credentials go with a login notice
+            self.on_change({})
+            self.on_change({ 'table': 'login' })
+        self.sent += 1
+        self.pending = "{}-{}".format(self.id, self.sent)
+        try:
+            yield self.app_session.call(self.topic_base + '.operation',
+                "select pg_notify(%(channel)s, %(payload)s)",
+                { 'channel': self.channel, 'payload': json.dumps({ 'ping': self.pending }) },
+                options=types.CallOptions(timeout=2000,discloseMe=True))
+        except Exception as e:
+            log.msg("NotifyListener.check: ping error {}".format(e))
+
+        return
+
+    def stats(self):
+        return {
+            'notices': self.notices,
+            'missed': self.missed
+        }
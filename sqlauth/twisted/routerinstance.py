@@ -0,0 +1,158 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## routerinstance.py - one of several routers sharing a sqlauth database
+##
+## each router keeps a row in router_instance, its id is the router's epoch
+## (SessionDb.epoch, stamped on every session it opens), and beats it every
+## interval seconds.  a router that misses Backend.ROUTER_MISSED beats is
+## gone: on its next beat any live router closes the gone one's sessions
+## and drops its row.  so sessions of a live router are never taken for
+## stale, and sessions of a crashed one don't stay open for long.
+##
+## every router sharing the database has to beat, the sessions of one that
+## doesn't are closed as if it were gone.
+###############################################################################
+
+import sys
+import time
+import socket
+
+from twisted.python import log
+from twisted.internet import defer, reactor, task
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import LoopingCall
+from autobahn.wamp import types
+
+from sqlauth.twisted import logger
+
+from sqlauth.backend import get_backend
+
+class RouterInstance(object):
+    """
+    this router's row in router_instance, with heartbeats
+    """
+
+    #
+    # engine     -> the database engine, like the router's --engine
+    # topic_base -> 'sys.db', the queries go to topic_base.query on app_session
+    # epoch      -> this router's id, SessionDb.epoch
+    # interval   -> seconds between heartbeats
+    #
+    def __init__(self, engine, topic_base, epoch, interval=10.0,
+            debug=False, app_session=None):
+        logger.start(debug is not None and debug)
+        log.msg("RouterInstance:__init__({} every {} seconds)".format(epoch, interval))
+        self.topic_base = topic_base
+        self.query = topic_base + '.query'
+        self.epoch = epoch
+        self.interval = interval
+        self.debug = debug
+        self.app_session = app_session
+        self.backend = get_backend(engine, self._query)
+        self.host = socket.gethostname()
+        self.started = int(time.time())
+
+        self.beats = 0
+        self.failed = 0
+        self._loop = None
+
+        return
+
+    def set_session(self, app_session):
+        log.msg("RouterInstance:set_session()")
+        self.app_session = app_session
+
+        return
+
+    def _query(self, s, a):
+        return self.app_session.call(self.query, s, a,
+            options=types.CallOptions(timeout=2000,discloseMe=True))
+
+    #
+    # one heartbeat, then the gone routers are reaped
+    #
+    @inlineCallbacks
+    def _beat(self):
+        now = int(time.time())
+        yield self.backend.router_beat({ 'id': self.epoch, 'host': self.host,
+            'started': self.started, 'now': now, 'beat_interval': int(self.interval) })
+        yield self.backend.router_reap(now)
+        self.beats += 1
+
+        return
+
+    @inlineCallbacks
+    def beat(self):
+        try:
+            yield self._beat()
+        except Exception as e:
+            self.failed += 1
+            log.msg("RouterInstance.beat: error {}".format(e))
+
+        return
+
+    #
+    # run before the router listens, in place of SessionDb.recover: the
+    # first beat, which closes the sessions of the gone routers (an earlier
+    # run of this one among them).  the database may not be reachable yet,
+    # so it is tried tries times, wait seconds apart.  returns True if it
+    # worked.
+    #
+    @inlineCallbacks
+    def recover(self, tries=30, wait=1.0):
+        log.msg("RouterInstance.recover({})".format(self.epoch))
+        done = False
+        for i in range(tries):
+            try:
+                yield self._beat()
+                done = True
+                break
+            except Exception as e:
+                log.msg("RouterInstance.recover(try {},error{})".format(i + 1, e))
+                yield task.deferLater(reactor, wait, lambda: None)
+        defer.returnValue(done)
+
+    def start(self):
+        log.msg("RouterInstance.start(every {} seconds)".format(self.interval))
+        if self._loop is None:
+            self._loop = LoopingCall(self.beat)
+            self._loop.start(self.interval, now=False)
+
+        return
+
+    # stop beating and leave, the other routers stop counting on this one
+    @inlineCallbacks
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        try:
+            yield self.backend.router_stop(self.epoch)
+        except Exception as e:
+            log.msg("RouterInstance.stop: error {}".format(e))
+
+        return
+
+    def stats(self):
+        return {
+            'epoch': self.epoch,
+            'beats': self.beats,
+            'failed': self.failed
+        }
@@ -26,6 +26,7 @@
 import six,sys,logging
 
 from twisted.python import log
+from twisted.internet import reactor, task
 from twisted.internet.defer import inlineCallbacks
 
 from autobahn import util
@@ -37,6 +38,16 @@ from autobahn.twisted.wamp import RouterSession
 from twisted.internet import defer
 from autobahn.twisted.wamp import ApplicationSession
 
+from sqlauth.twisted.activitywriter import ActivityWriter, ActivityRollup
+from sqlauth.twisted import statements
+from sqlauth.twisted import metrics
+from sqlauth.twisted import logger
+
+SESSIONDB = metrics.registry.counter('sqlauth_sessiondb_total',
+    'session and activity writes, by op (add, delete, activity) and result (ok, error, queued)', ( 'op', 'result', ))
+
+LOG = logger.Logger('SessionDb', hot=True)
+
 class SessionDb(object):
     """
     A session database.
@@ -51,18 +62,46 @@ class SessionDb(object):
     # this only actively tracks 'active' sessions.  once terminated they are no
     # longer available through this interface (like list/get).
     #
-    def __init__(self, topic_base, debug=False, app_session=None):
-        if debug is not None and debug:
-            log.startLogging(sys.stdout)
-        log.msg("SessionDb:__init__()")
+    # activity is recorded one rpc per event unless batch_size is set, then it is
+    # queued and written batch_size records (or batch_interval seconds) at a time
+    # through topic_base.activity.addbatch. batch_max bounds the queue.
+    # with rollup_interval set activity is only counted, and the counts are added
+    # to the activity_rollup table every rollup_interval seconds through
+    # topic_base.activity.rollup.
+    #
+    # epoch names this run of the router, every session it opens is stamped
+    # with it (session.router_epoch).  a new one is made up if not given.
+    #
+    def __init__(self, topic_base, debug=False, app_session=None,
+            batch_size=0, batch_interval=1.0, batch_max=50000, rollup_interval=0,
+            epoch=None):
+        logger.start(debug is not None and debug)
+        self.epoch = epoch if epoch is not None else util.newid()
+        log.msg("SessionDb:__init__(epoch {})".format(self.epoch))
         self._sessiondb = {}
         self.app_session = app_session
         self.topic_base = topic_base
         self.debug = debug
         self.system_sessions = None
+        self.writer = None
+        if rollup_interval > 0:
+            self.writer = ActivityRollup(self._activity_rollup, interval=rollup_interval,
+                max_keys=batch_max)
+            self.writer.start()
+        elif batch_size > 0:
+            self.writer = ActivityWriter(self._activity_batch, batch_size=batch_size,
+                interval=batch_interval, max_pending=batch_max)
+            self.writer.start()
 
         return
 
+    # write out queued activity, called at shutdown
+    def flush(self):
+        log.msg("SessionDb:flush()")
+        if self.writer is not None:
+            return self.writer.stop()
+        return defer.succeed(None)
+
     # this sets the autobahn application that we run against for call,register,publish,subscribe
     def set_session(self, app_session):
         log.msg("SessionDb:set_session()")
@@ -90,49 +129,102 @@ class SessionDb(object):
     # term persistence, a database.
     @inlineCallbacks
     def add(self, authid, sessionid, session_body):
-        log.msg("SessionDb.add({},sessionid:{})".format(authid,sessionid))
+        LOG.debug("add({},sessionid:{})", authid, sessionid)
         # first, we remember the session internally in our object store
         self._sessiondb[sessionid] = session_body
         # then record the session in the database
-        log.msg("SessionDb.add({}session:{})".format(authid,sessionid))
+        LOG.debug("add({}session:{})", authid, sessionid)
         try:
             rv = yield self.app_session.call(self.topic_base+'.session.add',
-                action_args={ 'login_id':authid, 'ab_session_id':sessionid },
+                action_args={ 'login_id':authid, 'ab_session_id':sessionid, 'router_epoch':self.epoch },
                 options = types.CallOptions(timeout=2000,discloseMe = True))
+            SESSIONDB.inc('add', 'ok')
             defer.returnValue(rv)
         except Exception as e:
             # if we get an error we don't really care, it just means that the session
             # isn't recorded in the database.  maybe the database doesn't exist yet.
-            log.msg("SessionDb.add({}-{},error{})".format(authid,sessionid,e))
+            SESSIONDB.inc('add', 'error')
+            LOG.warn("add({}-{},error{})", authid, sessionid, e)
             pass
-        log.msg("SessionDb.add({},body:{})".format(authid,session_body))
+        LOG.debug("add({},body:{})", authid, session_body)
 
         return
 
+    #
+    # crash recovery, run before the router listens.  a router that stopped
+    # without closing its sessions leaves them open in the database, so
+    # every open session not stamped with this epoch is closed, in one
+    # statement.  the database may not be reachable yet, so it is tried
+    # tries times, wait seconds apart.  returns True if it worked.
+    #
     @inlineCallbacks
-    def activity(self, ab_session_id, topic_name, type_id, allow):
-        log.msg("SessionDb.activity({},{},{},{})".format(ab_session_id,
-            topic_name,type_id,allow))
-        if topic_name != self.topic_base+'.activity.add':
+    def recover(self, tries=30, wait=1.0):
+        log.msg("SessionDb.recover(epoch {})".format(self.epoch))
+        done = False
+        for i in range(tries):
             try:
-                rv = yield self.app_session.call(self.topic_base+'.activity.add',
-                    action_args={ 'ab_session_id':ab_session_id,
-                        'topic_name':topic_name,
-                        'type_id':type_id,
-                        'allow':allow},
+                yield self.app_session.call(self.topic_base+'.db.operation',
+                    statements.SESSION_RECOVER, { 'router_epoch':self.epoch },
                     options = types.CallOptions(timeout=2000,discloseMe = True))
-                defer.returnValue(rv)
+                done = True
+                break
             except Exception as e:
-                # if we get an error we don't really care, it just means that the activity
-                # isn't recorded in the database.  maybe the database doesn't exist yet.
-                log.msg("SessionDb.activity({},error{})".format(ab_session_id,e))
-                pass
-        else:
+                log.msg("SessionDb.recover(try {},error{})".format(i + 1, e))
+                yield task.deferLater(reactor, wait, lambda: None)
+        log.msg("SessionDb.recover({})".format('stale sessions closed' if done else 'gave up'))
+        defer.returnValue(done)
+
+    @inlineCallbacks
+    def activity(self, ab_session_id, topic_name, type_id, allow):
+        LOG.debug("activity({},{},{},{})", ab_session_id, topic_name, type_id, allow)
+        if topic_name in ( self.topic_base+'.activity.add', self.topic_base+'.activity.addbatch',
+                self.topic_base+'.activity.rollup', ):
+            defer.returnValue([])
+        if self.writer is not None:
+            self.writer.add({ 'ab_session_id':ab_session_id,
+                'topic_name':topic_name,
+                'type_id':type_id,
+                'allow':allow})
+            SESSIONDB.inc('activity', 'queued')
             defer.returnValue([])
-        log.msg("SessionDb.activity({},done)".format(ab_session_id))
+        try:
+            rv = yield self.app_session.call(self.topic_base+'.activity.add',
+                action_args={ 'ab_session_id':ab_session_id,
+                    'topic_name':topic_name,
+                    'type_id':type_id,
+                    'allow':allow},
+                options = types.CallOptions(timeout=2000,discloseMe = True))
+            SESSIONDB.inc('activity', 'ok')
+            defer.returnValue(rv)
+        except Exception as e:
+            # if we get an error we don't really care, it just means that the activity
+            # isn't recorded in the database.  maybe the database doesn't exist yet.
+            SESSIONDB.inc('activity', 'error')
+            LOG.warn("activity({},error{})", ab_session_id, e)
+            pass
+        LOG.debug("activity({},done)", ab_session_id)
 
         return
 
+    # the writer's flush function, one rpc for the whole batch.  errors are
+    # passed back to the writer so it can count them.
+    def _activity_batch(self, batch):
+        log.msg("SessionDb._activity_batch({} records)".format(len(batch)))
+        return self.app_session.call(self.topic_base+'.activity.addbatch',
+            action_args={ 'activity':batch },
+            options = types.CallOptions(timeout=2000,discloseMe = True))
+
+    # the rollup's flush function, the counts since the last flush
+    def _activity_rollup(self, batch):
+        log.msg("SessionDb._activity_rollup({} counters)".format(len(batch)))
+        return self.app_session.call(self.topic_base+'.activity.rollup',
+            action_args={ 'activity':batch },
+            options = types.CallOptions(timeout=2000,discloseMe = True))
+
+    # how many sessions are open on this router
+    def count(self):
+        return len(self._sessiondb)
+
     # return a dictionary of all of the in memory sessions. this is used
     # by the session.list call which compares its sessions with the memory
     # ones, only the memory ones are listed.  old sessions can be in the database
@@ -144,16 +236,22 @@ class SessionDb(object):
             s[k] = { 'authid': self._sessiondb[k]._authid }
         return(s)
 
-    # delete in memory and possible persistent session record.
+    # delete in memory and possible persistent session record.  the session's
+    # queued activity is written first, the database ties it to the session
+    # by ab_session_id, which the delete takes away.
     @inlineCallbacks
     def delete(self, sessionid):
-        log.msg("SessionDb.delete({})".format(sessionid))
+        LOG.debug("delete({})", sessionid)
+        if self.writer is not None:
+            yield self.writer.flush_session(sessionid)
         try:
             rv = yield self.app_session.call(self.topic_base+'.session.delete',
                 action_args={ 'ab_session_id':sessionid },
                 options = types.CallOptions(timeout=2000,discloseMe = True))
+            SESSIONDB.inc('delete', 'ok')
         except Exception as e:
-            log.msg("SessionDb.delete({},error{})".format(sessionid,e))
+            SESSIONDB.inc('delete', 'error')
+            LOG.warn("delete({},error{})", sessionid, e)
             pass
 
         try:
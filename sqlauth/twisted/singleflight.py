@@ -0,0 +1,87 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## singleflight.py - coalesce identical lookups that are in flight together
+##
+## when a few hundred sessions for the same login subscribe to the same topic
+## at once they all ask the database the same question.  the first caller for
+## a key does the lookup, everyone who asks for that key before it comes back
+## waits on the same answer.  once the answer is in the key is forgotten, the
+## next caller does a fresh lookup (caching is somebody else's job).
+###############################################################################
+
+from twisted.python import log
+from twisted.internet import defer
+
+class SingleFlight(object):
+    """
+    one outstanding lookup per key, shared by every concurrent caller
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self.issued = 0
+        self.coalesced = 0
+
+        return
+
+    #
+    # do(key, fn, *args, **kwargs) -> deferred
+    # fn is only called if there isn't already a lookup for key in flight.
+    # every caller gets its own deferred, so one caller's callbacks can't
+    # change the result another caller sees.  failures are shared as well.
+    #
+    def do(self, key, fn, *args, **kwargs):
+        d = defer.Deferred()
+        waiting = self._pending.get(key)
+        if waiting is not None:
+            self.coalesced += 1
+            waiting.append(d)
+            return d
+
+        self.issued += 1
+        waiting = [ d ]
+        self._pending[key] = waiting
+
+        def done(rv):
+            del self._pending[key]
+            for w in waiting:
+                w.callback(rv)
+            return None
+
+        def failed(err):
+            del self._pending[key]
+            log.msg("SingleFlight: lookup {} failed, {} waiting".format(key, len(waiting)))
+            for w in waiting:
+                w.errback(err)
+            return None
+
+        defer.maybeDeferred(fn, *args, **kwargs).addCallbacks(done, failed)
+
+        return d
+
+    def __len__(self):
+        return len(self._pending)
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'issued': self.issued,
+            'coalesced': self.coalesced
+        }
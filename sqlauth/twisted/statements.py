@@ -0,0 +1,218 @@
+###############################################################################
+##
+##  Copyright (C) 2014 Greg Fausak
+##
+##  Licensed under the Apache License, Version 2.0 (the "License");
+##  you may not use this file except in compliance with the License.
+##  You may obtain a copy of the License at
+##
+##        http://www.apache.org/licenses/LICENSE-2.0
+##
+##  Unless required by applicable law or agreed to in writing, software
+##  distributed under the License is distributed on an "AS IS" BASIS,
+##  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+##  See the License for the specific language governing permissions and
+##  limitations under the License.
+##
+###############################################################################
+
+###############################################################################
+## statements.py - the fixed hot path statements, and a registry to prepare them
+##
+## the login lookup, the permission check and the session/activity inserts
+## are the same text every time.  they are kept here so that the code that
+## sends them (UserDb, AuthorizeRouter, DirectDb) and the code that prepares
+## them agree on the text.  DirectDb recognizes a registered statement by its
+## text, on postgres it is PREPAREd once on each pooled connection and run
+## with EXECUTE from then on.  every registered statement is timed, prepared
+## or not, so the two can be compared.
+###############################################################################
+
+import re
+import time
+
+from twisted.python import log
+
+from sqlauth.backend.postgres import array_literal
+
+# UserDb.get
+LOGIN_QUERY = "select password, salt, id from login where login = %(login)s"
+
+# AuthorizeRouter.check_permission, topiclist is a tuple of the uri's prefixes.
+# the first row decides, the shortest topic, and on it a deny (false sorts
+# first) over an allow, like AclTrie.check.
+PERMISSION_QUERY = """
+        select t.name, length(t.name) as topic_length, tr.allow
+          from topic as t,
+               topicrole as tr,
+               loginrole as lr
+         where
+            t.name in %(topiclist)s
+           and
+            t.id = tr.topic_id
+           and
+            tr.role_id = lr.role_id
+           and
+            tr.type_id = %(action)s
+           and
+            lr.login_id = %(authid)s
+      order by
+            topic_length,
+            tr.allow"""
+
+# the list of prefixes varies in length, so the prepared form takes an array
+PERMISSION_PREPARE = PERMISSION_QUERY.replace("t.name in %(topiclist)s",
+    "t.name = any(%(topiclist)s::text[])")
+
+SESSION_ADD = """
+            insert into session ( login_id, ab_session_id, tzname, router_epoch )
+            values ( %(login_id)s, %(ab_session_id)s,
+                ( select tzname from login where id = %(login_id)s ), %(router_epoch)s )"""
+
+# every session still open that this run of the router didn't open
+SESSION_RECOVER = """
+            update session set ab_session_id = null
+             where ab_session_id is not null
+               and ( router_epoch is null or router_epoch <> %(router_epoch)s )"""
+
+SESSION_DELETE = """
+            update session set ab_session_id = null
+             where ab_session_id = %(ab_session_id)s"""
+
+ACTIVITY_ADD = """
+            insert into activity ( session_id, topic_name, type_id, allow )
+            values (
+                ( select id from session where ab_session_id = %(ab_session_id)s ),
+                %(topic_name)s, %(type_id)s, %(allow)s )"""
+
+_ARG = re.compile(r'%\((\w+)\)s')
+
+class Statement(object):
+    """
+    one registered statement and its timings
+    """
+
+    def __init__(self, name, sql, prepare=None):
+        self.name = name
+        self.sql = sql
+        # the server side version, %(name)s arguments become $1, $2 ...
+        self.args = []
+        def sub(m):
+            if not m.group(1) in self.args:
+                self.args.append(m.group(1))
+            return '$' + str(self.args.index(m.group(1)) + 1)
+        self.prepare_sql = "prepare {} as {}".format(name, _ARG.sub(sub, prepare or sql))
+        if self.args:
+            self.execute_sql = "execute {} ({})".format(name,
+                ', '.join([ '%(' + a + ')s' for a in self.args ]))
+        else:
+            self.execute_sql = "execute {}".format(name)
+
+        self.calls = 0
+        self.prepared_calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+        return
+
+    def record(self, elapsed, prepared, error=False):
+        self.calls += 1
+        if prepared:
+            self.prepared_calls += 1
+        if error:
+            self.errors += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+        return
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'prepared_calls': self.prepared_calls,
+            'errors': self.errors,
+            'total_ms': round(self.total * 1000.0, 3),
+            'avg_ms': round(self.total * 1000.0 / self.calls, 3) if self.calls else 0.0,
+            'max_ms': round(self.max * 1000.0, 3)
+        }
+
+class StatementRegistry(object):
+    """
+    statements known by their text, prepared per connection
+    """
+
+    def __init__(self, prefix='sqlauth_'):
+        self.prefix = prefix
+        self._by_sql = {}
+        self._by_name = {}
+        # id of the dbapi connection -> names prepared on it.  every new
+        # connection goes through prepare_connection first, so a reused id
+        # is always overwritten before it is looked at.
+        self._prepared = {}
+
+        return
+
+    def register(self, name, sql, prepare=None):
+        st = Statement(self.prefix + name, sql, prepare)
+        self._by_sql[sql] = st
+        self._by_name[st.name] = st
+        return st
+
+    def find(self, sql):
+        return self._by_sql.get(sql)
+
+    def __len__(self):
+        return len(self._by_name)
+
+    #
+    # the pool's cp_openfun, PREPARE everything on a new connection.  a statement
+    # that won't prepare (a table not there yet) is left to run as plain sql
+    # on this connection.
+    #
+    def prepare_connection(self, conn):
+        done = set()
+        cur = conn.cursor()
+        for st in self._by_name.values():
+            try:
+                cur.execute(st.prepare_sql)
+                done.add(st.name)
+            except Exception as e:
+                log.msg("StatementRegistry.prepare_connection: {} error {}".format(st.name, e))
+                conn.rollback()
+        cur.close()
+        conn.commit()
+        self._prepared[id(conn)] = done
+        log.msg("StatementRegistry.prepare_connection: {} of {} prepared".format(len(done), len(self._by_name)))
+
+        return
+
+    def is_prepared(self, conn, st):
+        return st.name in self._prepared.get(id(conn), ())
+
+    #
+    # run st on cursor cur with arguments a through execute(cur, s, a, prepared),
+    # prepared if it is prepared on this connection.  the time taken is recorded.
+    #
+    def run(self, cur, st, a, execute):
+        prepared = self.is_prepared(cur.connection, st)
+        if prepared:
+            s = st.execute_sql
+            # tuples are 'in' lists in the plain text, arrays when prepared.
+            # a list would be adapted to an in list too, see array_literal
+            a = dict((k, array_literal(v) if isinstance(v, ( tuple, list, )) else v) for k, v in a.items())
+        else:
+            s = st.sql
+        start = time.time()
+        try:
+            rv = execute(cur, s, a, prepared)
+        except Exception:
+            st.record(time.time() - start, prepared, error=True)
+            raise
+        st.record(time.time() - start, prepared)
+
+        return rv
+
+    def stats(self):
+        return dict((st.name, st.stats()) for st in self._by_name.values())
@@ -23,12 +23,23 @@
 ## i abstracted the database layer, then this layer, to separate the router code from this.
 ###############################################################################
 
-import six, sys
+import six, sys, time
 from twisted.python import log
 from twisted.internet import defer
 from twisted.internet.defer import inlineCallbacks, returnValue
 from autobahn.wamp import types
 
+from sqlauth.twisted.cache import LruCache
+from sqlauth.twisted.singleflight import SingleFlight
+from sqlauth.twisted.statements import LOGIN_QUERY
+from sqlauth.twisted import metrics
+from sqlauth.twisted import logger
+
+USER_GET = metrics.registry.histogram('sqlauth_userdb_get_seconds',
+    'UserDb.get, by where the answer came from (hit, negative or query), seconds', ( 'result', ))
+
+LOG = logger.Logger('UserDb', hot=True)
+
 class UserDb(object):
     """
     basic user database for authentication
@@ -44,14 +55,30 @@ class UserDb(object):
     # topic_base could be 'sys.db', such that 'sys.db.query' and 'sys.db.watch' and 'sys.db.operation'
     # are all available, and the connection has already been made.
     #
-    def __init__(self, topic_base, debug=False, app_session=None):
-        if debug is not None and debug:
-            log.startLogging(sys.stdout)
+    # with cache_size set, found logins are remembered for cache_ttl seconds and
+    # logins that don't exist for negative_ttl seconds.  sqlauthrpc user.add and
+    # user.delete publish a change notice that drops the login from both.
+    #
+    # concurrent gets for the same login share one query through flight, a
+    # SingleFlight that may be shared with the AuthorizeRouter.
+    #
+    def __init__(self, topic_base, debug=False, app_session=None,
+            cache_size=0, cache_ttl=300, negative_ttl=5, flight=None):
+        logger.start(debug is not None and debug)
         log.msg("UserDb:__init__()")
         self.app_session = app_session
         self.topic_base = topic_base
         self.query = topic_base + '.query'
         self.debug = debug
+        self.cache = None
+        self.negative = None
+        if cache_size > 0:
+            self.cache = LruCache(size=cache_size, ttl=cache_ttl)
+            self.negative = LruCache(size=cache_size, ttl=negative_ttl)
+        self.flight = flight or SingleFlight()
+        # bumped by invalidate, a query that started before a change
+        # neither fills the cache nor is shared with callers after it.
+        self.generation = 0
 
         return
 
@@ -63,11 +90,53 @@ class UserDb(object):
  
     @inlineCallbacks
     def get(self,authid):
-        log.msg("UserDb:get({})".format(authid))
-        rv = yield self.app_session.call(self.query, "select password, salt, id from login where login = %(login)s",
+        LOG.debug("get({})", authid)
+        start = time.time()
+        if self.cache is not None:
+            rv = self.cache.get(authid)
+            if rv is not None:
+                USER_GET.since(start, 'hit')
+                defer.returnValue(rv)
+            if authid in self.negative:
+                USER_GET.since(start, 'negative')
+                defer.returnValue((None, None, None, None))
+        rv = yield USER_GET.track(self.flight.do(('login', authid, self.generation), self.lookup, authid),
+            start, 'query')
+        defer.returnValue(rv)
+        return
+
+    @inlineCallbacks
+    def lookup(self,authid):
+        generation = self.generation
+        rv = yield self.app_session.call(self.query, LOGIN_QUERY,
                 { 'login':authid }, options=types.CallOptions(timeout=2000,discloseMe=True))
         if len(rv) > 0:
-            defer.returnValue((six.u(rv[0]['salt']), six.u(rv[0]['password']), six.u('user'), rv[0]['id']))
+            rv = (six.u(rv[0]['salt']), six.u(rv[0]['password']), six.u('user'), rv[0]['id'])
+            if self.cache is not None and generation == self.generation:
+                self.cache.set(authid, rv)
+            defer.returnValue(rv)
         else:
+            if self.negative is not None and generation == self.generation:
+                self.negative.set(authid, True)
             defer.returnValue((None, None, None, None))
         return
+
+    #
+    # change notice from sqlauthrpc, only login changes matter here.
+    # a notice without a login forgets everyone.
+    #
+    def invalidate(self, table=None, login=None, **kwargs):
+        if table != 'login':
+            return
+        self.generation += 1
+        if self.cache is None:
+            return
+        log.msg("UserDb:invalidate({})".format(login))
+        if login is None:
+            self.cache.clear()
+            self.negative.clear()
+        else:
+            self.cache.delete(login)
+            self.negative.delete(login)
+
+        return